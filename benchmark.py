@@ -0,0 +1,324 @@
+"""Route latency benchmarks for Crafter's Closet.
+
+For each dataset size, loads a synthetic inventory of that many items into a
+scratch database, drives the main routes through the Flask test client, and
+reports latency percentiles and query counts for each route. Save a baseline
+once, then compare later runs against it to catch regressions:
+
+    python benchmark.py --sizes 10,1000 --save-baseline
+    python benchmark.py --sizes 10,1000
+
+Never point --uri at a database you care about. Its tables get dropped.
+"""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import urllib
+
+from model import connect_to_db, db, unit_of_work
+from query_stats import track_queries
+from seed import (bulk_load_all, set_val_user_id, set_val_sd_id, set_val_item_id,
+                  set_val_project_id, set_val_ps_id)
+from server import app
+from synthetic_data import SyntheticCatalog, generate_seed_files
+
+BENCHMARK_URI = "postgresql:///crafterscloset_bench"
+
+# Inventory sizes to benchmark, in items.
+BENCHMARK_SIZES = [10, 1000, 100000, 1000000]
+
+# Timed requests per route, after one untimed request to warm caches up.
+BENCHMARK_REQUESTS = 30
+
+BASELINE_FILE = "benchmark_baseline.json"
+
+# A route regresses if a percentile gets this much slower than its baseline,
+# as a fraction, and by at least REGRESSION_FLOOR_MS, so a route going from
+# 1ms to 2ms doesn't count. Any increase in queries counts.
+REGRESSION_THRESHOLD = 0.25
+REGRESSION_FLOOR_MS = 5.0
+
+PERCENTILES = [50, 95, 99]
+
+# What the dashboard's jQuery sends when it wants JSON back.
+JQUERY_JSON_ACCEPT = "application/json, text/javascript, */*; q=0.01"
+
+BENCHMARK_USER_ID = 1
+
+
+##########################################################
+# Synthetic data
+##########################################################
+
+def get_benchmark_catalog(items):
+    """Return the synthetic catalog for a benchmark dataset of items items. It
+    has a few more supplies than the user owns, so there's something to add."""
+
+    return SyntheticCatalog(items + 100)
+
+
+def write_benchmark_seed_files(seed_dir, items, seed=0):
+    """Write u.* seed files for a benchmark user who owns items different
+    supplies, plus projects that use them, into seed_dir."""
+
+    generate_seed_files(seed_dir, users=1, supply_details=len(get_benchmark_catalog(items)),
+                        items=items, projects=min(max(10, items // 100), 10000), seed=seed)
+
+
+def load_benchmark_data(items, seed=0):
+    """Replace the database's contents with a benchmark dataset of items
+    items."""
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    seed_dir = tempfile.mkdtemp(prefix="cc-benchmark-")
+
+    try:
+        write_benchmark_seed_files(seed_dir, items, seed)
+        bulk_load_all(seed_dir)
+
+    finally:
+        shutil.rmtree(seed_dir)
+
+    if db.engine.dialect.name == "postgresql":
+        with unit_of_work():
+            set_val_user_id()
+            set_val_sd_id()
+            set_val_item_id()
+            set_val_project_id()
+            set_val_ps_id()
+
+        # Give the planner real statistics, like a long-lived database has.
+        db.session.remove()
+        connection = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        connection.execute("ANALYZE")
+        connection.close()
+
+
+##########################################################
+# Routes
+##########################################################
+
+def get_benchmark_routes(items):
+    """Return (name, method, url, form data, headers) for each route to
+    benchmark against a dataset of items items."""
+
+    supply_type, brand, color, units = get_benchmark_catalog(items).get_supply(1)
+
+    def query(**params):
+        return urllib.urlencode(params)
+
+    json_headers = {"Accept": JQUERY_JSON_ACCEPT}
+
+    return [
+        ("dashboard", "GET", "/dashboard", None, None),
+        ("inventory chart", "GET", "/supply-types", None, None),
+        ("inventory data", "GET", "/inventory/data", None, None),
+        ("inventory filter", "GET", "/inventory/filter?" + query(brand=brand, supplytype="", color=""),
+         None, None),
+        ("inventory search", "GET", "/inventory/search-results?" + query(search=color.split()[0]),
+         None, None),
+        ("inventory autocomplete", "GET", "/inventory/search-autocomplete-tags?" + query(search="re"),
+         None, None),
+        ("project page", "GET", "/project/1", None, None),
+        ("project search", "GET", "/projects/search-results?" + query(search=supply_type.split()[-1]),
+         None, None),
+        ("catalog brands", "GET", "/dashboard/brands", None, None),
+        ("catalog units", "GET", "/dashboard/units", None, None),
+        ("catalog colors", "GET", "/typeahead/colors-by-brand?" + query(brand=brand), None, None),
+        ("add supply", "POST", "/add-supply",
+         {"supplytype": supply_type, "brand": brand, "color": color, "units": units,
+          "quantity-owned": "1"}, None),
+        ("update supply", "POST", "/update-item", {"itemID": "1", "qty": "5"}, json_headers),
+    ]
+
+
+##########################################################
+# Measuring
+##########################################################
+
+def percentile(values, p):
+    """Return the pth percentile of values, by the nearest-rank method."""
+
+    ordered = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(ordered)))
+
+    return ordered[max(rank, 1) - 1]
+
+
+def benchmark_route(client, method, url, data, headers, requests):
+    """Request a route requests times, after one untimed request, and return
+    its latency percentiles in milliseconds and how many queries it ran."""
+
+    timings = []
+    query_counts = []
+
+    for i in range(requests + 1):
+        with track_queries() as stats:
+            start = time.time()
+            response = client.open(url, method=method, data=data, headers=headers)
+            elapsed = (time.time() - start) * 1000
+
+        if response.status_code >= 400:
+            raise RuntimeError("%s %s failed with %s" % (method, url, response.status))
+
+        if i == 0:
+            cold = elapsed
+            continue
+
+        timings.append(elapsed)
+        query_counts.append(stats.count)
+
+    result = {"cold": cold, "queries": max(query_counts)}
+
+    for p in PERCENTILES:
+        result["p%d" % p] = percentile(timings, p)
+
+    return result
+
+
+def run_benchmarks(sizes, requests=BENCHMARK_REQUESTS, route_names=None, seed=0):
+    """Benchmark each route at each dataset size. Returns a dictionary of
+    results for each route, by route name, by size."""
+
+    results = {}
+
+    for size in sizes:
+        print "\n****Benchmarking %s items****" % format_size(size)
+
+        routes = get_benchmark_routes(size)
+
+        if route_names:
+            routes = [route for route in routes if route[0] in route_names]
+
+        load_benchmark_data(size, seed)
+
+        client = app.test_client()
+
+        with client.session_transaction() as session:
+            session["user_id"] = BENCHMARK_USER_ID
+            session["username"] = "crafter%d" % BENCHMARK_USER_ID
+
+        results[str(size)] = {}
+
+        for name, method, url, data, headers in routes:
+            result = benchmark_route(client, method, url, data, headers, requests)
+            results[str(size)][name] = result
+
+        print_results(results[str(size)])
+
+    return results
+
+
+def find_regressions(results, baseline, threshold=REGRESSION_THRESHOLD,
+                     floor=REGRESSION_FLOOR_MS):
+    """Return a description of each way results are worse than baseline.
+    Routes and sizes missing from the baseline aren't compared."""
+
+    regressions = []
+
+    for size, routes in sorted(results.items()):
+        for name, result in sorted(routes.items()):
+            base = baseline.get(size, {}).get(name)
+
+            if base is None:
+                continue
+
+            for p in PERCENTILES:
+                key = "p%d" % p
+                allowed = max(base[key] * (1 + threshold), base[key] + floor)
+
+                if result[key] > allowed:
+                    regressions.append("%s at %s items: %s %.1fms, baseline %.1fms" %
+                                       (name, format_size(int(size)), key, result[key], base[key]))
+
+            if result["queries"] > base["queries"]:
+                regressions.append("%s at %s items: %d queries, baseline %d" %
+                                   (name, format_size(int(size)), result["queries"], base["queries"]))
+
+    return regressions
+
+
+def format_size(size):
+    """Return a short label for a dataset size, like 1k or 1M."""
+
+    for factor, suffix in ((1000000, "M"), (1000, "k")):
+        if size >= factor and size % factor == 0:
+            return "%d%s" % (size // factor, suffix)
+
+    return str(size)
+
+
+def print_results(routes):
+    """Print one size's results as a table."""
+
+    print "\n%-24s %9s %9s %9s %9s %8s" % ("route", "cold ms", "p50 ms", "p95 ms", "p99 ms", "queries")
+
+    for name, result in sorted(routes.items()):
+        print "%-24s %9.1f %9.1f %9.1f %9.1f %8d" % (name, result["cold"], result["p50"],
+                                                    result["p95"], result["p99"],
+                                                    result["queries"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Crafter's Closet routes "
+                                                 "at several dataset sizes.")
+    parser.add_argument("--uri", default=BENCHMARK_URI,
+                        help="scratch database to benchmark against; its tables get dropped")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in BENCHMARK_SIZES),
+                        help="comma-separated inventory sizes, in items")
+    parser.add_argument("--requests", type=int, default=BENCHMARK_REQUESTS,
+                        help="timed requests per route")
+    parser.add_argument("--routes", help="comma-separated names of routes to benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the dataset")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline file")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="save these results as the new baseline, instead of comparing")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="how much slower than baseline counts as a regression, as a fraction")
+    args = parser.parse_args()
+
+    # Loading a million rows takes longer than a web request should.
+    connect_to_db(app, args.uri, profile="web", statement_timeout=0)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    route_names = args.routes.split(",") if args.routes else None
+
+    results = run_benchmarks(sizes, args.requests, route_names, args.seed)
+
+    if args.save_baseline:
+        baseline = {}
+
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        # Keep the baselines for sizes we didn't run this time.
+        baseline.update(results)
+
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+
+        print "\nSaved baseline to %s." % args.baseline
+
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.threshold)
+
+        if regressions:
+            print "\n****Regressions****\n"
+            print "\n".join(regressions)
+            sys.exit(1)
+
+        print "\nNo regressions against %s." % args.baseline
+
+    else:
+        print "\nNo baseline at %s to compare against." % args.baseline
@@ -0,0 +1,121 @@
+"""In-process caches for Crafter's Closet data that changes rarely."""
+
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class VersionedCache(object):
+    """A small in-memory cache whose entries are only good for the version
+    they were computed under.
+
+    Bumping the version throws everything out at once, so writers don't need
+    to know which keys their change affects. Entries can optionally expire
+    after ttl seconds, and the cache can optionally be capped at max_entries,
+    in which case the least recently used entry is dropped first.
+    """
+
+    def __init__(self, ttl=None, max_entries=None):
+        self.version = 0
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        # Keys are kept in least to most recently used order.
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def bump_version(self):
+        """Invalidate every entry in the cache."""
+
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def get(self, key):
+        """Return the cached value for key, or None if there isn't a fresh one."""
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None:
+                return None
+
+            version, stored_at, value = entry
+
+            # Stale entries just stay popped.
+            if version != self.version:
+                return None
+
+            if self.ttl is not None and time.time() - stored_at >= self.ttl:
+                return None
+
+            # Put the entry back at the most recently used end.
+            self._entries[key] = entry
+
+            return value
+
+    def set(self, key, value, version=None):
+        """Store value under key. If the value was computed under an older
+        version than the current one, it's thrown away instead."""
+
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+
+            self._entries.pop(key, None)
+            self._entries[key] = (self.version, time.time(), value)
+
+            if self.max_entries is not None:
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """Return the cached value for key, calling compute() to fill the
+        cache if there isn't a fresh value."""
+
+        value = self.get(key)
+
+        if value is None:
+            # Note the version before computing, so a write that lands while
+            # we're computing doesn't get papered over by our stale result.
+            version = self.version
+            value = compute()
+            self.set(key, value, version)
+
+        return value
+
+    def clear(self):
+        """Drop every entry without changing the version."""
+
+        with self._lock:
+            self._entries.clear()
+
+
+# The supply catalog only changes when a supply detail gets added, and that
+# bumps the version. Other server processes won't see that bump, though, so
+# let entries expire after a few minutes no matter what.
+CATALOG_CACHE_TTL = 300
+
+catalog_cache = VersionedCache(ttl=CATALOG_CACHE_TTL, max_entries=64)
+
+# Colors for each brand someone's typed in, filed under the catalog_cache
+# version they were found in. Typing can make any number of these, so they get
+# a cache of their own and can't push the catalog itself out.
+brand_colors_cache = VersionedCache(ttl=CATALOG_CACHE_TTL, max_entries=256)
+
+
+# Rendered inventory HTML and JSON, filed under each user's inventory version
+# (see model.get_inventory_version()), so nothing rendered for an older
+# version is ever handed out again.
+#
+# That version comes from the database, so every process sees a change as soon
+# as it's committed, and fragments could live until they're pushed out. Only a
+# reseed in another process, which starts versions over, can make an entry
+# wrong, so they expire after ten minutes in case of that.
+INVENTORY_FRAGMENT_TTL = 600
+
+inventory_fragments = VersionedCache(ttl=INVENTORY_FRAGMENT_TTL, max_entries=1000)
+
+# The HTML for one inventory row depends on nothing but the row, so rows can
+# be shared between tables, no matter how they were filtered.
+row_fragments = VersionedCache(max_entries=10000)
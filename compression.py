@@ -0,0 +1,121 @@
+"""Response compression for Crafter's Closet.
+
+Big inventory tables and catalog JSON go over the wire compressed, with
+Brotli if it's installed and the browser takes it, and gzip otherwise.
+"""
+
+from flask import request
+import zlib
+
+from cache import VersionedCache
+
+# Brotli compresses text better than gzip, but it's an optional extra.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Only text is worth compressing. Images and the like already are.
+COMPRESSIBLE_MIMETYPES = set(["text/html", "text/css", "text/plain",
+                              "application/json", "application/javascript"])
+
+# Below this many bytes, compressing saves less than it costs.
+COMPRESS_MIN_SIZE = 500
+
+# gzip levels run 1-9 and Brotli qualities 0-11. These trade a little size
+# for a lot of speed.
+COMPRESS_LEVEL = 6
+COMPRESS_BROTLI_QUALITY = 5
+
+# Compressed bodies of responses with ETags, like the catalog JSON. An ETag
+# names exactly one body, so entries never go stale, they just fall out.
+compressed_payloads = VersionedCache(max_entries=128)
+
+
+def init_compression(app):
+    """Compress the app's responses from now on, using the COMPRESS_* settings
+    in app.config, where there are any."""
+
+    app.config.setdefault("COMPRESS_MIMETYPES", COMPRESSIBLE_MIMETYPES)
+    app.config.setdefault("COMPRESS_MIN_SIZE", COMPRESS_MIN_SIZE)
+    app.config.setdefault("COMPRESS_LEVEL", COMPRESS_LEVEL)
+    app.config.setdefault("COMPRESS_BROTLI_QUALITY", COMPRESS_BROTLI_QUALITY)
+
+    @app.after_request
+    def compress_response(response):
+        return compress(response, app.config)
+
+
+def compress(response, config):
+    """Compress response in place, if it's worth compressing and the browser
+    can take it. Returns the response."""
+
+    # Leave alone anything that's streamed, empty, or already encoded.
+    if (response.direct_passthrough or response.is_streamed or
+            response.status_code < 200 or response.status_code in (204, 304) or
+            "Content-Encoding" in response.headers):
+        return response
+
+    if response.mimetype not in config["COMPRESS_MIMETYPES"]:
+        return response
+
+    data = response.get_data()
+
+    if len(data) < config["COMPRESS_MIN_SIZE"]:
+        return response
+
+    # Whether or not this browser gets it compressed, the next one might, so
+    # caches need to keep the two apart.
+    response.vary.add("Accept-Encoding")
+
+    encoding = choose_encoding(request.accept_encodings)
+
+    if encoding is None:
+        return response
+
+    etag, weak = response.get_etag()
+
+    if etag:
+        compressed = compressed_payloads.get_or_compute(
+            (etag, encoding),
+            lambda: compress_data(data, encoding, config))
+    else:
+        compressed = compress_data(data, encoding, config)
+
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+
+    # A strong ETag promises byte-for-byte identical bodies, so the compressed
+    # body needs an ETag of its own. If the browser already has it, there's
+    # nothing to send after all.
+    if etag:
+        response.set_etag("%s-%s" % (etag, encoding), weak)
+        response.make_conditional(request)
+
+    return response
+
+
+def choose_encoding(accept_encodings):
+    """Return the best encoding the browser accepts that we can produce, or
+    None if it should get the response as is."""
+
+    if brotli is not None and accept_encodings["br"]:
+        return "br"
+
+    if accept_encodings["gzip"]:
+        return "gzip"
+
+    return None
+
+
+def compress_data(data, encoding, config):
+    """Compress a string of bytes with the given encoding."""
+
+    if encoding == "br":
+        return brotli.compress(data, quality=config["COMPRESS_BROTLI_QUALITY"])
+
+    # A wbits of 16 + 15 gets zlib to write a gzip header, with no timestamp,
+    # so the same data always compresses to the same bytes.
+    compressor = zlib.compressobj(config["COMPRESS_LEVEL"], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    return compressor.compress(data) + compressor.flush()
@@ -0,0 +1,177 @@
+"""Database engine settings for the different ways Crafter's Closet runs."""
+
+from sqlalchemy import exc, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from threading import Lock
+import time
+
+# Each profile says how to pool connections and how long a statement may run.
+#
+# web: many short requests from each worker. Keep a few connections warm,
+#      allow bursts, give up on a busy pool quickly rather than pile up, and
+#      check connections still work before handing them out, since Postgres
+#      or a proxy may have dropped idle ones.
+# seed: one long-running script doing big loads, so one connection, and no
+#       statement timeout.
+# test: a handful of connections, failing fast if a test leaks one.
+#
+# Times are in seconds, except statement_timeout, which is in milliseconds,
+# like Postgres's. A statement_timeout of 0 means no timeout.
+ENGINE_PROFILES = {
+    "web": {"pool_size": 5,
+            "max_overflow": 10,
+            "pool_timeout": 10,
+            "pool_recycle": 1800,
+            "pre_ping": True,
+            "statement_timeout": 5000,
+            "isolation_level": "READ COMMITTED"},
+
+    "seed": {"pool_size": 1,
+             "max_overflow": 0,
+             "pool_timeout": 30,
+             "pool_recycle": -1,
+             "pre_ping": False,
+             "statement_timeout": 0,
+             "isolation_level": "READ COMMITTED"},
+
+    "test": {"pool_size": 2,
+             "max_overflow": 2,
+             "pool_timeout": 5,
+             "pool_recycle": -1,
+             "pre_ping": False,
+             "statement_timeout": 30000,
+             "isolation_level": "READ COMMITTED"},
+}
+
+
+def get_engine_options(uri, profile="web", **overrides):
+    """Return the keyword arguments for create_engine() to connect to uri with
+    the settings from the named profile. Any setting in the profile can be
+    overridden by passing it as a keyword argument."""
+
+    if profile not in ENGINE_PROFILES:
+        raise ValueError("No engine profile named %r." % profile)
+
+    settings = dict(ENGINE_PROFILES[profile])
+    settings.update(overrides)
+
+    drivername = make_url(uri).drivername
+
+    # SQLite lives in our process, so there's no server to pool connections
+    # to or to time statements out on. Leave it to Flask-SQLAlchemy.
+    if drivername.startswith("sqlite"):
+        return {}
+
+    options = {"poolclass": PingingQueuePool if settings["pre_ping"] else TimedQueuePool,
+               "pool_size": settings["pool_size"],
+               "max_overflow": settings["max_overflow"],
+               "pool_timeout": settings["pool_timeout"],
+               "pool_recycle": settings["pool_recycle"]}
+
+    if drivername.startswith("postgresql"):
+        options["isolation_level"] = settings["isolation_level"]
+
+        if settings["statement_timeout"]:
+            options["connect_args"] = {
+                "options": "-c statement_timeout=%d" % settings["statement_timeout"]}
+
+    return options
+
+
+##########################################################
+# Connection pools
+##########################################################
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that keeps track of how long callers wait for connections,
+    and how often they give up waiting."""
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+
+        self._stats_lock = Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        start = time.time()
+
+        try:
+            connection = super(TimedQueuePool, self)._do_get()
+
+        except exc.TimeoutError:
+            self.record_wait(time.time() - start, timed_out=True)
+            raise
+
+        self.record_wait(time.time() - start)
+
+        return connection
+
+    def record_wait(self, wait, timed_out=False):
+        """Add one wait for a connection to the totals."""
+
+        with self._stats_lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+
+class PingingQueuePool(TimedQueuePool):
+    """A TimedQueuePool that makes sure each connection still works before
+    handing it out. See ping_connection()."""
+
+
+@event.listens_for(PingingQueuePool, "checkout")
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Check a connection is still alive as it's checked out. If it isn't,
+    the pool throws it away and tries again with a fresh one."""
+
+    cursor = dbapi_connection.cursor()
+
+    try:
+        cursor.execute("SELECT 1")
+
+    except Exception:
+        raise exc.DisconnectionError()
+
+    finally:
+        cursor.close()
+
+
+def get_pool_stats(engine):
+    """Return a dictionary describing how the engine's connection pool is
+    doing right now, for sizing pools against Postgres's max_connections.
+
+    Waits are in seconds. Pools that don't keep connections, like the ones
+    used for SQLite, only report their class.
+    """
+
+    pool = engine.pool
+    stats = {"pool_class": type(pool).__name__}
+
+    if isinstance(pool, QueuePool):
+        stats.update({"size": pool.size(),
+                      "checked_in": pool.checkedin(),
+                      "checked_out": pool.checkedout(),
+                      # The pool counts up from -size, and only goes
+                      # positive once it's opened connections past its size.
+                      "overflow": max(pool.overflow(), 0)})
+
+    if isinstance(pool, TimedQueuePool):
+        with pool._stats_lock:
+            waits = pool.checkouts + pool.timeouts
+
+            stats.update({"checkouts": pool.checkouts,
+                          "timeouts": pool.timeouts,
+                          "total_wait": pool.total_wait,
+                          "mean_wait": pool.total_wait / waits if waits else 0.0,
+                          "max_wait": pool.max_wait})
+
+    return stats
@@ -1,52 +1,81 @@
 """Helper functions specific to Crafter's Closet project."""
 
-from model import SupplyDetail, ProjectSupply, Item, Project, User, db
+from model import (SupplyDetail, ProjectSupply, Item, Project, User, db,
+                   get_supply_key_columns, normalize_supply_key, on_commit,
+                   get_inventory_version, has_unsaved_changes)
+from cache import catalog_cache, inventory_fragments, brand_colors_cache
+from search_index import (add_inventory_tags, get_supply_tags, ProjectSearchIndex,
+                          project_search_indexes)
 from flask import jsonify, request
+from functools import partial
+from itertools import groupby
+import hashlib
+import json
 import math
 
 CHART_COLORS = ["#b366ff", "#0059b3", "#00cc99", "#ffd480",
                 "#ff99cc", "#b3e6ff", "#bfff80", "#ffccb3"]
 
+# Roughly how much physical space one unit of each type of supply takes up,
+# relative to the others. The inventory chart scales each type's total by this.
+CHART_WEIGHTS = {
+    "Fabric": .8, "Felt": .5, "Yarn": .5, "Acrylic Paint": .5,
+    "Oven-Bake Clay": .5, "Conductive Thread": .09, "LEDs": .1,
+    "Color Sensor": 1, "Arduino Board": 1
+}
+
+# Weight for supply types that aren't in CHART_WEIGHTS, like ones users add.
+DEFAULT_CHART_WEIGHT = 1
+
+PROJECT_SEARCH_PAGE_SIZE = 20
+
 
 ####################################################################
 # Get all non-duplicate, non-null fields in a column from the
 # supply_details table.
+#
+# The catalog only changes when add_supply_to_db runs, so these are
+# served from the in-process catalog cache.
 ####################################################################
 
 def get_all_supply_types():
     """Returns all existing types of supplies from the db."""
 
-    all_supply_types = set(db.session.query(SupplyDetail.supply_type).all())
-    all_supply_types = sorted(list(all_supply_types))
+    def query_supply_types():
+        all_supply_types = set(db.session.query(SupplyDetail.supply_type).all())
+        return sorted(list(all_supply_types))
 
-    return all_supply_types
+    return list(catalog_cache.get_or_compute("supply_types", query_supply_types))
 
 
 def get_all_brands():
     """Returns all existing brands in db."""
 
-    all_brands = set(db.session.query(SupplyDetail.brand).filter(SupplyDetail.brand != None).all())
-    all_brands = sorted(list(all_brands))
+    def query_brands():
+        all_brands = set(db.session.query(SupplyDetail.brand).filter(SupplyDetail.brand != None).all())
+        return sorted(list(all_brands))
 
-    return all_brands
+    return list(catalog_cache.get_or_compute("brands", query_brands))
 
 
 def get_all_colors():
     """Returns all existing colors in db."""
 
-    all_colors = set(db.session.query(SupplyDetail.color).filter(SupplyDetail.color != None).all())
-    all_colors = sorted(list(all_colors))
+    def query_colors():
+        all_colors = set(db.session.query(SupplyDetail.color).filter(SupplyDetail.color != None).all())
+        return sorted(list(all_colors))
 
-    return all_colors
+    return list(catalog_cache.get_or_compute("colors", query_colors))
 
 
 def get_all_supply_units():
     """Returns all existing units of measurement from the db."""
 
-    all_units = set(db.session.query(SupplyDetail.units).all())
-    all_units = sorted(list(all_units))
+    def query_units():
+        all_units = set(db.session.query(SupplyDetail.units).all())
+        return sorted(list(all_units))
 
-    return all_units
+    return list(catalog_cache.get_or_compute("units", query_units))
 
 
 ###################################################
@@ -54,8 +83,31 @@ def get_all_supply_units():
 ###################################################
 
 def get_matching_sd(supply_type, brand, color):
-    """Gets an existing supply detail record from the database whose columns match
-    those of the passed supply detail."""
+    """Gets the existing supply detail record from the database whose type,
+    brand, and color exactly match the passed ones, ignoring case and
+    surrounding whitespace. Returns None if there isn't one.
+
+    Keys are looked up in an in-memory index of the whole catalog first. If the
+    key isn't there, it may have been added by another server process, so we
+    ask the database, which can use its unique index on the key.
+    """
+
+    key = normalize_supply_key(supply_type, brand, color)
+    sd_id = get_sd_lookup().get(key)
+
+    if sd_id is not None:
+        return SupplyDetail.query.get(sd_id)
+
+    key_columns = get_supply_key_columns()
+
+    return SupplyDetail.query.filter(*[column == value for column, value in zip(key_columns, key)]).first()
+
+
+def get_fuzzy_matching_sd(supply_type, brand, color):
+    """Gets an existing supply detail record from the database whose columns
+    contain the passed supply type, brand, and color, despite typos. This has
+    to scan the table, and "Red" will happily match "Red Heart", so only use
+    it when a loose match is really what you want."""
 
     # Use ilike() to check columns despite typos
     sd_from_db = SupplyDetail.query.filter(SupplyDetail.supply_type.ilike("%" + supply_type + "%"),
@@ -64,6 +116,52 @@ def get_matching_sd(supply_type, brand, color):
     return sd_from_db
 
 
+def get_matching_sds(supply_keys):
+    """Given a list of (supply_type, brand, color) keys, get all of the existing
+    supply detail records exactly matching any of them in one query, the same
+    way get_matching_sd() matches one.
+
+    Returns a dictionary mapping each normalized key with a match to its
+    supply detail.
+    """
+
+    keys = set(normalize_supply_key(*key) for key in supply_keys)
+
+    if not keys:
+        return {}
+
+    # Look the keys up in memory, and fetch everything we found by id. Ask the
+    # database about any we didn't find, in the same query.
+    sd_lookup = get_sd_lookup()
+    found_ids = [sd_lookup[key] for key in keys if key in sd_lookup]
+    missing_keys = [key for key in keys if key not in sd_lookup]
+
+    matches = SupplyDetail.sd_id.in_(found_ids)
+
+    if missing_keys:
+        matches = matches | db.tuple_(*get_supply_key_columns()).in_(missing_keys)
+
+    sds = SupplyDetail.query.filter(matches).all()
+
+    return {normalize_supply_key(sd.supply_type, sd.brand, sd.color): sd for sd in sds}
+
+
+def get_sd_lookup():
+    """Get a dictionary mapping every supply detail's normalized key to its id,
+    from the catalog cache."""
+
+    def build_lookup():
+        q = db.session.query(SupplyDetail.sd_id,
+                             SupplyDetail.supply_type,
+                             SupplyDetail.brand,
+                             SupplyDetail.color)
+
+        return {normalize_supply_key(supply_type, brand, color): sd_id
+                for sd_id, supply_type, brand, color in q}
+
+    return catalog_cache.get_or_compute("sd_lookup", build_lookup)
+
+
 def get_matching_item(user_id, sd_id):
     """Given a user and a supply id, find an existing item record."""
 
@@ -90,12 +188,159 @@ def add_item_to_inventory(user_id, sd_id, qty):
 
     # Add the new item to the database
     db.session.add(item)
-    db.session.commit()
+    db.session.flush()
+
+    # Keep the user's autocomplete index in step with their inventory, once
+    # the item is saved.
+    on_commit(partial(add_inventory_tags, user_id, get_supply_tags(item.supply_details)))
 
     # Return the id of the item just created.
     return item
 
 
+def add_supplies_to_inventory(user_id, rows):
+    """Add a whole batch of supplies to the user's inventory at once.
+
+    Each row is a dictionary with supply_type, brand, color, units, and qty
+    keys. Supply details for every row are looked up in one query, any that
+    don't exist yet are created, the user's existing items for them are
+    fetched in one more query, and then every item is inserted or updated in
+    a single flush.
+
+    Returns a list with a result dictionary for each row, in order:
+    {"row": ???, "status": ???, "message": ???, "item_id": ???, "qty": ???}
+    where status is "added", "updated", "created", or "error". Rows with
+    errors are skipped; the rest still go in.
+    """
+
+    results = [{"row": i, "status": None, "message": None, "item_id": None, "qty": None}
+               for i in range(len(rows))]
+
+    # Make sure every row has what we need before touching the database.
+    valid_rows = []
+
+    for result, row in zip(results, rows):
+        error = get_supply_row_error(row)
+
+        if error:
+            result["status"] = "error"
+            result["message"] = error
+        else:
+            valid_rows.append((result, row))
+
+    # Fetch every supply detail any of the rows refer to.
+    keys = [normalize_supply_key(row.get("supply_type"), row.get("brand"), row.get("color"))
+            for _, row in valid_rows]
+    sds = get_matching_sds(keys)
+
+    # Create the supply details we don't have yet. Flush, so they get ids.
+    new_sds = []
+
+    for key, (result, row) in zip(keys, valid_rows):
+        if key not in sds:
+            if not (row.get("units") or "").strip():
+                result["status"] = "error"
+                result["message"] = "Units are required for a new supply."
+                continue
+
+            sds[key] = SupplyDetail(supply_type=row["supply_type"].strip(),
+                                    brand=(row.get("brand") or "").strip(),
+                                    color=(row.get("color") or "").strip(),
+                                    units=row["units"].strip())
+            new_sds.append(sds[key])
+            result["status"] = "created"
+
+    db.session.add_all(new_sds)
+    db.session.flush()
+
+    # Fetch the items the user already has for those supplies.
+    sd_ids = [sd.sd_id for sd in sds.itervalues()]
+    items = Item.query.filter(Item.user_id == user_id, Item.sd_id.in_(sd_ids)).all()
+    items_by_sd_id = {item.sd_id: item for item in items}
+
+    new_items = []
+
+    for key, (result, row) in zip(keys, valid_rows):
+        if result["status"] == "error":
+            continue
+
+        sd = sds[key]
+        qty = int(row["qty"])
+        item = items_by_sd_id.get(sd.sd_id)
+
+        # A supply that's already owned, or that an earlier row in this batch
+        # added, just gets more.
+        if item is not None:
+            item.qty += qty
+            result["status"] = result["status"] or "updated"
+            result["message"] = "Amount of %s %s %s updated." % (sd.brand, sd.color, sd.supply_type)
+
+        else:
+            item = Item(user_id=user_id, sd_id=sd.sd_id, qty=qty)
+            items_by_sd_id[sd.sd_id] = item
+            new_items.append(item)
+            result["status"] = result["status"] or "added"
+            result["message"] = "%s %s of %s %s %s have been added to your inventory." % \
+                                (qty, sd.units, sd.brand, sd.color, sd.supply_type)
+
+        result["item"] = item
+
+    db.session.add_all(new_items)
+    db.session.flush()
+
+    # The catalog may have grown, and the user's autocomplete tags along with
+    # it, once everything's saved.
+    if new_sds:
+        on_commit(catalog_cache.bump_version)
+
+    for item in new_items:
+        on_commit(partial(add_inventory_tags, user_id, get_supply_tags(item.supply_details)))
+
+    # Now that everything's flushed, every item has an id.
+    for result in results:
+        item = result.pop("item", None)
+
+        if item is not None:
+            result["item_id"] = item.item_id
+            result["qty"] = item.qty
+
+    return results
+
+
+def get_supply_row_error(row):
+    """Return a message saying what's wrong with a row of supply data, or None
+    if there's nothing wrong with it."""
+
+    if not isinstance(row, dict):
+        return "Each supply should be an object."
+
+    # JSON can send anything, and everything past here expects text.
+    for field in ("supply_type", "brand", "color", "units"):
+        if not isinstance(row.get(field) or "", basestring):
+            return "The %s should be text." % field.replace("_", " ")
+
+    if not (row.get("supply_type") or "").strip():
+        return "A supply type is required."
+
+    # True is an int as far as Python's concerned, and int() would quietly
+    # chop 2.5 down to 2.
+    qty = row.get("qty")
+
+    if isinstance(qty, bool) or not isinstance(qty, (int, long, basestring)):
+        return "The quantity should be a whole number."
+
+    try:
+        qty = int(qty)
+    except ValueError:
+        return "The quantity should be a whole number."
+
+    # Adding none of something would leave an item that isn't in the inventory.
+    if qty <= 0:
+        return "The quantity should be at least 1."
+
+    return None
+
+
 def add_supply_to_db(supply_type, brand, color, units):
     """Add details about a supply to the database.
     Creates a new record for the supply_details table and adds it."""
@@ -108,7 +353,10 @@ def add_supply_to_db(supply_type, brand, color, units):
 
     # Add that record to the database.
     db.session.add(supply_detail)
-    db.session.commit()
+    db.session.flush()
+
+    # Once the catalog changes, anything cached about it is out of date.
+    on_commit(catalog_cache.bump_version)
 
     # Return the id of the supply_detail just created.
     return supply_detail
@@ -120,7 +368,7 @@ def add_user_to_db(email, username, password_hash):
     # Create a user object and add it to the database.
     user = User(email=email, username=username, password=password_hash)
     db.session.add(user)
-    db.session.commit()
+    db.session.flush()
 
 
 def add_project_supply_to_db(project, sd, qty):
@@ -128,7 +376,7 @@ def add_project_supply_to_db(project, sd, qty):
         # Get the entered supply's id
         sd_id = sd.sd_id
 
-        # Create and commit project supply record to db, so the entered
+        # Create and flush project supply record to db, so the entered
         # supply is associated with this project.
 
         project_supply = ProjectSupply(project_id=project.project_id,
@@ -136,11 +384,14 @@ def add_project_supply_to_db(project, sd, qty):
                                        supply_qty=qty)
 
         db.session.add(project_supply)
-        db.session.commit()
+        db.session.flush()
+
+        # The project's supplies are part of what project search looks at.
+        on_commit(project_search_indexes.bump_version)
 
 
 def add_project_to_db(user_id, title, description, instr_url, img_url):
-    #Create and commit project record
+    #Create and flush project record
     project = Project(user_id=user_id,
                       title=title.title(),
                       description=description,
@@ -148,7 +399,61 @@ def add_project_to_db(user_id, title, description, instr_url, img_url):
                       img_url=img_url)
 
     db.session.add(project)
-    db.session.commit()
+    db.session.flush()
+
+    # Make sure project search can find the new project.
+    on_commit(project_search_indexes.bump_version)
+
+    return project
+
+
+def create_project_with_supplies(user_id, title, description, instr_url, img_url, supplies):
+    """Create a project along with all of its supplies, in one transaction.
+
+    supplies is a list of (supply_type, brand, color, qty) tuples. Every
+    supply is resolved in one query. If any of them is blank, doesn't match a
+    supply we know about, or has a bad quantity, ValueError is raised and
+    nothing is added. Otherwise the project and all of its ProjectSupply rows
+    are inserted with a single flush, to be committed along with the rest of
+    the unit of work.
+    """
+
+    sds = get_matching_sds([(supply_type, brand, color)
+                            for supply_type, brand, color, _ in supplies])
+
+    project_supplies = []
+
+    for supply_type, brand, color, qty in supplies:
+        if not (supply_type or "").strip():
+            raise ValueError("Some required supply fields are blank.")
+
+        sd = sds.get(normalize_supply_key(supply_type, brand, color))
+
+        if sd is None:
+            raise ValueError("No supply matches %s." % " ".join(field for field in
+                                                              (brand, color, supply_type)
+                                                              if field))
+
+        try:
+            qty = int(qty)
+        except (TypeError, ValueError):
+            raise ValueError("The quantity of %s %s %s isn't a number." % (brand, color, supply_type))
+
+        project_supplies.append(ProjectSupply(sd_id=sd.sd_id, supply_qty=qty))
+
+    project = Project(user_id=user_id,
+                      title=title.title(),
+                      description=description,
+                      instr_url=instr_url,
+                      img_url=img_url,
+                      project_supplies=project_supplies)
+
+    # Adding the project adds its supplies along with it.
+    db.session.add(project)
+    db.session.flush()
+
+    # Make sure project search can find the new project.
+    on_commit(project_search_indexes.bump_version)
 
     return project
 
@@ -160,47 +465,33 @@ def add_project_to_db(user_id, title, description, instr_url, img_url):
 
 def get_inventory_chart_dict(user_id):
     """Build a JSON object representing the total numbers of each type of item
-    in a user's inventory."""
-
-    weights = {
-        "Fabric": .8, "Felt": .5, "Yarn": .5, "Acrylic Paint": .5,
-        "Oven-Bake Clay": .5, "Conductive Thread": .09, "LEDs": .1,
-        "Color Sensor": 1, "Arduino Board": 1
-    }
-
-    # Get all of the passed user's items
-    items = Item.query.filter(Item.user_id == user_id)
-
-    # Create an empty dict for counting supply quantities and an empty set
-    # to contain non-repeating supply types, to be used as chart labels.
-    type_quantities = {}
-    labels = set([])
+    in a user's inventory.
 
-    # For each item in the user's inventory, get the type and quantity.
-    # If the supply type isn't in the dict, add it. Either way, add the
-    # current quantity to that type's total value. Add the supply type
-    # to the labels set.
-    for item in items:
+    The totals come from a single query grouped by supply type, so the chart
+    costs the same however many items the user owns."""
 
-        supply_type = str(item.supply_details.supply_type)
-        qty_owned = item.qty
+    # Total up the quantity of each type of supply the user owns.
+    q = db.session.query(SupplyDetail.supply_type,
+                         db.func.sum(Item.qty)).join(Item,
+                                                     Item.sd_id == SupplyDetail.sd_id)
+    q = q.filter(Item.user_id == user_id)
+    q = q.group_by(SupplyDetail.supply_type).order_by(SupplyDetail.supply_type)
 
-        wtd_qty_owned = math.floor(qty_owned * weights[supply_type])
+    # Weight each type's total by how much space that kind of supply takes up,
+    # so the chart's slices roughly reflect the physical size of the inventory.
+    labels = []
+    data = []
 
-        type_quantities[supply_type] = type_quantities.get(supply_type, 0)
-        type_quantities[supply_type] += wtd_qty_owned
-        labels.add(supply_type)
-
-    # Put the quantity counts we just made in a list, in the same order as
-    # the labels array.
-    data = [type_quantities[label] for label in labels]
+    for supply_type, qty_owned in q:
+        labels.append(supply_type)
+        data.append(math.floor(qty_owned * get_chart_weight(supply_type)))
 
     # Get enough colors from the global colors list to fill out the chart.
     backgroundColors = CHART_COLORS[:len(labels)]
 
     # Create the data dictionary in a format Chart.js can understand, and
     # return it as JSON.
-    supply_data_dict = {"labels": list(labels),
+    supply_data_dict = {"labels": labels,
                         "datasets": [{"data": data,
                                       "backgroundColor": backgroundColors}]
                        }
@@ -208,6 +499,77 @@ def get_inventory_chart_dict(user_id):
     return jsonify(supply_data_dict)
 
 
+def get_chart_weight(supply_type):
+    """Return how much space one unit of a supply type takes up, for the
+    inventory chart. Types we don't know about get the default weight."""
+
+    return CHART_WEIGHTS.get(supply_type, DEFAULT_CHART_WEIGHT)
+
+
+def get_catalog_facets():
+    """Build every supply-type and brand mapping the forms need from a single
+    pass over the distinct (supply_type, brand, color, units) combinations in
+    the catalog. The result is cached until the catalog changes.
+
+    Returns a dictionary of the following format:
+
+    {"brands_by_type": {"supplytype1": ["brand1", "brand2", ...], ...},
+     "colors_by_type": {"supplytype1": ["color1", "color2", ...], ...},
+     "units_by_type": {"supplytype1": "units", ...},
+     "colors_by_brand": {"brand1": ["color1", "color2", ...], ...}}
+    """
+
+    def build_facets():
+        q = db.session.query(SupplyDetail.supply_type,
+                             SupplyDetail.brand,
+                             SupplyDetail.color,
+                             SupplyDetail.units).distinct()
+
+        q = q.order_by(SupplyDetail.supply_type,
+                       SupplyDetail.brand,
+                       SupplyDetail.color,
+                       SupplyDetail.units)
+
+        brands_by_type = {}
+        colors_by_type = {}
+        units_by_type = {}
+        colors_by_brand = {}
+
+        # Every supply type gets a key, even if none of its supplies have a
+        # brand or color. Nulls never make it into the lists.
+        for supply_type, brand, color, units in q:
+            type_brands = brands_by_type.setdefault(supply_type, set())
+            type_colors = colors_by_type.setdefault(supply_type, set())
+
+            # A supply type is measured in one kind of unit, so the first one
+            # we see is as good as any.
+            units_by_type.setdefault(supply_type, units)
+
+            if brand is not None:
+                type_brands.add(brand)
+                brand_colors = colors_by_brand.setdefault(brand, set())
+
+                if color is not None:
+                    brand_colors.add(color)
+
+            if color is not None:
+                type_colors.add(color)
+
+        # Sort everything, so the JSON we send comes out the same every time.
+        return {"brands_by_type": sort_facet_values(brands_by_type),
+                "colors_by_type": sort_facet_values(colors_by_type),
+                "units_by_type": units_by_type,
+                "colors_by_brand": sort_facet_values(colors_by_brand)}
+
+    return catalog_cache.get_or_compute("facets", build_facets)
+
+
+def sort_facet_values(facet):
+    """Given a dictionary of sets, return a dictionary of sorted lists."""
+
+    return {key: sorted(values) for key, values in facet.iteritems()}
+
+
 def get_all_brands_by_supply_type():
     """Fetch all brands in the database by supply type.
 
@@ -217,22 +579,9 @@ def get_all_brands_by_supply_type():
      "supplytype2": ["brand3", ...], ...}
     """
 
-    # Fetch all supply types from the db. Cast the list returned by the
-    # db query into a set to remove dupes.
-    supply_types = set(db.session.query(SupplyDetail.supply_type).all())
+    brands_by_type = get_catalog_facets()["brands_by_type"]
 
-    # Create a dictionary of empty lists, where each key is a supply in the db.
-    # Uses dictionary comprehension!
-    brands_by_type = {supply_type: [] for (supply_type,) in supply_types}
-
-    # For each supply type, fetch the brands associated with that type. Then, use
-    # a list comprehension to create a list of brands & set the value of the key for
-    # that supply type equal to the list.
-    for key in brands_by_type.iterkeys():
-        brands = set(db.session.query(SupplyDetail.brand).filter(SupplyDetail.supply_type == key).all())
-        brands_by_type[key] = [brand for (brand,) in brands if brand is not None]
-
-    return brands_by_type
+    return {key: list(brands) for key, brands in brands_by_type.iteritems()}
 
 
 def get_all_units_by_supply_type():
@@ -244,73 +593,137 @@ def get_all_units_by_supply_type():
      "supplytype2": "units"}
     """
 
-    # Fetch all supply types from the db. Cast the list returned by the
-    # db query into a set to remove dupes.
-    raw_supply_types = set(db.session.query(SupplyDetail.supply_type).all())
-    supply_types = [raw_type for (raw_type,) in raw_supply_types]
+    return dict(get_catalog_facets()["units_by_type"])
 
-    # Create a dictionary of empty lists, where each key is a supply in the db.
-    # Uses dictionary comprehension!
-    units_by_type = {}
 
-    # For each supply type, fetch the unit of measure associated with that type
-    # and create a key/value pair with the type as the key and the unit as the value.
-    for supply_type in supply_types:
-        unit_q = db.session.query(SupplyDetail.units).filter(SupplyDetail.supply_type == supply_type)
-        unit = unit_q.first()
-        units_by_type[supply_type] = units_by_type.get(supply_type, unit[0])
+def get_all_colors_by_supply_type():
+    """Fetch all colors in the database by supply type.
 
-    return units_by_type
+    Returns a dictionary of the following format:
 
+    {"supplytype1": ["color1", "color2", ...],
+     "supplytype2": ["color3", ...], ...}
+    """
+
+    colors_by_type = get_catalog_facets()["colors_by_type"]
+
+    return {key: list(colors) for key, colors in colors_by_type.iteritems()}
 
-def get_all_colors_by_supply_type():
-    """Fetch all brands in the database by supply type.
+
+def get_all_colors_dict_by_brand():
+    """Fetch all colors in the database by brand.
 
     Returns a dictionary of the following format:
+
+    {"brand1": ["color1", "color2", ...],
+     "brand2": ["color3", ...], ...}
     """
 
-    # Fetch all supply types from the db. Cast the list returned by the
-    # db query into a set to remove dupes.
-    supply_types = set(db.session.query(SupplyDetail.supply_type).all())
+    colors_by_brand = get_catalog_facets()["colors_by_brand"]
 
-    # Create a dictionary of empty lists, where each key is a supply in the db.
-    # Uses dictionary comprehension!
-    colors_by_type = {supply_type: [] for (supply_type,) in supply_types}
+    return {key: list(colors) for key, colors in colors_by_brand.iteritems()}
 
-    # For each supply type, fetch the brands associated with that type. Then, use
-    # a list comprehension to create a list of brands & set the value of the key for
-    # that supply type equal to the list.
-    for key in colors_by_type.iterkeys():
-        colors = set(db.session.query(SupplyDetail.color).filter(SupplyDetail.supply_type == key).all())
-        colors_by_type[key] = [color for (color,) in colors if color is not None]
 
-    return colors_by_type
+def get_catalog_json(facet):
+    """Return one of the catalog facets (e.g. "brands_by_type") serialized to
+    JSON, along with a strong ETag for it, as a tuple: (body, etag).
 
+    Every user gets the same catalog, so the bytes are built once and cached
+    until the catalog changes. The ETag is a hash of the bytes themselves, so
+    every server process agrees on it.
+    """
 
-def get_all_colors_dict_by_brand():
-    """Fetch all colors in the database by brand."""
+    def build_json():
+        return to_json_with_etag(get_catalog_facets()[facet])
+
+    return catalog_cache.get_or_compute(("json", facet), build_json)
+
+
+def get_brand_colors_json(brand):
+    """Return the colors from get_colors_from_brand() serialized to JSON,
+    along with a strong ETag for it, as a tuple: (body, etag). Cached until
+    the catalog changes, like get_catalog_json(), but in brand_colors_cache."""
+
+    def build_json():
+        return to_json_with_etag(get_colors_from_brand(brand))
+
+    return brand_colors_cache.get_or_compute(get_brand_colors_key("json", brand), build_json)
+
+
+def get_inventory_json(user_id):
+    """Return the user's whole inventory, in the columnar form from
+    User.get_inventory_columns(), serialized to JSON, along with a strong ETag
+    for it, as a tuple: (body, etag).
+
+    The JSON is cached until the user's inventory changes.
+    """
+
+    def build_json():
+        user = User.query.get(user_id)
+        return to_json_with_etag(user.get_inventory_columns())
 
-    # Query the database to get all colors associated with the brand, as a
-    # list of tuples
-    brands = get_all_brands()
+    return get_inventory_fragment(user_id, ("columns",), None, build_json)
 
-    # Create a dictionary of empty lists, where each key is a brand in the db.
-    colors_by_brand = {brand: [] for (brand,) in brands}
 
-    # For each brand, fetch the colors associated with that brand. Then, use
-    # a list comprehension to create a list of colors & set the value of the key for
-    # that brand equal to the list.
-    for key in colors_by_brand.iterkeys():
-        colors = set(db.session.query(SupplyDetail.color).filter(SupplyDetail.brand == key).all())
-        colors_by_brand[key] = [color for (color,) in colors if color is not None]
+def to_json_with_etag(data):
+    """Serialize data to compact JSON, with its keys sorted so the same data
+    always comes out the same. Returns a tuple: (body, etag), where the ETag is
+    a hash of the body, so every server process agrees on it."""
 
-    return colors_by_brand
+    body = json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+    return body, hashlib.sha1(body).hexdigest()
+
+
+def get_inventory_fragment(user_id, view, page_token, render):
+    """Return whatever render() makes of a page of a view of the user's
+    inventory, like its HTML. view is a tuple naming the view and its
+    parameters. The result is cached until the user's inventory changes.
+    """
+
+    # Changes this transaction hasn't committed could still be rolled back,
+    # and then their version would be handed out again for different items.
+    if has_unsaved_changes():
+        return render()
+
+    # Note the version before fetching anything, so rows fetched just after a
+    # change are never filed under the version from before it.
+    key = (user_id, get_inventory_version(user_id), view, page_token)
+
+    return inventory_fragments.get_or_compute(key, render)
 
 
 def get_colors_from_brand(brand):
-    colors = set(db.session.query(SupplyDetail.color).filter(SupplyDetail.brand.ilike("%"+brand+"%")).all())
-    colors = [color for (color,) in colors if color is not None]
-    return colors
+    """Get the colors of every supply whose brand contains brand, ignoring case,
+    as a sorted list.
+
+    The colors by brand are already cached with the rest of the catalog, so
+    this doesn't touch the database, and each answer is cached, too, so the
+    same brand coming up again costs next to nothing.
+    """
+
+    key = get_brand_colors_key("list", brand)
+    brand = key[-1]
+
+    def find_colors():
+        colors = set()
+
+        for brand_name, brand_colors in get_catalog_facets()["colors_by_brand"].iteritems():
+            if brand in brand_name.lower():
+                colors.update(brand_colors)
+
+        return sorted(colors)
+
+    return brand_colors_cache.get_or_compute(key, find_colors)
+
+
+def get_brand_colors_key(kind, brand):
+    """Return the brand_colors_cache key for a kind of answer about the colors
+    of brand. Brands are trimmed and lowercased, so "Red Heart" and
+    "red heart " share entries, and the key includes the catalog's version,
+    so answers from before the catalog changed are never used again."""
+
+    return (catalog_cache.version, kind, brand.strip().lower())
 
 
 ###########################################################
@@ -351,32 +764,91 @@ def calc_amt_to_buy(sd_id, qty_specified, user_id=None):
 def get_craft_project_supplies_info(project, user_id):
     """Given a project and a user_id, craft a dictionary containing
     all necessary info to display on a project page, including the amount of
-    required supplies a user owns and how  much they'd need to buy."""
+    required supplies a user owns and how  much they'd need to buy.
 
-    # # Get the project's id.
-    # project_id = project.project_id
+    The project's supplies and the user's inventory are compared in a single
+    query, so the cost of a project page doesn't grow with its supply count."""
 
     # Get a list of dictionaries representing the supplies needed for the
-    # project.
-    project_supplies_info = project.get_project_supplies_list()
+    # project, already netted against what the user owns.
+    project_supplies_info = project.get_project_supplies_list(user_id)
 
-    # For each supply in the list of dictionaries, calculate how many
-    # of that supply the user must buy, and add that amount to the dictionary.
-    for supply in project_supplies_info:
-        amt_to_buy = calc_amt_to_buy(supply["sd_id"],
-                                     supply["qty_specified"], user_id)
+    return project_supplies_info
 
-        item = Item.query.filter(Item.sd_id == supply["sd_id"],
-                                 Item.user_id == user_id).first()
 
-        supply["qty_to_buy"] = amt_to_buy
+###########################################################
+# Generate a shopping list for several projects at once
+###########################################################
 
-        if item is None:
-            supply["qty_owned"] = 0
-        else:
-            supply["qty_owned"] = item.qty
+def get_shopping_list(project_ids, user_id=None):
+    """Given some project ids and a user id, figure out everything the user
+    would need to buy to make all of those projects.
 
-    return project_supplies_info
+    Quantities are summed per supply across the projects and netted against the
+    user's inventory once, all in a single grouped query. Supplies are grouped
+    by where to buy them and by brand, in the following format:
+
+    [{"purchase_url": ???, "brand": ???,
+      "supplies": [{"sd_id": ???, "supply_type": ???, "color": ???, "units": ???,
+                    "qty_needed": ???, "qty_owned": ???, "qty_to_buy": ???}, ...]},
+     ...]
+    """
+
+    # Asking for the same project twice shouldn't double its supplies.
+    project_ids = set(project_ids)
+
+    if not project_ids:
+        return []
+
+    # Total up how much of each supply all of the projects need together.
+    needed = db.session.query(ProjectSupply.sd_id,
+                              db.func.sum(ProjectSupply.supply_qty).label("qty_needed"))
+    needed = needed.filter(ProjectSupply.project_id.in_(project_ids))
+    needed = needed.group_by(ProjectSupply.sd_id).subquery()
+
+    # Total up how much of each supply the user owns.
+    owned = db.session.query(Item.sd_id,
+                             db.func.sum(Item.qty).label("qty_owned"))
+    owned = owned.filter(Item.user_id == user_id).group_by(Item.sd_id).subquery()
+
+    qty_owned = db.func.coalesce(owned.c.qty_owned, 0)
+
+    # Join the totals to the supply details, and only keep the supplies the user
+    # doesn't already have enough of.
+    q = db.session.query(SupplyDetail.purchase_url,
+                         SupplyDetail.brand,
+                         SupplyDetail.sd_id,
+                         SupplyDetail.supply_type,
+                         SupplyDetail.color,
+                         SupplyDetail.units,
+                         needed.c.qty_needed,
+                         qty_owned)
+    q = q.join(needed, needed.c.sd_id == SupplyDetail.sd_id)
+    q = q.outerjoin(owned, owned.c.sd_id == SupplyDetail.sd_id)
+    q = q.filter(needed.c.qty_needed > qty_owned)
+    q = q.order_by(SupplyDetail.purchase_url,
+                   SupplyDetail.brand,
+                   SupplyDetail.supply_type,
+                   SupplyDetail.color)
+
+    # The rows come back ordered by store and brand, so each group is just a run
+    # of consecutive rows.
+    columns = ["sd_id", "supply_type", "color", "units", "qty_needed", "qty_owned"]
+    shopping_list = []
+
+    for (purchase_url, brand), rows in groupby(q.all(), key=lambda row: row[:2]):
+        supplies = []
+
+        for row in rows:
+            supply = dict(zip(columns, row[2:]))
+            supply["qty_to_buy"] = supply["qty_needed"] - supply["qty_owned"]
+            supplies.append(supply)
+
+        shopping_list.append({"purchase_url": purchase_url,
+                              "brand": brand,
+                              "supplies": supplies})
+
+    return shopping_list
 
 
 ############################################################
@@ -384,28 +856,102 @@ def get_craft_project_supplies_info(project, user_id):
 ############################################################
 def get_projects_by_search(search_term):
     """Given a search term, return a list of tuples containing
-    relevant project data."""
+    relevant project data, best matches first."""
 
-    sqlfied_st = "%" + search_term + "%"
+    search_results, _ = search_projects(search_term, per_page=None)
 
-    # Craft query to db for all needed columns.
-    q = db.session.query(Project.title, Project.description, Project.project_id)
+    return search_results
 
-    # Join the projects table with the supply_detalis and project_supply tables,
-    # so we can search both project info and supply info. Join on sd_id so that
-    # we'll only get supplies that are actually in projects.
-    q = q.join(ProjectSupply).join(SupplyDetail,
-                                   ProjectSupply.sd_id == SupplyDetail.sd_id)
 
-    # Filter on our search term.
+def search_projects(search_term, page=1, per_page=PROJECT_SEARCH_PAGE_SIZE):
+    """Given a search term, return one page of (title, description, project_id)
+    tuples for projects whose title, description, or supplies contain the
+    term, best matches first. Also returns whether there are more pages.
+
+    If per_page is None, return every matching project.
+    """
+
+    if per_page is None:
+        offset, limit = 0, None
+
+    else:
+        # Ask for one extra result, so we know whether there's another page.
+        offset, limit = (page - 1) * per_page, per_page + 1
+
+    if db.engine.dialect.name == "postgresql":
+        search_results = search_projects_with_trigram_indexes(search_term, offset, limit)
+
+    else:
+        search_results = get_project_search_index().search(search_term)
+        search_results = search_results[offset:]
+
+        if limit is not None:
+            search_results = search_results[:limit]
+
+    has_more = limit is not None and len(search_results) > per_page
+
+    return search_results[:per_page], has_more
+
+
+def search_projects_with_trigram_indexes(search_term, offset=0, limit=None):
+    """Search projects on PostgreSQL, where the pg_trgm indexes created in
+    model.py let substring matches use an index, and rank them by how similar
+    their titles and descriptions are to the search term."""
+
+    sqlfied_st = "%" + search_term + "%"
+
+    # Rather than joining every project to every one of its supplies and
+    # removing dupes afterward, just ask whether any of a project's supplies
+    # match.
+    matching_supply = db.session.query(ProjectSupply.ps_id).join(SupplyDetail,
+                                                                 ProjectSupply.sd_id == SupplyDetail.sd_id)
+    matching_supply = matching_supply.filter(ProjectSupply.project_id == Project.project_id,
+                                             SupplyDetail.supply_type.ilike(sqlfied_st) |
+                                             SupplyDetail.brand.ilike(sqlfied_st) |
+                                             SupplyDetail.color.ilike(sqlfied_st))
+
+    # Craft query to db for all needed columns, filtered on our search term.
+    q = db.session.query(Project.title, Project.description, Project.project_id)
     q = q.filter(Project.title.ilike(sqlfied_st) |
                  Project.description.ilike(sqlfied_st) |
-                 SupplyDetail.supply_type.ilike(sqlfied_st) |
-                 SupplyDetail.brand.ilike(sqlfied_st) |
-                 SupplyDetail.color.ilike(sqlfied_st))
+                 matching_supply.exists())
 
-    # Get the resulting tuples and clean them up (remove dupes & sort).
-    search_results = q.all()
-    search_results = sorted(set(search_results))
+    # Title matches count the most.
+    rank = (db.func.similarity(Project.title, search_term) * 2 +
+            db.func.similarity(db.func.coalesce(Project.description, ""), search_term))
 
-    return search_results
+    q = q.order_by(rank.desc(), Project.title, Project.project_id)
+    q = q.offset(offset).limit(limit)
+
+    return q.all()
+
+
+def get_project_search_index():
+    """Get the in-memory project search index, building it if we don't have
+    one yet. Building it takes two queries, however many projects there are."""
+
+    def build_index():
+        projects = db.session.query(Project.project_id,
+                                    Project.title,
+                                    Project.description).all()
+
+        q = db.session.query(ProjectSupply.project_id,
+                             SupplyDetail.supply_type,
+                             SupplyDetail.brand,
+                             SupplyDetail.color).join(SupplyDetail,
+                                                      ProjectSupply.sd_id == SupplyDetail.sd_id)
+
+        supply_fields = {}
+
+        for project_id, supply_type, brand, color in q:
+            supply_fields.setdefault(project_id, []).extend([supply_type, brand, color])
+
+        index = ProjectSearchIndex()
+
+        for project_id, title, description in projects:
+            index.add_project(project_id, title, description,
+                              supply_fields.get(project_id, []))
+
+        return index
+
+    return project_search_indexes.get_or_compute("projects", build_index)
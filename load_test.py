@@ -0,0 +1,384 @@
+"""Concurrent load testing for Crafter's Closet.
+
+Replays whole user journeys, from many threads in several processes at once,
+against a locally served copy of the app: register and log in, load the
+dashboard, type a search term one letter at a time into the autocomplete, flip
+inventory filters, add and update a supply, create a project, and search for
+projects. Then reports throughput, latency percentiles, and error rates for
+each step, and how the database pool held up:
+
+    python load_test.py --processes 4 --threads 25 --duration 60
+
+Each journey registers a brand new user, so --uri should be a scratch
+database with a catalog in it. By default, it's the one benchmark.py loads. With --url,
+runs against a server that's already up instead, like one behind gunicorn.
+"""
+
+import argparse
+import cookielib
+import json
+import multiprocessing
+import random
+import threading
+import time
+import urllib
+import urllib2
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from benchmark import percentile, PERCENTILES, BENCHMARK_URI, JQUERY_JSON_ACCEPT
+from engine_profiles import get_pool_stats
+from model import connect_to_db, db, SupplyDetail
+from server import app
+
+# Seconds to wait between steps, on average, like a person reading the page,
+# and between keystrokes while typing.
+THINK_TIME = 0.5
+KEYSTROKE_TIME = 0.08
+
+REQUEST_TIMEOUT = 30
+
+# Seconds to wait after a journey fails, doubling with each failure in a row
+# up to the most. A server that's down would otherwise get hammered, and
+# fill the stats with instant errors.
+FAILURE_BACKOFF = 0.5
+MAX_FAILURE_BACKOFF = 10
+
+# Journeys pick their supplies from this many of the catalog's first ones.
+CATALOG_SAMPLE = 200
+
+SEARCH_WORDS = ["red", "blue", "white", "yarn", "paint", "clay", "felt", "green"]
+
+
+class NoRedirects(urllib2.HTTPRedirectHandler):
+    """Hand redirects back as they are, so each step times one request."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Serve requests without logging each one. There are a lot of them."""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class StepStats(object):
+    """Latencies, in milliseconds, and errors for each step, collected from
+    many threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, step, latency, error=None):
+        with self._lock:
+            self.latencies.setdefault(step, []).append(latency)
+
+            if error is not None:
+                self.errors.setdefault(step, []).append(error)
+
+    def as_dict(self):
+        with self._lock:
+            return {"latencies": self.latencies, "errors": self.errors}
+
+    def merge(self, other):
+        """Add the stats from another StepStats' as_dict()."""
+
+        with self._lock:
+            for step, latencies in other["latencies"].items():
+                self.latencies.setdefault(step, []).extend(latencies)
+
+            for step, errors in other["errors"].items():
+                self.errors.setdefault(step, []).extend(errors)
+
+
+class JourneyFailed(Exception):
+    """A step went wrong, so the rest of the journey can't go on."""
+
+
+class VirtualUser(object):
+    """One person using the site, with their own cookies."""
+
+    def __init__(self, base_url, name, catalog, stats, rng, think_time=THINK_TIME):
+        self.base_url = base_url
+        self.name = name
+        self.catalog = catalog
+        self.stats = stats
+        self.rng = rng
+        self.think_time = think_time
+        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookielib.CookieJar()),
+                                           NoRedirects())
+
+    def request(self, step, path, data=None, headers=None, expect=None):
+        """Make one request, recording how long it took under step, and return
+        (status, body, headers). Anything over 400, anything that doesn't
+        redirect to expect, if given, and anything that doesn't come back at
+        all, counts as an error."""
+
+        if data is not None:
+            data = urllib.urlencode(data)
+
+        req = urllib2.Request(self.base_url + path, data, headers or {})
+        start = time.time()
+
+        try:
+            response = self.opener.open(req, timeout=REQUEST_TIMEOUT)
+            status, body, response_headers = response.getcode(), response.read(), response.info()
+
+        except urllib2.HTTPError as e:
+            status, body, response_headers = e.code, e.read(), e.info()
+
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, e)
+            self.stats.record(step, (time.time() - start) * 1000, error)
+            raise JourneyFailed(error)
+
+        latency = (time.time() - start) * 1000
+        error = None
+
+        if status >= 400:
+            error = "HTTP %d" % status
+
+        elif expect is not None and expect not in response_headers.get("Location", ""):
+            error = "HTTP %d to %s" % (status, response_headers.get("Location"))
+
+        self.stats.record(step, latency, error)
+
+        if error is not None:
+            raise JourneyFailed(error)
+
+        return status, body, response_headers
+
+    def think(self, average=None):
+        time.sleep(self.rng.uniform(0, 2 * (self.think_time if average is None else average)))
+
+    def run_journey(self):
+        """Go through the whole journey, once."""
+
+        password = "load-test"
+        self.request("register", "/register",
+                     {"email": "%s@example.com" % self.name, "username": self.name,
+                      "password": password, "repeat-pw": password},
+                     expect="/login")
+
+        self.request("login", "/login", {"username": self.name, "password": password},
+                     expect="/dashboard")
+        self.request("dashboard", "/dashboard")
+        self.think()
+
+        # Start an inventory with a few supplies.
+        owned = self.rng.sample(self.catalog, 3)
+
+        for supply_type, brand, color, units in owned:
+            self.request("add supply", "/add-supply",
+                         {"supplytype": supply_type, "brand": brand, "color": color,
+                          "units": units, "quantity-owned": str(self.rng.randint(1, 20))},
+                         expect="/dashboard")
+            self.think()
+
+        # The dashboard fetches the whole inventory for filtering and search.
+        status, body, headers = self.request("inventory data", "/inventory/data")
+        item_ids = json.loads(body)["rows"]["item_id"]
+
+        # Type a search term, a letter at a time.
+        word = self.rng.choice(SEARCH_WORDS)
+
+        for end in range(1, len(word) + 1):
+            self.request("autocomplete", "/inventory/search-autocomplete-tags?" +
+                         urllib.urlencode({"search": word[:end]}))
+            self.think(KEYSTROKE_TIME)
+
+        self.request("inventory search", "/inventory/search-results?" +
+                     urllib.urlencode({"search": word}))
+        self.think()
+
+        # Flip through some filters, then clear them.
+        supply_type, brand, color, units = owned[0]
+
+        for filters in ({"brand": brand, "supplytype": "", "color": ""},
+                        {"brand": brand, "supplytype": supply_type, "color": ""},
+                        {"brand": "", "supplytype": "", "color": ""}):
+            self.request("filter", "/inventory/filter?" + urllib.urlencode(filters))
+            self.think(self.think_time / 2)
+
+        self.request("update item", "/update-item",
+                     {"itemID": str(self.rng.choice(item_ids)), "qty": str(self.rng.randint(1, 20))},
+                     headers={"Accept": JQUERY_JSON_ACCEPT})
+        self.think()
+
+        project = {"title": "%s's Project" % self.name, "description": "Made under load.",
+                   "instr-url": "", "img-url": "", "num-supplies": str(len(owned))}
+
+        for i, (supply_type, brand, color, units) in enumerate(owned):
+            project.update({"supplytype%d" % i: supply_type, "brand%d" % i: brand,
+                            "color%d" % i: color, "qty-required%d" % i: str(self.rng.randint(1, 5))})
+
+        self.request("create project", "/create-project", project, expect="/project/")
+        self.think()
+
+        self.request("project search", "/projects/search-results?" +
+                     urllib.urlencode({"search": self.rng.choice(SEARCH_WORDS)}))
+
+
+def run_users(base_url, catalog, threads, duration, worker, seed, think_time, run_id, results):
+    """Run threads virtual users at once, each starting journey after journey
+    until duration seconds are up, and put their stats on the results
+    queue. Usernames include run_id, so runs don't clash."""
+
+    stats = StepStats()
+    stop_at = time.time() + duration
+
+    def run_thread(thread):
+        rng = random.Random("%s-%s-%s" % (seed, worker, thread))
+        journey = 0
+        failures = 0
+
+        while time.time() < stop_at:
+            journey += 1
+            name = "load%d_%d_%d_%d" % (run_id, worker, thread, journey)
+            user = VirtualUser(base_url, name, catalog, stats, rng, think_time)
+            start = time.time()
+            error = None
+            failed = True
+
+            try:
+                user.run_journey()
+                failed = False
+
+            # The step's been recorded as an error already.
+            except JourneyFailed:
+                pass
+
+            # Anything else means the journey itself is broken, like a
+            # response it can't make sense of. That's an error too.
+            except Exception as e:
+                error = "%s: %s" % (type(e).__name__, e)
+
+            stats.record("journey", (time.time() - start) * 1000, error)
+
+            if not failed:
+                failures = 0
+                continue
+
+            # Back off before starting over as someone new, but not past the
+            # end of the run.
+            failures += 1
+            backoff = min(FAILURE_BACKOFF * 2 ** (failures - 1), MAX_FAILURE_BACKOFF)
+            time.sleep(max(min(backoff, stop_at - time.time()), 0))
+
+    workers = [threading.Thread(target=run_thread, args=(thread,)) for thread in range(threads)]
+
+    for thread in workers:
+        thread.start()
+
+    for thread in workers:
+        thread.join()
+
+    results.put(stats.as_dict())
+
+
+def get_catalog_sample(size=CATALOG_SAMPLE):
+    """Return (supply_type, brand, color, units) for some of the catalog's
+    supplies, for journeys to add to inventories and use in projects."""
+
+    supplies = SupplyDetail.query.order_by(SupplyDetail.sd_id).limit(size).all()
+
+    return [(sd.supply_type, sd.brand, sd.color, sd.units) for sd in supplies]
+
+
+def print_report(stats, elapsed):
+    """Print throughput, latency percentiles, and error rates for each step."""
+
+    print "\n%-18s %8s %8s %7s %9s %9s %9s" % ("step", "requests", "req/s", "errors",
+                                              "p50 ms", "p95 ms", "p99 ms")
+
+    for step, latencies in sorted(stats.latencies.items()):
+        errors = len(stats.errors.get(step, []))
+
+        print "%-18s %8d %8.1f %6.1f%% %9.1f %9.1f %9.1f" % (
+            step, len(latencies), len(latencies) / elapsed, 100.0 * errors / len(latencies),
+            percentile(latencies, PERCENTILES[0]), percentile(latencies, PERCENTILES[1]),
+            percentile(latencies, PERCENTILES[2]))
+
+    # Whole journeys are in there too, but they aren't requests.
+    total = sum(len(latencies) for step, latencies in stats.latencies.items()
+                if step != "journey")
+    print "\n%d requests in %.1fs (%.1f req/s)" % (total, elapsed, total / elapsed)
+
+    for step, errors in sorted(stats.errors.items()):
+        print "%s errors, for example: %s" % (step, ", ".join(sorted(set(errors))[:3]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay concurrent user journeys "
+                                                 "against Crafter's Closet.")
+    parser.add_argument("--uri", default=BENCHMARK_URI,
+                        help="database to serve from, and to find supplies in")
+    parser.add_argument("--url", help="test a server that's already running here instead")
+    parser.add_argument("--processes", type=int, default=2,
+                        help="processes making requests")
+    parser.add_argument("--threads", type=int, default=10,
+                        help="virtual users at once in each process")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run for")
+    parser.add_argument("--think", type=float, default=THINK_TIME,
+                        help="average seconds between steps")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    connect_to_db(app, args.uri)
+
+    catalog = get_catalog_sample()
+
+    if not catalog:
+        parser.error("There are no supplies in %s to use. Seed it first." % args.uri)
+
+    server = None
+    base_url = args.url
+
+    if base_url is None:
+        server = make_server("127.0.0.1", 0, app, threaded=True,
+                             request_handler=QuietRequestHandler)
+        base_url = "http://127.0.0.1:%d" % server.server_port
+
+    # The request processes get copies of our database connections when they
+    # fork. Close ours first, so they can't shut them down under us.
+    db.session.remove()
+    db.engine.dispose()
+
+    run_id = int(time.time())
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=run_users,
+                                       args=(base_url, catalog, args.threads, args.duration,
+                                             worker, args.seed, args.think, run_id, results))
+               for worker in range(args.processes)]
+
+    for worker in workers:
+        worker.start()
+
+    if server is not None:
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    print "Replaying journeys against %s from %d processes of %d threads for %ds..." % (
+        base_url, args.processes, args.threads, args.duration)
+
+    start = time.time()
+    stats = StepStats()
+
+    # Collect the results before joining, so big ones can't block the queue.
+    for worker in workers:
+        stats.merge(results.get())
+
+    for worker in workers:
+        worker.join()
+
+    print_report(stats, time.time() - start)
+
+    if server is not None:
+        server.shutdown()
+
+        print "\nDatabase pool: %s" % json.dumps(get_pool_stats(db.engine), sort_keys=True)
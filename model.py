@@ -1,7 +1,39 @@
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, select, DDL
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+from contextlib import contextmanager
+from functools import partial
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import json
+
+from cache import catalog_cache, inventory_fragments
+from engine_profiles import get_engine_options
+from search_index import (TagIndex, inventory_tag_indexes, remove_inventory_tags,
+                          get_supply_tags, project_search_indexes)
+
+class CraftersClosetSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, plus whatever create_engine() options are in
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"]. On its own, it only knows how to
+    set the size, overflow, timeout, and recycle time of the pool."""
+
+    def apply_driver_hacks(self, app, info, options):
+        options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+
+        super(CraftersClosetSQLAlchemy, self).apply_driver_hacks(app, info, options)
+
 
 # Create an object representing the idea of the Crafter's Closet database.
-db = SQLAlchemy()
+db = CraftersClosetSQLAlchemy()
+
+
+# How many inventory rows to send at once.
+INVENTORY_PAGE_SIZE = 100
+
+# How many versions of a user's inventory to remember deleted items for.
+# Anyone further behind than that gets told to fetch the whole inventory again,
+# so the item_deletions table doesn't grow forever.
+ITEM_DELETION_RETENTION = 1000
 
 
 ##############################################################
@@ -28,125 +60,193 @@ class User(db.Model):
     username = db.Column(db.String(64), nullable=False, unique=True)
     password = db.Column(db.String(64), nullable=True)
 
-    def get_inventory(self):
-        """Get the current user's inventory details as a list of tuples of the
-        format: (type, brand, color, units, url, qty)"""
-        inventory = db.session.query(SupplyDetail.supply_type,
-                                     SupplyDetail.brand,
-                                     SupplyDetail.color,
-                                     SupplyDetail.units,
-                                     SupplyDetail.purchase_url,
-                                     Item.qty,
-                                     Item.item_id).outerjoin(Item).filter_by(user_id=self.user_id).all()
+    # Goes up by one with every transaction that changes the user's items, so
+    # clients can tell whether what they have is stale.
+    inventory_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
-        inventory = sorted(inventory)
-        return inventory
+    def query_inventory(self, brand="", supply_type="", color="", search_term=None):
+        """Build a query for the user's inventory rows, as tuples of the format:
+        (type, brand, color, units, url, qty, item_id), ordered in the database
+        by get_inventory_sort_key().
 
-    def get_projects(self):
-        """Get all of the user's projects as objects."""
-        return Project.query.filter(Project.user_id == self.user_id).all()
-
-    def get_filtered_inventory(self, brand="", supply_type="", color=""):
-        """Given a user and filter parameters, fetches inventory table HTML to only
-        display supplies matching those parameters. Returns list of tuples."""
+        Any non-empty brand, supply type, or color narrows the rows to those
+        exact values, and a search term narrows them to supplies with that
+        string in their type, brand, or color. The query can be narrowed further
+        before fetching it, paged with paginate_inventory(), or streamed with
+        iter_inventory().
+        """
 
-        # Craft a query to the db for all needed columns.
+        # Start from the user's items, so the database can find them with the
+        # (user_id, sd_id) index, and join each one to its supply details.
         q = db.session.query(SupplyDetail.supply_type,
                              SupplyDetail.brand,
                              SupplyDetail.color,
                              SupplyDetail.units,
                              SupplyDetail.purchase_url,
                              Item.qty,
-                             Item.item_id).outerjoin(Item).filter(Item.user_id == self.user_id)
+                             Item.item_id).select_from(Item).join(SupplyDetail,
+                                                                  Item.sd_id == SupplyDetail.sd_id)
 
-        # If the brand actually came with a filter selected, fetch the inventory
-        # filtered by brand.
-        if brand != "":
+        q = q.filter(Item.user_id == self.user_id)
 
+        # Only filter on the parameters that actually came with a value.
+        if brand:
             q = q.filter(SupplyDetail.brand == brand)
 
-        # If we aren't filtering by brand, then check the supply type argument
-        # to see if it's not empty.
-        if supply_type != "":
-
-            # Craft a query to the db for all needed columns.
+        if supply_type:
             q = q.filter(SupplyDetail.supply_type == supply_type)
 
-        # If we aren't filtering by brand or type, then check the color argument
-        # to see if it's not empty.
-        if color != "":
-
+        if color:
             q = q.filter(SupplyDetail.color == color)
 
-        # Fetch the inventory, filtered by the passed parameters. (If the user
-        # didn't enter any, then we'll get the whole inventory.)
-        inventory = sorted(q.all())
+        # Wrap the user's search term in SQL wildcards and use it as a filter
+        # on the existing query.
+        if search_term is not None:
+            sql_like_str = "%" + search_term + "%"
+            q = q.filter(SupplyDetail.supply_type.ilike(sql_like_str) |
+                         SupplyDetail.brand.ilike(sql_like_str) |
+                         SupplyDetail.color.ilike(sql_like_str))
 
-        return inventory
+        # Let the database do the sorting.
+        return q.order_by(*get_inventory_sort_key())
 
-    def get_inventory_by_search(self, search_term):
-        """Given a user id and search parameter, get a list of tuples representing
-        all items owned by that user with the relevant strings."""
+    def iter_inventory(self, batch_size=1000, **filters):
+        """Iterate over the user's inventory rows in order, fetching them from
+        the database batch_size rows at a time instead of all at once. Takes
+        the same filters as query_inventory()."""
 
-        # Craft a query to the db for all needed columns.
-        q = db.session.query(SupplyDetail.supply_type,
-                             SupplyDetail.brand,
-                             SupplyDetail.color,
-                             SupplyDetail.units,
-                             SupplyDetail.purchase_url,
-                             Item.qty,
-                             Item.item_id).outerjoin(Item).filter(Item.user_id == self.user_id)
+        return self.query_inventory(**filters).yield_per(batch_size)
 
-        # Wrap the user's search term in SQL wildcards and use it as a filter
-        # on the existing query.
-        sql_like_str = "%" + search_term + "%"
-        q = q.filter(SupplyDetail.supply_type.ilike(sql_like_str) |
-                     SupplyDetail.brand.ilike(sql_like_str) |
-                     SupplyDetail.color.ilike(sql_like_str))
+    def get_inventory_columns(self):
+        """Get the user's whole inventory in a compact, column-by-column form,
+        for the dashboard to filter and search on its own.
 
-        # Fetch the inventory, filtered by the search parameter.
-        inventory = sorted(q.all())
+        Each distinct supply type, brand, color, and unit appears once, in a
+        list of its own, and the rows refer to them by their index:
 
-        return inventory
+        {"supply_types": ["Acrylic Paint", ...], "brands": [...],
+         "colors": [...], "units": [...],
+         "rows": {"supply_type": [0, 0, ...], "brand": [...], "color": [...],
+                  "units": [...], "qty": [10, 3, ...], "item_id": [1, 4, ...]}}
 
-    def get_inventory_search_ac_tags(self, search_term):
-        """Given a user ID and the user's search term, return a list of possible
-        existing inventory information the user might be trying to type."""
+        The rows come in the same order as query_inventory()'s. The version
+        of the inventory they came from goes in "version".
+        """
 
-        # Craft a query to the db for all needed columns.
-        q = db.session.query(SupplyDetail.supply_type,
-                             SupplyDetail.brand,
-                             SupplyDetail.color,
-                             SupplyDetail.units,
-                             SupplyDetail.purchase_url,
-                             Item.qty,
-                             Item.item_id).outerjoin(Item).filter(Item.user_id == self.user_id)
+        # Note the version before fetching anything, so nothing that changes
+        # while we're fetching gets missed by asking what changed since it.
+        columns = {"version": get_inventory_version(self.user_id),
+                   "supply_types": [], "brands": [], "colors": [], "units": [],
+                   "rows": {"supply_type": [], "brand": [], "color": [],
+                            "units": [], "qty": [], "item_id": []}}
+
+        # Index of each value in its list, for each of the encoded columns.
+        indexes = {"supply_types": {}, "brands": {}, "colors": {}, "units": {}}
+
+        def encode(values, value):
+            index = indexes[values].get(value)
+
+            if index is None:
+                index = indexes[values][value] = len(columns[values])
+                columns[values].append(value)
 
-        inventory = sorted(q.all())
+            return index
 
-        # We only want to show a given tag once, so create an empty set to contain
-        # the tags.
-        tags = set()
+        rows = columns["rows"]
 
-        # For each item in the user's inventory, check whether the search term
-        # is used anywhere in that item's supply details. If so, add it to our set
-        # of tags.
-        for item in inventory:
+        for supply_type, brand, color, units, _, qty, item_id in self.iter_inventory():
+            rows["supply_type"].append(encode("supply_types", supply_type))
+            rows["brand"].append(encode("brands", brand))
+            rows["color"].append(encode("colors", color))
+            rows["units"].append(encode("units", units))
+            rows["qty"].append(qty)
+            rows["item_id"].append(item_id)
 
-            if search_term.lower() in item.supply_type.lower():
-                tags.add(item.supply_type)
+        return columns
 
-            if search_term.lower() in item.brand.lower():
-                tags.add(item.brand)
+    def get_inventory_changes(self, since):
+        """Get everything that changed in the user's inventory after version
+        since, as a dictionary of the following format:
 
-            if search_term.lower() in item.color.lower():
-                tags.add(item.color)
+        {"version": 12,
+         "items": [{"item_id": 4, "supply_type": ..., "brand": ..., "color": ...,
+                    "units": ..., "qty": 3}, ...],
+         "deleted": [7, 9, ...]}
 
-        # Convert the set of tags to a list for easy jsonification, and sort it
-        # for the user's sanity.
-        tags = sorted(list(tags))
+        where items are the rows that were added or changed, in the same order
+        as query_inventory()'s, deleted holds the ids of the items that are
+        gone, and version is the version this brings the caller up to.
 
-        return tags
+        Deleted items are only remembered for ITEM_DELETION_RETENTION versions.
+        If since is older than that, all that comes back is
+        {"version": 12, "reload": True}, and the caller should fetch the whole
+        inventory again.
+        """
+
+        # Note the version first, like get_inventory_columns() does.
+        version = get_inventory_version(self.user_id)
+
+        if since < version - ITEM_DELETION_RETENTION:
+            return {"version": version, "reload": True}
+
+        items = [{"item_id": item_id, "supply_type": supply_type, "brand": brand,
+                  "color": color, "units": units, "qty": qty}
+                 for supply_type, brand, color, units, _, qty, item_id
+                 in self.query_inventory().filter(Item.version > since)]
+
+        q = db.session.query(ItemDeletion.item_id)
+        q = q.filter(ItemDeletion.user_id == self.user_id, ItemDeletion.version > since)
+        q = q.order_by(ItemDeletion.item_id)
+
+        return {"version": version,
+                "items": items,
+                "deleted": [item_id for item_id, in q]}
+
+    def get_inventory(self, page_token=None, page_size=INVENTORY_PAGE_SIZE):
+        """Get a page of the current user's inventory details as a list of tuples
+        of the format: (type, brand, color, units, url, qty, item_id), along with
+        the token for the next page. See paginate_inventory()."""
+
+        return paginate_inventory(self.query_inventory(), page_token, page_size)
+
+    def get_projects(self):
+        """Get all of the user's projects as objects."""
+        return Project.query.filter(Project.user_id == self.user_id).all()
+
+    def get_filtered_inventory(self, brand="", supply_type="", color="",
+                               page_token=None, page_size=INVENTORY_PAGE_SIZE):
+        """Given a user and filter parameters, fetches inventory table HTML to only
+        display supplies matching those parameters. Returns a page of the list of
+        tuples and the token for the next page."""
+
+        # If the user didn't pick any filters, we'll get the whole inventory.
+        q = self.query_inventory(brand=brand, supply_type=supply_type, color=color)
+
+        return paginate_inventory(q, page_token, page_size)
+
+    def get_inventory_by_search(self, search_term, page_token=None,
+                                page_size=INVENTORY_PAGE_SIZE):
+        """Given a user id and search parameter, get a list of tuples representing
+        all items owned by that user with the relevant strings. Returns a page of
+        that list and the token for the next page."""
+
+        q = self.query_inventory(search_term=search_term)
+
+        return paginate_inventory(q, page_token, page_size)
+
+    def get_inventory_search_ac_tags(self, search_term):
+        """Given a user ID and the user's search term, return a list of possible
+        existing inventory information the user might be trying to type."""
+
+        # Tags with a word starting with the search term come first, then any
+        # others containing it, capped so power users don't get thousands.
+        return self.get_inventory_tag_index().search(search_term)
+
+    def get_inventory_tag_index(self):
+        """Get the autocomplete index over the supply types, brands, and colors
+        in the user's inventory, building it if we don't have one yet."""
+
+        return get_inventory_tag_index(self.user_id)
 
     def __repr__(self):
         """Provide a human-readable representation of an instance of the
@@ -227,33 +327,50 @@ class Project(db.Model):
         return "<Project title=%s, instr_url=%s, description=%s>" % \
             (self.title, self.instr_url, self.description)
 
-    def get_project_supplies_list(self):
+    def get_project_supplies_list(self, user_id=None):
         """Get details about the supplies required to make this project instance
-        project.
+        project, including how much of each supply the passed user owns and how
+        much they would need to buy. Everything comes back from one joined query,
+        no matter how many supplies the project has.
 
         Format of data: {'color': ???, 'brand': ???, 'qty_to_buy': ???, 'sd_id': ???
-                         'units': ???, 'qty_specified': ???, 'supply_type': ???}
+                         'units': ???, 'qty_specified': ???, 'supply_type': ???,
+                         'qty_owned': ???}
 
         Example:
         [{'color': u'Petal Pink', 'brand': u'Red Heart', 'qty_to_buy': 0, 'sd_id': 1,
-          'units': u'yds', 'qty_specified': 4, 'supply_type': u'yarn'},
+          'units': u'yds', 'qty_specified': 4, 'supply_type': u'yarn', 'qty_owned': 4},
           {'color': u'blue', 'brand': u'SparkFun', 'qty_to_buy': 0, 'sd_id': 24,
-          'units': u'components', 'qty_specified': 6, 'supply_type': u'LED'}]
+          'units': u'components', 'qty_specified': 6, 'supply_type': u'LED',
+          'qty_owned': 10}]
+
+        If no user is passed, we assume they own nothing and must buy everything.
         """
 
+        # Sum the user's items per supply detail, so a supply the user happens to
+        # own in more than one row still only shows up once per project supply.
+        qty_owned = db.func.coalesce(db.func.sum(Item.qty), 0)
+
         # Craft a query to join the tables defined by the SupplyDetail and
-        # ProjectSupply models, so we can get information from both.
+        # ProjectSupply models, so we can get information from both. Outer join
+        # the user's items, so supplies they don't own still show up.
         q = db.session.query(SupplyDetail.sd_id,
                              SupplyDetail.supply_type,
                              SupplyDetail.brand,
                              SupplyDetail.color,
                              ProjectSupply.supply_qty,
-                             SupplyDetail.units).join(ProjectSupply,
-                                                      SupplyDetail.sd_id == ProjectSupply.sd_id)
+                             SupplyDetail.units,
+                             qty_owned).join(ProjectSupply,
+                                             SupplyDetail.sd_id == ProjectSupply.sd_id)
+
+        q = q.outerjoin(Item, db.and_(Item.sd_id == SupplyDetail.sd_id,
+                                      Item.user_id == user_id))
 
         # Add a filter to the query so that we'll only get details for supplies related
         # to the passed project
         q_filtered = q.filter(ProjectSupply.project_id == self.project_id)
+        q_filtered = q_filtered.group_by(ProjectSupply.ps_id,
+                                         SupplyDetail.sd_id).order_by(ProjectSupply.ps_id)
 
         # Fetch the specified details
         specified_supplies = q_filtered.all()
@@ -261,12 +378,16 @@ class Project(db.Model):
         # Create an empty list and a list containing the columns for each piece
         # of info for a supply
         supplies_list = []
-        columns = ["sd_id", "supply_type", "brand", "color", "qty_specified", "units"]
+        columns = ["sd_id", "supply_type", "brand", "color", "qty_specified", "units",
+                   "qty_owned"]
 
         # For each set of supply information, create a dictionary using the columns
-        # above as keys and the information itself as values.
+        # above as keys and the information itself as values. The user never has
+        # to buy a negative amount of anything.
         for supply in specified_supplies:
             supply_dict = dict(zip(columns, supply))
+            supply_dict["qty_to_buy"] = max(supply_dict["qty_specified"] -
+                                            supply_dict["qty_owned"], 0)
             supplies_list.append(supply_dict)
 
         # Return a list of dictionaries
@@ -341,6 +462,15 @@ class Item(db.Model):
     # Quantity column, to store how much of a supply a user owns.
     qty = db.Column(db.Integer, nullable=False)
 
+    # The owner's inventory version when this item last changed.
+    version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    # Every inventory query looks up a user's items and joins them to their
+    # supply details, so index both together. Asking what changed since some
+    # version looks items up by their version.
+    __table_args__ = (db.Index("ix_items_user_id_sd_id", "user_id", "sd_id"),
+                      db.Index("ix_items_user_id_version", "user_id", "version"))
+
     # Define relationship between users, supply details, and the items a user
     # owns.  A supply detail describes the nature of the item owned, and the items
     # table says how many supplies of that nature are owned.
@@ -363,20 +493,27 @@ class Item(db.Model):
         # the record; otherwise, change the old item qty to reflect the new one.
         elif overwrite:
             if qty == "0":
+                # Work out the tags to drop now, since we can't load the
+                # supply details from a deleted item.
+                remove_tags = partial(remove_inventory_tags,
+                                      self.user_id,
+                                      get_supply_tags(self.supply_details))
+
                 db.session.delete(self)
-                db.session.commit()
+                db.session.flush()
+                on_commit(remove_tags)
                 success_string = "Deleted!"
 
             else:
                 self.qty = qty
-                db.session.commit()
+                db.session.flush()
                 success_string = str(self.qty) + " " + str(self.supply_details.units)
 
         # If we're changing but not overwriting, then we must be trying to add
         # a supply that exists. Just increase the qty in the db.
         else:
             self.qty = self.qty + qty
-            db.session.commit()
+            db.session.flush()
             success_string = "Amount of " + self.supply_details.brand + " " + \
                              self.supply_details.color + " " + \
                              self.supply_details.supply_type + " updated."
@@ -388,6 +525,180 @@ class Item(db.Model):
             (self.user_id, self.sd_id, self.qty)
 
 
+class ItemDeletion(db.Model):
+    """A model that remembers an item a user deleted, and at which version of
+    their inventory, so clients can find out what disappeared."""
+
+    # Set the table name for this model.
+    __tablename__ = "item_deletions"
+
+    # Create the columns in the item_deletions table. The item itself is gone,
+    # so its id isn't a foreign key.
+    deletion_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    item_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey("users.user_id"),
+                        nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (db.Index("ix_item_deletions_user_id_version", "user_id", "version"),)
+
+    def __repr__(self):
+        return "<ItemDeletion item_id=%s, user_id=%s, version=%s>" % \
+            (self.item_id, self.user_id, self.version)
+
+
+##########################################################
+# Inventory autocomplete
+##########################################################
+
+def get_inventory_tag_index(user_id):
+    """Get the autocomplete index over the supply types, brands, and colors in
+    the user's inventory, building it if we don't have one yet. Building it
+    only needs the user's id, so we don't load the user to search it."""
+
+    def build_index():
+        # We only need the three columns that can be tags.
+        q = db.session.query(SupplyDetail.supply_type,
+                             SupplyDetail.brand,
+                             SupplyDetail.color).join(Item).filter(Item.user_id == user_id)
+
+        index = TagIndex()
+
+        # Each item adds its own reference to its tags, so deleting one
+        # item doesn't drop a tag another item still uses.
+        for supply in q:
+            for tag in get_supply_tags(supply):
+                index.add(tag)
+
+        return index
+
+    return inventory_tag_indexes.get_or_compute(user_id, build_index)
+
+
+##########################################################
+# Exact supply detail lookups
+##########################################################
+
+def get_supply_key_columns():
+    """Return SQL expressions for the key a supply detail is matched on: its
+    type, brand, and color, trimmed and lowercased, with nulls as ''."""
+
+    return [db.func.lower(db.func.trim(SupplyDetail.supply_type)),
+            db.func.lower(db.func.trim(db.func.coalesce(SupplyDetail.brand, ""))),
+            db.func.lower(db.func.trim(db.func.coalesce(SupplyDetail.color, "")))]
+
+
+def normalize_supply_key(supply_type, brand, color):
+    """Return the key for a supply detail with the passed type, brand, and
+    color, matching the one get_supply_key_columns() computes in SQL."""
+
+    return tuple((field or "").strip().lower() for field in (supply_type, brand, color))
+
+
+# No two supply details can share a key, and looking one up by its key can use
+# this index instead of scanning the table.
+db.Index("uq_supply_details_key", *get_supply_key_columns(), unique=True)
+
+
+##########################################################
+# Inventory pagination
+##########################################################
+
+def get_inventory_sort_key():
+    """Return the columns inventory rows are ordered and paged by. Brands and
+    colors can be null, which would break keyset comparisons, so nulls sort as
+    empty strings. The item id breaks ties."""
+
+    return [SupplyDetail.supply_type,
+            db.func.coalesce(SupplyDetail.brand, ""),
+            db.func.coalesce(SupplyDetail.color, ""),
+            Item.item_id]
+
+
+def paginate_inventory(q, page_token=None, page_size=INVENTORY_PAGE_SIZE):
+    """Given a query for inventory rows already ordered by
+    get_inventory_sort_key(), like the ones User.query_inventory() builds,
+    return one page of its rows and a token for the next page.
+
+    Pages are found by seeking past the last row of the previous page, which
+    its token encodes, rather than with an offset, so later pages cost no
+    more than the first. The next token is None on the last page. If page_size
+    is None, every row comes back on one page.
+    """
+
+    if page_token:
+        last_key = decode_page_token(page_token)
+        q = q.filter(db.tuple_(*get_inventory_sort_key()) > db.tuple_(*last_key))
+
+    if page_size is None:
+        return q.all(), None
+
+    # Fetch one extra row, so we know whether there's another page.
+    rows = q.limit(page_size + 1).all()
+
+    if len(rows) <= page_size:
+        return rows, None
+
+    rows = rows[:page_size]
+    last_row = rows[-1]
+
+    next_page_token = encode_page_token([last_row.supply_type,
+                                         last_row.brand or "",
+                                         last_row.color or "",
+                                         last_row.item_id])
+
+    return rows, next_page_token
+
+
+def encode_page_token(last_key):
+    """Turn the sort key of the last row on a page into an opaque token."""
+
+    return urlsafe_b64encode(json.dumps(last_key))
+
+
+def decode_page_token(page_token):
+    """Turn a page token back into a sort key. Raises ValueError if the token
+    is garbage."""
+
+    try:
+        last_key = json.loads(urlsafe_b64decode(str(page_token)))
+
+    except (TypeError, ValueError):
+        raise ValueError("Invalid page token: %s" % page_token)
+
+    if not isinstance(last_key, list) or len(last_key) != 4:
+        raise ValueError("Invalid page token: %s" % page_token)
+
+    return last_key
+
+
+##########################################################
+# Trigram indexes for project search
+##########################################################
+
+# Project search matches substrings anywhere in a project's title, description,
+# or supplies, which ordinary b-tree indexes can't help with. On PostgreSQL,
+# pg_trgm's GIN indexes can. Other databases fall back to the in-memory
+# index in search_index.py.
+event.listen(db.metadata,
+             "before_create",
+             DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"))
+
+TRIGRAM_INDEXED_COLUMNS = [(SupplyDetail.__table__, "supply_type"),
+                           (SupplyDetail.__table__, "brand"),
+                           (SupplyDetail.__table__, "color"),
+                           (Project.__table__, "title"),
+                           (Project.__table__, "description")]
+
+for table, column in TRIGRAM_INDEXED_COLUMNS:
+    trigram_index = DDL("CREATE INDEX ix_%(table)s_%(column)s_trgm ON %(table)s "
+                        "USING gin (%(column)s gin_trgm_ops)",
+                        context={"column": column})
+
+    event.listen(table, "after_create", trigram_index.execute_if(dialect="postgresql"))
+
+
 ##########################################################
 # Function to add controlled sample data
 ##########################################################
@@ -482,16 +793,206 @@ def example_data():
 
     db.session.commit()
 
+    # The example data replaces whatever catalog and inventories were cached
+    # before.
+    catalog_cache.bump_version()
+    inventory_tag_indexes.bump_version()
+    inventory_fragments.bump_version()
+    project_search_indexes.bump_version()
+
+
+##########################################################
+# Unit of work
+##########################################################
+
+# Functions that change the database only flush their changes. The web app
+# commits once, at the end of each request, and scripts wrap their changes in
+# unit_of_work(). Anything that should only happen once changes are really
+# saved, like updating in-memory caches, waits for the commit with on_commit().
+
+def on_commit(callback):
+    """Call callback once the current transaction commits. If the transaction
+    is rolled back instead, callback is never called."""
+
+    db.session.info.setdefault("on_commit", []).append(callback)
+
+
+def has_unsaved_changes():
+    """Return True if the current transaction has anything to commit."""
+
+    # Don't start a session just to find out it's empty.
+    if not db.session.registry.has():
+        return False
+
+    session = db.session
+
+    return bool(session.info.get("flushed") or session.new or session.dirty or session.deleted)
+
+
+def discard_unsaved_changes():
+    """Roll back the current transaction, if there is one."""
+
+    if db.session.registry.has():
+        db.session.rollback()
+
+
+@contextmanager
+def unit_of_work():
+    """Commit everything done inside the block at once, or roll all of it back
+    if anything goes wrong. For code that runs outside a web request."""
+
+    try:
+        yield db.session
+        db.session.commit()
+
+    except:
+        db.session.rollback()
+        raise
+
+
+@event.listens_for(SignallingSession, "after_flush")
+def note_flush(session, flush_context):
+    """Remember that this transaction has written something."""
+
+    session.info["flushed"] = True
+
+
+@event.listens_for(SignallingSession, "after_commit")
+def run_commit_callbacks(session):
+    """Call everything that was waiting for this transaction to commit."""
+
+    for callback in session.info.pop("on_commit", []):
+        callback()
+
+
+@event.listens_for(SignallingSession, "after_transaction_end")
+def reset_unit_of_work(session, transaction):
+    """Start the next transaction with a clean slate, however this one ended."""
+
+    # Only the outermost transaction ending leaves the session without one.
+    if session.transaction is None:
+        session.info.pop("on_commit", None)
+        session.info.pop("flushed", None)
+        session.info.pop("inventory_versions", None)
+
+
+##########################################################
+# Inventory versions
+##########################################################
+
+def get_inventory_version(user_id):
+    """Return the version of the user's inventory. It goes up every time a
+    transaction that changes any of their items commits."""
+
+    q = db.session.query(User.inventory_version).filter(User.user_id == user_id)
+
+    return q.scalar()
+
+
+def get_next_inventory_version(session, user_id):
+    """Move the user's inventory on to its next version, and return it. Every
+    flush in the same transaction gets the same version.
+
+    Updating the user's row first means that, in PostgreSQL, transactions
+    changing the same inventory take turns, so versions only ever go up.
+    """
+
+    versions = session.info.setdefault("inventory_versions", {})
+
+    if user_id not in versions:
+        users = User.__table__
+
+        session.execute(users.update()
+                             .where(users.c.user_id == user_id)
+                             .values(inventory_version=users.c.inventory_version + 1))
+
+        versions[user_id] = session.execute(select([users.c.inventory_version])
+                                            .where(users.c.user_id == user_id)).scalar()
+
+        # Don't let a user we've already loaded hang on to the old version.
+        user = session.identity_map.get(identity_key(User, user_id))
+
+        if user is not None:
+            set_committed_value(user, "inventory_version", versions[user_id])
+
+    return versions[user_id]
+
+
+@event.listens_for(SignallingSession, "after_flush")
+def stamp_inventory_changes(session, flush_context):
+    """Stamp the items that were just saved with their owners' next inventory
+    versions, and remember the ones that were just deleted."""
+
+    changed = {}
+    deleted = {}
+
+    for obj in session.new:
+        if isinstance(obj, Item):
+            changed.setdefault(obj.user_id, []).append(obj)
+
+    for obj in session.dirty:
+        if isinstance(obj, Item) and session.is_modified(obj):
+            changed.setdefault(obj.user_id, []).append(obj)
+
+    for obj in session.deleted:
+        if isinstance(obj, Item):
+            deleted.setdefault(obj.user_id, []).append(obj.item_id)
+
+    # Go through users in order, so transactions never wait on each other's
+    # users in opposite orders.
+    for user_id in sorted(set(changed) | set(deleted)):
+        version = get_next_inventory_version(session, user_id)
+
+        items = changed.get(user_id)
+
+        if items:
+            session.execute(Item.__table__.update()
+                                .where(Item.item_id.in_([item.item_id for item in items]))
+                                .values(version=version))
+
+            for item in items:
+                set_committed_value(item, "version", version)
+
+        if user_id in deleted:
+            deletions = ItemDeletion.__table__
+
+            session.execute(deletions.insert(),
+                            [{"item_id": item_id, "user_id": user_id, "version": version}
+                             for item_id in deleted[user_id]])
+
+            # Nobody gets asked about deletions this old any more.
+            session.execute(deletions.delete()
+                                     .where(deletions.c.user_id == user_id)
+                                     .where(deletions.c.version <=
+                                            version - ITEM_DELETION_RETENTION))
+
 
 ##########################################################
 # Helper functions
 ##########################################################
 
-def connect_to_db(app, uri='postgresql:///crafterscloset'):
-    """Connect to the database for the Crafter's Closet Flask app."""
+def set_statement_timeout(milliseconds):
+    """Let statements run for up to this many milliseconds, instead of the
+    engine profile's default, until the current transaction ends.
+
+    Only PostgreSQL can time statements out, so elsewhere this does nothing.
+    """
+
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute("SET LOCAL statement_timeout = %d" % int(milliseconds))
+
+
+def connect_to_db(app, uri='postgresql:///crafterscloset', profile="web", **overrides):
+    """Connect to the database for the Crafter's Closet Flask app.
+
+    The profile picks the pool and timeout settings from ENGINE_PROFILES in
+    engine_profiles.py: "web" for the server, "seed" for bulk loads, and
+    "test" for the tests. Keyword arguments override single settings.
+    """
 
     # Configure the app to use the database.
     app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options(uri, profile, **overrides)
     # app.config['SQLALCHEMY_ECHO'] = True
     db.app = app
     db.init_app(app)
@@ -0,0 +1,220 @@
+"""Counting and timing the SQL each request runs.
+
+Every statement any engine runs gets counted against whatever trackers are
+active on its thread. Each Flask request gets a tracker of its own, and
+requests that run too many statements, spend too long in SQL, or run the same
+statement over and over, which usually means a query in a loop, get logged.
+In strict mode, as in the tests, they raise QueryBudgetExceeded instead.
+"""
+
+from flask import request, g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from collections import Counter
+from contextlib import contextmanager
+import re
+import threading
+import time
+
+# Budgets for a single request. Time is in seconds.
+SQL_QUERY_BUDGET = 25
+SQL_TIME_BUDGET = 0.5
+
+# Running one statement more than this many times in a request means it's
+# probably in a loop, and should be one query instead.
+SQL_REPEAT_BUDGET = 5
+
+# The trackers active on each thread, innermost last.
+_local = threading.local()
+
+
+class QueryBudgetExceeded(Exception):
+    """A request in strict mode, or a block of code in query_budget(), went
+    over its SQL budget."""
+
+
+class QueryStats(object):
+    """The statements run while this was tracking, how many there were, and
+    how long they took altogether, in seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.fingerprints = Counter()
+
+    def record(self, statement, duration):
+        """Add one statement that took duration seconds."""
+
+        self.count += 1
+        self.total_time += duration
+        self.fingerprints[fingerprint(statement)] += 1
+
+    def get_repeated(self, limit=SQL_REPEAT_BUDGET):
+        """Return (fingerprint, times run) for each statement run more than
+        limit times, most repeated first."""
+
+        return [(statement, times) for statement, times in self.fingerprints.most_common()
+                if times > limit]
+
+    def get_problems(self, query_budget=SQL_QUERY_BUDGET, time_budget=SQL_TIME_BUDGET,
+                     repeat_budget=SQL_REPEAT_BUDGET):
+        """Return a list of descriptions of the ways these stats go over
+        budget. An empty list means they don't."""
+
+        problems = []
+
+        if self.count > query_budget:
+            problems.append("%d queries (budget %d)" % (self.count, query_budget))
+
+        if self.total_time > time_budget:
+            problems.append("%.3fs in SQL (budget %.3fs)" % (self.total_time, time_budget))
+
+        for statement, times in self.get_repeated(repeat_budget):
+            problems.append("%d runs of: %s" % (times, statement))
+
+        return problems
+
+
+def fingerprint(statement):
+    """Boil a SQL statement down so that the same query run with different
+    values, or a different number of them, looks the same."""
+
+    statement = " ".join(statement.split())
+
+    # Quoted strings and numbers become placeholders...
+    statement = re.sub(r"'(?:[^']|'')*'", "?", statement)
+    statement = re.sub(r"\b\d+(?:\.\d+)?\b", "?", statement)
+
+    # ...as do named parameters, like psycopg2's %(name)s and sqlite's :name.
+    statement = re.sub(r"%\(\w+\)s|%s|:\w+", "?", statement)
+
+    # An IN list is the same query however long it is.
+    return re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?)", statement)
+
+
+##########################################################
+# Tracking
+##########################################################
+
+def get_active_trackers():
+    """Return the list of trackers active on this thread."""
+
+    if not hasattr(_local, "trackers"):
+        _local.trackers = []
+
+    return _local.trackers
+
+
+@contextmanager
+def track_queries():
+    """Track the statements run inside the block, on this thread.
+
+        with track_queries() as stats:
+            get_inventory_chart_dict(user_id)
+
+        print stats.count
+    """
+
+    stats = QueryStats()
+    trackers = get_active_trackers()
+    trackers.append(stats)
+
+    try:
+        yield stats
+
+    finally:
+        trackers.remove(stats)
+
+
+@contextmanager
+def query_budget(queries=SQL_QUERY_BUDGET, seconds=SQL_TIME_BUDGET, repeats=SQL_REPEAT_BUDGET):
+    """Raise QueryBudgetExceeded if the block goes over any of the budgets,
+    the way strict mode does for requests.
+
+        with query_budget(queries=3):
+            get_craft_project_supplies_info(project, user_id)
+    """
+
+    with track_queries() as stats:
+        yield stats
+
+    problems = stats.get_problems(queries, seconds, repeats)
+
+    if problems:
+        raise QueryBudgetExceeded("Went over the SQL budget: %s" % "; ".join(problems))
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_times", []).append(time.time())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    duration = time.time() - conn.info["query_start_times"].pop()
+
+    for stats in get_active_trackers():
+        stats.record(statement, duration)
+
+
+@event.listens_for(Engine, "handle_error")
+def forget_failed_query(exception_context):
+    # A statement that fails never gets to after_cursor_execute, so its start
+    # time has to go now.
+    connection = exception_context.connection
+
+    if connection is not None and connection.info.get("query_start_times"):
+        connection.info["query_start_times"].pop()
+
+
+##########################################################
+# Flask requests
+##########################################################
+
+def init_query_stats(app):
+    """Track the statements each of the app's requests runs, and complain
+    about requests that go over the SQL_* budgets in app.config. With
+    SQL_STRICT set, raise QueryBudgetExceeded instead of logging."""
+
+    app.config.setdefault("SQL_QUERY_BUDGET", SQL_QUERY_BUDGET)
+    app.config.setdefault("SQL_TIME_BUDGET", SQL_TIME_BUDGET)
+    app.config.setdefault("SQL_REPEAT_BUDGET", SQL_REPEAT_BUDGET)
+    app.config.setdefault("SQL_STRICT", False)
+
+    @app.before_request
+    def start_tracking_queries():
+        g.query_stats = QueryStats()
+        get_active_trackers().append(g.query_stats)
+
+    @app.after_request
+    def check_query_budget(response):
+        stats = getattr(g, "query_stats", None)
+
+        if stats is None:
+            return response
+
+        if app.debug:
+            response.headers["X-Query-Count"] = str(stats.count)
+            response.headers["X-Query-Time"] = "%.3f" % stats.total_time
+
+        problems = stats.get_problems(app.config["SQL_QUERY_BUDGET"],
+                                      app.config["SQL_TIME_BUDGET"],
+                                      app.config["SQL_REPEAT_BUDGET"])
+
+        if problems:
+            message = "%s %s went over its SQL budget: %s" % (
+                request.method, request.path, "; ".join(problems))
+
+            if app.config["SQL_STRICT"]:
+                raise QueryBudgetExceeded(message)
+
+            app.logger.warning(message)
+
+        return response
+
+    @app.teardown_request
+    def stop_tracking_queries(exception):
+        stats = getattr(g, "query_stats", None)
+
+        if stats in get_active_trackers():
+            get_active_trackers().remove(stats)
@@ -0,0 +1,298 @@
+"""In-memory search indexes for Crafter's Closet autocomplete features."""
+
+from bisect import bisect_left, insort
+from threading import Lock
+import re
+
+from cache import VersionedCache
+
+# Don't send the front end more suggestions than anyone would read.
+AUTOCOMPLETE_LIMIT = 20
+
+# Tags are also indexed by each word in them, so "pa" finds "Acrylic Paint".
+WORD_SEPARATORS = re.compile(r"[\s\-/(),]+")
+
+# How many recent searches each index remembers the results of.
+MAX_REMEMBERED_SEARCHES = 200
+
+
+class TagIndex(object):
+    """An autocomplete index over a collection of tags.
+
+    Each tag is indexed under its whole lowercased self and under each word in
+    it, in a sorted array of (token, tag) pairs, so prefix lookups are a binary
+    search. If there aren't enough prefix matches, we fall back to a substring
+    scan over the distinct tags. Tags are reference counted, so the same tag
+    can be added by many items and only disappears when the last one goes.
+
+    Autocomplete searches come a keystroke at a time, so the index remembers
+    its recent results until its tags change. A search for a term that extends
+    one it answered in full only has to look through that answer.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._tokens = []
+        self._lock = Lock()
+
+        # (term, limit): (tags, whether those are all the matching tags)
+        self._results = {}
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, tag):
+        """Add one reference to tag."""
+
+        if not tag:
+            return
+
+        with self._lock:
+            self._counts[tag] = self._counts.get(tag, 0) + 1
+
+            if self._counts[tag] == 1:
+                for token in get_tag_tokens(tag):
+                    insort(self._tokens, (token, tag))
+
+                self._results.clear()
+
+    def remove(self, tag):
+        """Remove one reference to tag, dropping it when none are left."""
+
+        with self._lock:
+            if tag not in self._counts:
+                return
+
+            self._counts[tag] -= 1
+
+            if self._counts[tag] == 0:
+                del self._counts[tag]
+
+                for token in get_tag_tokens(tag):
+                    i = bisect_left(self._tokens, (token, tag))
+                    if i < len(self._tokens) and self._tokens[i] == (token, tag):
+                        del self._tokens[i]
+
+                self._results.clear()
+
+    def search(self, term, limit=AUTOCOMPLETE_LIMIT):
+        """Return up to limit tags matching term. Tags with a word starting
+        with term come first, then tags that merely contain it."""
+
+        term = term.strip().lower()
+
+        with self._lock:
+            result = self._results.get((term, limit))
+
+            if result is None:
+                result = self.search_earlier_result(term, limit) or self.search_tokens(term, limit)
+
+                if len(self._results) >= MAX_REMEMBERED_SEARCHES:
+                    self._results.clear()
+
+                self._results[(term, limit)] = result
+
+        tags, _ = result
+
+        return list(tags)
+
+    def search_tokens(self, term, limit):
+        """Search the whole index for term. Returns (tags, complete), where
+        complete says whether tags holds every matching tag."""
+
+        prefix_matches = set()
+
+        # Walk the sorted tokens from the first one that could start with the
+        # term, stopping at the first one that doesn't.
+        i = bisect_left(self._tokens, (term,))
+
+        while i < len(self._tokens) and self._tokens[i][0].startswith(term):
+            prefix_matches.add(self._tokens[i][1])
+            i += 1
+
+        tags = sorted(prefix_matches)
+
+        # Once there are enough prefix matches, we don't look any further, so
+        # we can't know we've found everything.
+        if len(tags) >= limit:
+            return tags[:limit], False
+
+        substring_matches = [tag for tag in self._counts
+                             if tag not in prefix_matches and term in tag.lower()]
+        tags.extend(sorted(substring_matches))
+
+        return tags[:limit], len(tags) <= limit
+
+    def search_earlier_result(self, term, limit):
+        """If we answered a search for the start of term in full, search just
+        that answer, since any tag containing term contains the start of it,
+        too. Returns (tags, complete), or None if there's no such answer."""
+
+        for end in range(len(term) - 1, 0, -1):
+            result = self._results.get((term[:end], limit))
+
+            if result is not None and result[1]:
+                return order_tags(result[0], term), True
+
+        return None
+
+
+def order_tags(tags, term):
+    """Put the tags that contain term in the order TagIndex.search() would,
+    dropping the rest."""
+
+    prefix_matches = []
+    substring_matches = []
+
+    for tag in tags:
+        if any(token.startswith(term) for token in get_tag_tokens(tag)):
+            prefix_matches.append(tag)
+        elif term in tag.lower():
+            substring_matches.append(tag)
+
+    return sorted(prefix_matches) + sorted(substring_matches)
+
+
+def get_tag_tokens(tag):
+    """Return the set of lowercased tokens a tag is indexed under."""
+
+    tag = tag.lower()
+    tokens = set(word for word in WORD_SEPARATORS.split(tag) if word)
+    tokens.add(tag)
+
+    return tokens
+
+
+##########################################################
+# Per-user inventory autocomplete indexes
+##########################################################
+
+# Indexes are built lazily and kept up to date as items come and go. Other
+# server processes don't see those updates, so let indexes expire, too.
+inventory_tag_indexes = VersionedCache(ttl=600, max_entries=1000)
+
+
+def add_inventory_tags(user_id, tags):
+    """Add the tags for a newly owned supply to the user's index, if it's been
+    built. If it hasn't, it'll pick the supply up when it is."""
+
+    index = inventory_tag_indexes.get(user_id)
+
+    if index is not None:
+        for tag in tags:
+            index.add(tag)
+
+
+def remove_inventory_tags(user_id, tags):
+    """Remove the tags for a supply the user no longer owns from their index,
+    if it's been built."""
+
+    index = inventory_tag_indexes.get(user_id)
+
+    if index is not None:
+        for tag in tags:
+            index.remove(tag)
+
+
+def get_supply_tags(supply_detail):
+    """Return the tags a supply detail contributes to an inventory index."""
+
+    return (supply_detail.supply_type, supply_detail.brand, supply_detail.color)
+
+
+##########################################################
+# Project search
+##########################################################
+
+class ProjectSearchIndex(object):
+    """An in-memory trigram index over project pages, for databases that
+    can't index substring searches themselves.
+
+    Each project is indexed by the trigrams in its title, description, and the
+    supply types, brands, and colors it uses. A search intersects the postings
+    for the search term's trigrams to find candidates, then checks that each
+    candidate really contains the term, so results match an ilike '%term%'
+    search without scanning every project.
+    """
+
+    # How much a match in each kind of field counts toward a project's rank.
+    TITLE_WEIGHT = 4
+    DESCRIPTION_WEIGHT = 2
+    SUPPLY_WEIGHT = 1
+
+    def __init__(self):
+        self._projects = {}
+        self._postings = {}
+
+    def __len__(self):
+        return len(self._projects)
+
+    def add_project(self, project_id, title, description, supply_fields):
+        """Index a project by its title, description, and a list of strings
+        describing its supplies."""
+
+        fields = {"title": (title or "").lower(),
+                  "description": (description or "").lower(),
+                  "supplies": [field.lower() for field in supply_fields if field]}
+
+        self._projects[project_id] = (title, description, fields)
+
+        for text in [fields["title"], fields["description"]] + fields["supplies"]:
+            for trigram in get_trigrams(text):
+                self._postings.setdefault(trigram, set()).add(project_id)
+
+    def search(self, term):
+        """Return (title, description, project_id) tuples for every project
+        matching term, best matches first."""
+
+        term = term.lower()
+        trigrams = get_trigrams(term)
+
+        # Terms too short to have trigrams have to check every project.
+        if trigrams:
+            postings = sorted((self._postings.get(trigram, set()) for trigram in trigrams),
+                              key=len)
+            candidates = set.intersection(*postings)
+        else:
+            candidates = self._projects.keys()
+
+        ranked = []
+
+        for project_id in candidates:
+            title, description, fields = self._projects[project_id]
+            score = self.rank(term, fields)
+
+            if score:
+                ranked.append((-score, title, project_id, description))
+
+        ranked.sort()
+
+        return [(title, description, project_id)
+                for _, title, project_id, description in ranked]
+
+    def rank(self, term, fields):
+        """Score how well a project's fields match term. Zero means they don't."""
+
+        score = 0
+
+        if term in fields["title"]:
+            score += self.TITLE_WEIGHT
+
+        if term in fields["description"]:
+            score += self.DESCRIPTION_WEIGHT
+
+        if any(term in supply for supply in fields["supplies"]):
+            score += self.SUPPLY_WEIGHT
+
+        return score
+
+
+def get_trigrams(text):
+    """Return the set of three-character substrings of text."""
+
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+# There's only ever one project index. It gets thrown out whenever a project
+# or one of its supplies is added.
+project_search_indexes = VersionedCache(ttl=600)
@@ -1,11 +1,33 @@
 """Utility file to seed Crafter's Closet database from data in seed_data/"""
 
 from sqlalchemy import func
-from model import User, SupplyDetail, Project, ProjectSupply, Item
+import argparse
+import os
+import time
 
-from model import connect_to_db, db
+from model import User, SupplyDetail, Project, ProjectSupply, Item, ItemDeletion
+
+from model import connect_to_db, db, on_commit, unit_of_work
+from cache import catalog_cache, inventory_fragments
+from search_index import inventory_tag_indexes, project_search_indexes
 from server import app
 
+#########################################################
+# Emptying the database, so it can be seeded again.
+#########################################################
+
+
+def empty_tables():
+    """Delete every row the seed files could fill, along with the record of
+    deleted items, which would otherwise point at users that no longer exist.
+    Children go first, so foreign keys don't get in the way."""
+
+    ItemDeletion.query.delete()
+
+    for _, model, _ in reversed(SEED_FILES):
+        model.query.delete()
+
+
 #########################################################
 # Functions related to loading users.
 #########################################################
@@ -33,8 +55,9 @@ def load_users():
         # We need to add to the session or it won't ever be stored
         db.session.add(user)
 
-    # Once we're done, we should commit our work
-    db.session.commit()
+    # Once we're done, flush our work. It gets committed along with
+    # everything else the script loads.
+    db.session.flush()
 
 
 def set_val_user_id():
@@ -49,7 +72,6 @@ def set_val_user_id():
     # Set the value for the next user_id to be max_id + 1
     query = "SELECT setval('users_user_id_seq', :new_id)"
     db.session.execute(query, {'new_id': max_id + 1})
-    db.session.commit()
 
 
 #########################################################
@@ -80,8 +102,12 @@ def load_supplydetails():
         # We need to add to the session or it won't ever be stored
         db.session.add(supplydetail)
 
-    # Once we're done, we should commit our work
-    db.session.commit()
+    # Once we're done, flush our work. It gets committed along with
+    # everything else the script loads.
+    db.session.flush()
+
+    # Anything cached about the old catalog is out of date once that's saved.
+    on_commit(catalog_cache.bump_version)
 
 
 def set_val_sd_id():
@@ -96,7 +122,6 @@ def set_val_sd_id():
     # Set the value for the next user_id to be max_id + 1
     query = "SELECT setval('supply_details_sd_id_seq', :new_id)"
     db.session.execute(query, {'new_id': max_id + 1})
-    db.session.commit()
 
 
 #########################################################
@@ -127,8 +152,12 @@ def load_projects():
         # We need to add to the session or it won't ever be stored
         db.session.add(project)
 
-    # Once we're done, we should commit our work
-    db.session.commit()
+    # Once we're done, flush our work. It gets committed along with
+    # everything else the script loads.
+    db.session.flush()
+
+    # Project search needs to look at the new projects once they're saved.
+    on_commit(project_search_indexes.bump_version)
 
 
 def set_val_project_id():
@@ -143,7 +172,6 @@ def set_val_project_id():
     # Set the value for the next user_id to be max_id + 1
     query = "SELECT setval('projects_project_id_seq', :new_id)"
     db.session.execute(query, {'new_id': max_id + 1})
-    db.session.commit()
 
 
 ################################################################################
@@ -172,8 +200,12 @@ def load_projectsupplies():
         # We need to add to the session or it won't ever be stored
         db.session.add(projectsupply)
 
-    # Once we're done, we should commit our work
-    db.session.commit()
+    # Once we're done, flush our work. It gets committed along with
+    # everything else the script loads.
+    db.session.flush()
+
+    # Project search also looks at the supplies in projects, once they're saved.
+    on_commit(project_search_indexes.bump_version)
 
 
 def set_val_ps_id():
@@ -188,7 +220,6 @@ def set_val_ps_id():
     # Set the value for the next user_id to be max_id + 1
     query = "SELECT setval('project_supplies_ps_id_seq', :new_id)"
     db.session.execute(query, {'new_id': max_id + 1})
-    db.session.commit()
 
 
 #########################################################
@@ -217,8 +248,9 @@ def load_items():
         # We need to add to the session or it won't ever be stored
         db.session.add(item)
 
-    # Once we're done, we should commit our work
-    db.session.commit()
+    # Once we're done, flush our work. It gets committed along with
+    # everything else the script loads.
+    db.session.flush()
 
 
 def set_val_item_id():
@@ -233,26 +265,220 @@ def set_val_item_id():
     # Set the value for the next user_id to be max_id + 1
     query = "SELECT setval('items_item_id_seq', :new_id)"
     db.session.execute(query, {'new_id': max_id + 1})
+
+#########################################################
+# Bulk loading, for seeding large amounts of data quickly.
+#########################################################
+
+SEED_DIR = "seed_data"
+
+# The seed files in the order they have to be loaded, so foreign keys are
+# satisfied, along with the model each one fills and its columns, in the order
+# they appear in the file.
+SEED_FILES = [
+    ("u.user", User, ["user_id", "email", "username", "password"]),
+    ("u.supplydetail", SupplyDetail, ["sd_id", "supply_type", "brand", "color",
+                                      "units", "purchase_url"]),
+    ("u.project", Project, ["project_id", "title", "user_id", "instr_url",
+                            "img_url", "description"]),
+    ("u.projectsupply", ProjectSupply, ["ps_id", "project_id", "sd_id", "supply_qty"]),
+    ("u.item", Item, ["item_id", "user_id", "sd_id", "qty"]),
+]
+
+# How many rows to send per executemany() batch, and how often to say how
+# far we've gotten.
+BULK_BATCH_SIZE = 10000
+PROGRESS_EVERY = 100000
+
+
+def bulk_load_all(seed_dir=SEED_DIR):
+    """Replace everything in the database with the contents of the seed files
+    in seed_dir, in one transaction.
+
+    On PostgreSQL, each file is streamed straight into its table with COPY.
+    Elsewhere, rows go in with executemany() batches of plain INSERTs. Either
+    way, no ORM objects get created, and we report how fast each table loads.
+    """
+
+    print "\n****Bulk Loading Seed Data from %s****\n" % seed_dir
+
+    start = time.time()
+    total_rows = 0
+
+    empty_tables()
+
+    for filename, model, columns in SEED_FILES:
+        path = os.path.join(seed_dir, filename)
+        total_rows += bulk_load_file(path, model.__table__, columns)
+
     db.session.commit()
 
+    # Anything cached about the old data is out of date now.
+    catalog_cache.bump_version()
+    inventory_tag_indexes.bump_version()
+    inventory_fragments.bump_version()
+    project_search_indexes.bump_version()
+
+    report_progress("all tables", total_rows, start)
+
+    return total_rows
+
+
+def bulk_load_file(path, table, columns):
+    """Load one seed file into table, returning how many rows it had."""
+
+    start = time.time()
+
+    with open(path) as seed_file:
+        lines = SeedFileLines(seed_file, table.name, start)
+
+        if db.engine.dialect.name == "postgresql":
+            copy_seed_lines(lines, table, columns)
+
+        else:
+            insert_seed_lines(lines, table, columns)
+
+    report_progress(table.name, lines.count, start)
+
+    return lines.count
+
+
+def copy_seed_lines(lines, table, columns):
+    """Stream seed file lines into a PostgreSQL table with COPY. Seed files are
+    plain comma-separated text, and empty fields load as empty strings, just
+    like they do through the ORM."""
+
+    copy_sql = "COPY %s (%s) FROM STDIN WITH DELIMITER ','" % (table.name, ", ".join(columns))
+
+    # COPY lives on the raw psycopg2 cursor. Use the session's connection, so
+    # it happens in the same transaction as everything else.
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(copy_sql, lines)
+
+
+def insert_seed_lines(lines, table, columns):
+    """Insert seed file lines into a table with batched executemany() calls.
+    Seed files are UTF-8, which some drivers won't take as raw bytes."""
+
+    batch = []
+
+    for line in lines:
+        fields = line.rstrip("\n").decode("utf-8").split(",")
+        batch.append(dict(zip(columns, fields)))
+
+        if len(batch) == BULK_BATCH_SIZE:
+            db.session.execute(table.insert(), batch)
+            batch = []
+
+    if batch:
+        db.session.execute(table.insert(), batch)
+
+
+class SeedFileLines(object):
+    """A read-only, file-like view of a seed file that strips trailing
+    whitespace from each line and skips blank ones, the same way the ORM loaders
+    clean up rows. Lines are read lazily, so even huge files load in constant
+    memory, and we count them and report progress as they go by.
+    """
+
+    def __init__(self, seed_file, name, start):
+        self.name = name
+        self.start = start
+        self.count = 0
+        self._lines = (line.rstrip() + "\n" for line in seed_file if line.strip())
+        self._buffer = ""
+
+    def __iter__(self):
+        for line in self._lines:
+            self._count_line()
+            yield line
+
+    def read(self, size=-1):
+        """Return up to size bytes of cleaned-up lines, or all of them if size
+        is negative. This is all COPY needs."""
+
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+
+            if line is None:
+                break
+
+            self._count_line()
+            self._buffer += line
+
+        if size < 0:
+            data, self._buffer = self._buffer, ""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        return data
+
+    def readline(self):
+        """Return the next cleaned-up line, or an empty string at the end."""
+
+        if "\n" not in self._buffer:
+            line = next(self._lines, None)
+
+            if line is not None:
+                self._count_line()
+                self._buffer += line
+
+        line, newline, self._buffer = self._buffer.partition("\n")
+
+        return line + newline
+
+    def _count_line(self):
+        self.count += 1
+
+        if self.count % PROGRESS_EVERY == 0:
+            report_progress(self.name, self.count, self.start)
+
+
+def report_progress(name, rows, start):
+    """Print how many rows we've loaded into name since start, and how fast."""
+
+    elapsed = time.time() - start
+    rate = rows / elapsed if elapsed else rows
+
+    print "%s: %d rows in %.2fs (%d rows/s)" % (name, rows, elapsed, rate)
+
+
 if __name__ == "__main__":
-    connect_to_db(app)
+    parser = argparse.ArgumentParser(description="Seed the Crafter's Closet database.")
+    parser.add_argument("--bulk", action="store_true",
+                        help="stream the seed files straight into the database, "
+                             "instead of creating one object per row")
+    parser.add_argument("--seed-dir", default=SEED_DIR,
+                        help="directory holding the u.* seed files (bulk mode only)")
+    args = parser.parse_args()
+
+    connect_to_db(app, profile="seed")
 
     # In case tables haven't been created, create them
     db.create_all()
 
     # Import different types of data
-    load_users()
-    load_supplydetails()
-    load_projects()
-    load_projectsupplies()
-    load_items()
+    if args.bulk:
+        bulk_load_all(args.seed_dir)
+
+    else:
+        # Load everything in one transaction, so a bad row doesn't leave the
+        # database half seeded.
+        with unit_of_work():
+            empty_tables()
+            load_users()
+            load_supplydetails()
+            load_projects()
+            load_projectsupplies()
+            load_items()
 
     # Set the value of the autoincrementing primary key in each table to
     # the number immediately following the greatest existing id, so we don't
-    # start overwriting data.
-    set_val_user_id()
-    set_val_sd_id()
-    set_val_item_id()
-    set_val_project_id()
-    set_val_ps_id()
+    # start overwriting data. Only PostgreSQL has sequences to fix.
+    if db.engine.dialect.name == "postgresql":
+        with unit_of_work():
+            set_val_user_id()
+            set_val_sd_id()
+            set_val_item_id()
+            set_val_project_id()
+            set_val_ps_id()
@@ -0,0 +1 @@
+"""Seed data for Crafter's Closet, and the scripts that made it."""
@@ -2,22 +2,31 @@
 project."""
 
 
-def create_sup_details_from_colors(read_filename, write_filename, sup_id, sup_type, brand, units):
-    """Given a text file of only colors, create a list of supplies."""
-    read_file_obj = open(read_filename)
+def expand_colors(colors, sup_id, sup_type, brand, units):
+    """Given color names, generate a u.supplydetail row for each one, with ids
+    counting up from sup_id. Works one color at a time, so the colors can come
+    from a file or a generator of any length."""
 
-    # Open in append mode
-    write_file_obj = open(write_filename, "a")
-
-    for line in read_file_obj:
-        color = line.rstrip()
+    for color in colors:
         data_row = ",".join([str(sup_id),
                             sup_type,
                             brand,
-                            color.title(),
+                            color.rstrip().title(),
                             units,
                             "\n"])
 
+        yield data_row
+        sup_id += 1
+
+
+def create_sup_details_from_colors(read_filename, write_filename, sup_id, sup_type, brand, units):
+    """Given a text file of only colors, create a list of supplies."""
+    read_file_obj = open(read_filename)
+
+    # Open in append mode
+    write_file_obj = open(write_filename, "a")
+
+    for data_row in expand_colors(read_file_obj, sup_id, sup_type, brand, units):
         write_file_obj.write(data_row)
         sup_id += 1
 
@@ -58,12 +67,14 @@ def create_red_heart_yarns(sup_id, filename):
     read_file_obj.close()
     write_file_obj.close()
 
-sup_id = 0
-new_id = create_sup_details_from_colors("americanacolors.txt",
-                                        "paint_and_yarn.txt",
-                                        sup_id,
-                                        "Acrylic Paint",
-                                        "Americana",
-                                        "oz")
 
-create_red_heart_yarns(new_id, "paint_and_yarn.txt")
+if __name__ == "__main__":
+    sup_id = 0
+    new_id = create_sup_details_from_colors("americanacolors.txt",
+                                            "paint_and_yarn.txt",
+                                            sup_id,
+                                            "Acrylic Paint",
+                                            "Americana",
+                                            "oz")
+
+    create_red_heart_yarns(new_id, "paint_and_yarn.txt")
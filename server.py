@@ -1,30 +1,39 @@
 from jinja2 import StrictUndefined
 
-from flask import Flask, render_template, redirect, request, flash, session, url_for, jsonify, Markup
+from flask import Flask, render_template, redirect, request, flash, session, url_for, jsonify, Markup, abort
 from flask_debugtoolbar import DebugToolbarExtension
-from flask import Response
+from flask import Response, get_template_attribute
 from flask.ext.bcrypt import Bcrypt
+from functools import partial
 import json
 
-from model import connect_to_db, User, Project, Item, db
+from cache import row_fragments
+from compression import init_compression
+from query_stats import init_query_stats
+from engine_profiles import get_pool_stats
+from model import (connect_to_db, User, Project, Item, db,
+                   has_unsaved_changes, discard_unsaved_changes, get_inventory_tag_index,
+                   set_statement_timeout)
 
 from helpers import (
     get_all_supply_types,
     get_all_supply_units,
     get_all_brands,
     get_all_colors,
-    get_all_brands_by_supply_type,
-    get_all_units_by_supply_type,
-    get_projects_by_search,
+    get_catalog_json,
+    get_inventory_json,
+    get_inventory_fragment,
+    search_projects,
     get_inventory_chart_dict,
-    get_colors_from_brand,
-    get_all_colors_dict_by_brand,
+    get_brand_colors_json,
+    PROJECT_SEARCH_PAGE_SIZE,
     get_matching_sd,
     get_matching_item,
     get_craft_project_supplies_info,
+    get_shopping_list,
     add_item_to_inventory,
-    add_project_supply_to_db,
-    add_project_to_db,
+    add_supplies_to_inventory,
+    create_project_with_supplies,
     add_supply_to_db,
     add_user_to_db,
     )
@@ -39,6 +48,68 @@ app.secret_key = "ABC"
 # silently. This is horrible. Fix this so that, instead, it raises an error.
 app.jinja_env.undefined = StrictUndefined
 
+# Compress big responses, especially inventory tables, for slow connections.
+init_compression(app)
+
+# Keep an eye on how much SQL each request runs. This goes before the unit of
+# work hooks, so it sees the commit too.
+init_query_stats(app)
+
+# Statement timeouts for routes that shouldn't get the engine profile's
+# default, in milliseconds, by endpoint. Searches back typing, so they should
+# give up fast; bulk adds can take a while.
+app.config["STATEMENT_TIMEOUTS"] = {
+    "search_inventory": 2000,
+    "inventory_search_tags": 1000,
+    "get_project_search_results": 2000,
+    "add_supplies": 30000,
+}
+
+# Pool stats are for us, not for users.
+app.config["EXPOSE_POOL_STATS"] = False
+
+# How many projects each page of project search results shows.
+app.config["PROJECT_SEARCH_PAGE_SIZE"] = PROJECT_SEARCH_PAGE_SIZE
+
+
+#################################################################
+# Unit of work. Helpers only flush their changes; each request's
+# changes get committed together, once, right here.
+#################################################################
+
+@app.after_request
+def commit_unit_of_work(response):
+    """Commit whatever a successful request changed. Requests that failed
+    don't get to save anything."""
+
+    if response.status_code < 400:
+        if has_unsaved_changes():
+            db.session.commit()
+
+    else:
+        discard_unsaved_changes()
+
+    return response
+
+
+@app.before_request
+def apply_statement_timeout():
+    """Give this request's statements the timeout set for its route, if any."""
+
+    timeout = app.config["STATEMENT_TIMEOUTS"].get(request.endpoint)
+
+    if timeout:
+        set_statement_timeout(timeout)
+
+
+@app.teardown_request
+def rollback_unit_of_work(exception):
+    """Throw away a request's changes if it raised, including if the commit
+    itself failed."""
+
+    if exception is not None:
+        discard_unsaved_changes()
+
 
 @app.route("/")
 def index():
@@ -62,8 +133,6 @@ def show_dashboard():
     if user_id:
         user = User.query.get(user_id)
 
-        inventory = user.get_inventory()
-
         # Get the user's projects.
         projects = user.get_projects()
 
@@ -73,8 +142,14 @@ def show_dashboard():
         all_brands = get_all_brands()
         all_colors = get_all_colors()
 
-        table_body = Markup(render_template("supply_table.html", inventory=inventory))
-        inventory_chart = Markup(render_template("inventory-chart.html"))
+        # The first page of the whole inventory is the same table as the
+        # first page of an inventory filtered by nothing.
+        more_url = url_for(".filter_inventory", brand="", supplytype="", color="")
+        table_body = render_inventory_page(user_id,
+                                           ("filter", "", "", ""),
+                                           None,
+                                           user.get_inventory,
+                                           more_url)
 
         # Render a dashboard showing the user's inventory.
         return render_template("dashboard.html",
@@ -82,8 +157,7 @@ def show_dashboard():
                                all_supply_types=all_supply_types,
                                all_brands=all_brands,
                                all_colors=all_colors,
-                               table_body=table_body,
-                               inventory_chart=inventory_chart)
+                               table_body=table_body)
 
     else:
         flash("You can't go there! Please log in.")
@@ -153,6 +227,31 @@ def add_supply():
     return redirect(url_for('.show_dashboard'))
 
 
+@app.route("/add-supplies", methods=["POST"])
+def add_supplies():
+    """Add a batch of supplies to the user's inventory at once.
+
+    Expects a JSON body like {"supplies": [{"supply_type": ???, "brand": ???,
+    "color": ???, "units": ???, "qty": ???}, ...]}, and responds with JSON
+    saying what happened to each supply, in the same order.
+    """
+
+    user_id = session.get("user_id")
+
+    if not user_id:
+        abort(401)
+
+    data = request.get_json(silent=True) or {}
+    rows = data.get("supplies")
+
+    if not isinstance(rows, list):
+        abort(400)
+
+    results = add_supplies_to_inventory(user_id, rows)
+
+    return jsonify(results=results)
+
+
 @app.route("/update-item", methods=["POST"])
 def update_item():
     """Updates a row in the user's inventory based on values passed from AJAX."""
@@ -164,9 +263,27 @@ def update_item():
     # Instantiate the item
     item = Item.query.get(item_id)
 
+    # Hang on to the id, in case the item gets deleted.
+    item_id = item.item_id
+
     # Perform a wholesale overwrite.
     overwrite = True
     result = item.update_item_record(new_qty, overwrite)
+
+    # The dashboard keeps its own copy of the inventory, so if it asks, tell it
+    # exactly what changed. jQuery asks for JSON along with text/javascript
+    # and */*, so check JSON beats HTML rather than that it comes first. A
+    # bare */* still gets the plain message.
+    wanted = request.accept_mimetypes.best_match(["text/html", "application/json"])
+
+    if wanted == "application/json":
+        if result == "Deleted!":
+            change = {"item_id": item_id, "deleted": True}
+        else:
+            change = {"item_id": item_id, "deleted": False, "qty": int(item.qty)}
+
+        return jsonify(message=result, change=change)
+
     return result
 
 
@@ -174,17 +291,42 @@ def update_item():
 @app.route("/dashboard/brands")
 def get_brands():
     """Fetch all brands in the db by supply type, and return as JSON."""
-    brands = get_all_brands_by_supply_type()
-    brands = jsonify(brands)
-    return(brands)
+    return render_catalog_json("brands_by_type")
 
 
 @app.route("/dashboard/units")
 def get_units():
     """Fetch all units in the db by supply type, and return as JSON."""
-    units = get_all_units_by_supply_type()
-    units = jsonify(units)
-    return(units)
+    return render_catalog_json("units_by_type")
+
+
+def render_catalog_json(facet):
+    """Build a response for one of the catalog facets, from the cached JSON.
+    The catalog is the same for everyone, so any cache may store it."""
+
+    body, etag = get_catalog_json(facet)
+
+    return render_json_with_etag(body, etag, public=True)
+
+
+def render_json_with_etag(body, etag, public=False):
+    """Build a response for some JSON we've already serialized, with its ETag.
+
+    Caches should check back with us before reusing it. If the ETag they have
+    still matches, the response becomes a bodiless 304. Only public responses
+    may be stored by caches shared between users.
+    """
+
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+
+    if public:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+
+    return response.make_conditional(request)
 
 
 @app.route("/typeahead/colors-by-brand")
@@ -192,58 +334,162 @@ def typeahead_colors():
     """Fetch tags for colors autocomplete feature in adding supplies."""
 
     # Get the brand from the URL args.
-    brand = request.args.get("brand")
+    brand = request.args.get("brand") or ""
 
-    # Get the list of colors for that brand.
-    colors = get_colors_from_brand(brand)
+    # Get the list of colors for that brand, as JSON, and return it. Every user
+    # gets the same colors for the same brand, so let caches share it.
+    body, etag = get_brand_colors_json(brand)
 
-    # JSONify the list (not to be confused w/ calling jsonify...)
-    # and return it.
-    return Response(json.dumps(colors), mimetype='application/json')
+    return render_json_with_etag(body, etag, public=True)
 
 
 ##########################################################
 # Inventory filter/search routes
 ##########################################################
 
+@app.route("/inventory/data")
+def inventory_data():
+    """Give the dashboard the user's whole inventory as compact JSON, so it can
+    filter and search it without coming back to us. See
+    User.get_inventory_columns() for the format."""
+
+    user_id = session.get("user_id")
+
+    if not user_id:
+        abort(401)
+
+    body, etag = get_inventory_json(user_id)
+
+    return render_json_with_etag(body, etag)
+
+
+@app.route("/inventory/changes")
+def inventory_changes():
+    """Tell the dashboard what changed in the user's inventory since the version
+    it has, passed as since. See User.get_inventory_changes() for the format."""
+
+    user_id = session.get("user_id")
+
+    if not user_id:
+        abort(401)
+
+    try:
+        since = int(request.args.get("since"))
+    except (TypeError, ValueError):
+        abort(400)
+
+    user = User.query.get(user_id)
+
+    return jsonify(user.get_inventory_changes(since))
+
+
 @app.route("/inventory/filter")
 def filter_inventory():
     """Gives AJAX a filtered version of the HTML for the user's inventory, based on
-    brand, supply type, or color."""
+    brand, supply type, or color. If a page token is passed, only gives the rows
+    for that page."""
 
     # Get the brand, supply_type, and color from the GET request arguments.
     # Alse get the user_id from the session.
-    brand = request.args.get("brand")
-    supply_type = request.args.get("supplytype")
-    color = request.args.get("color")
-    user = User.query.get(session.get("user_id"))
-
-    # Fetch the filtered inventory as a list of tuples.
-    inventory = user.get_filtered_inventory(brand, supply_type, color)
+    brand = request.args.get("brand") or ""
+    supply_type = request.args.get("supplytype") or ""
+    color = request.args.get("color") or ""
+    page_token = request.args.get("page")
+    user_id = session.get("user_id")
 
-    # Render the HTML for the filtered inventory as a safe-to-use Markup object.
-    table_body = Markup(render_template("supply_table.html", inventory=inventory))
+    # Fetch a page of the filtered inventory as a list of tuples.
+    def get_page():
+        user = User.query.get(user_id)
+        return user.get_filtered_inventory(brand, supply_type, color, page_token)
 
     # Return the HTML to the AJAX request as a response.
-    return table_body
+    more_url = url_for(".filter_inventory", brand=brand, supplytype=supply_type, color=color)
+
+    return render_inventory_page(user_id,
+                                 ("filter", brand, supply_type, color),
+                                 page_token,
+                                 get_page,
+                                 more_url)
 
 
 @app.route("/inventory/search-results")
 def search_inventory():
     """Returns only the rows in the user's inventory relevant to the passed
-    search term."""
+    search term. If a page token is passed, only gives the rows for that page."""
 
     # Get the string the user wanted to search for.
-    search_term = request.args.get("search")
-    user = User.query.get(session.get("user_id"))
+    search_term = request.args.get("search") or ""
+    page_token = request.args.get("page")
+    user_id = session.get("user_id")
+
+    # Get a page of the user's inventory filtered by the search term, as a list
+    # of tuples.
+    def get_page():
+        user = User.query.get(user_id)
+        return user.get_inventory_by_search(search_term, page_token)
 
-    # Get the user's inventory filtered by the search term, as a list of tuples.
-    inventory = user.get_inventory_by_search(search_term)
+    more_url = url_for(".search_inventory", search=search_term)
 
-    # Render HTML for search results as a safe-to-use Markup object.
-    table_body = Markup(render_template("supply_table.html", inventory=inventory))
+    return render_inventory_page(user_id,
+                                 ("search", search_term),
+                                 page_token,
+                                 get_page,
+                                 more_url)
+
+
+def render_inventory_page(user_id, view, page_token, get_page, more_url):
+    """Render one page of a view of the user's inventory.
+
+    view is a tuple naming the view and its parameters, and get_page() fetches
+    the page's rows and the token for the next page. The first page gets the
+    whole table, as a safe-to-use Markup object, with a button that fetches the
+    next page from more_url. Later pages get just the rows, with the token for
+    the page after them in the X-Next-Page header.
 
-    return table_body
+    The HTML is cached until the user's inventory changes, so flipping back and
+    forth between filters doesn't query or render the same page twice.
+    """
+
+    def render():
+        try:
+            inventory, next_page = get_page()
+        except ValueError:
+            abort(400)
+
+        rows = render_supply_rows(inventory)
+
+        if page_token:
+            html = render_template("supply_rows.html", rows=rows)
+        else:
+            html = render_template("supply_table.html",
+                                   rows=rows,
+                                   next_page=next_page,
+                                   more_url=more_url)
+
+        return html, next_page
+
+    html, next_page = get_inventory_fragment(user_id, view, page_token, render)
+
+    if not page_token:
+        return Markup(html)
+
+    rows = Response(html)
+
+    if next_page:
+        rows.headers["X-Next-Page"] = next_page
+
+    return rows
+
+
+def render_supply_rows(inventory):
+    """Render each inventory row with the supply_row macro, as a list of
+    Markup objects. Rows that look exactly like ones rendered before, for any
+    table, reuse that HTML."""
+
+    supply_row = get_template_attribute("supply_macros.html", "supply_row")
+
+    return [row_fragments.get_or_compute(tuple(row), partial(supply_row, *row))
+            for row in inventory]
 
 
 @app.route("/inventory/search-autocomplete-tags")
@@ -251,10 +497,15 @@ def inventory_search_tags():
     """As the user types in the inventory search box, send the front end a list
     of autocomplete tags based on the user's search query."""
 
-    search_term = request.args.get("search")
-    user = User.query.get(session.get("user_id"))
+    search_term = request.args.get("search") or ""
+    user_id = session.get("user_id")
+
+    if not user_id:
+        abort(401)
 
-    tags = user.get_inventory_search_ac_tags(search_term)
+    # Search the user's autocomplete index directly. Most keystrokes are
+    # answered from results it remembers, without touching the database.
+    tags = get_inventory_tag_index(user_id).search(search_term)
 
     response = Response(json.dumps(tags), mimetype='application/json')
 
@@ -284,6 +535,22 @@ def show_project(project_id):
                            project_supplies_info=project_supplies_info)
 
 
+@app.route("/projects/shopping-list")
+def show_shopping_list():
+    """Return JSON listing everything the user needs to buy to make all of the
+    projects passed as project_id arguments, grouped by store and brand."""
+
+    user_id = session.get("user_id")
+
+    # Get the project ids from the URL args, ignoring anything that isn't an id.
+    project_ids = [int(project_id) for project_id in request.args.getlist("project_id")
+                   if project_id.isdigit()]
+
+    shopping_list = get_shopping_list(project_ids, user_id)
+
+    return jsonify(shopping_list=shopping_list)
+
+
 @app.route('/create-project', methods=['GET'])
 def show_project_creation_form():
     """Displays the project creation form."""
@@ -322,37 +589,33 @@ def handle_project_creation():
         flash("Hey, you can't make a project with no supplies! Please try again.")
         return redirect("/create-project")
 
-    else:
-        #Create and commit project record
-        project = add_project_to_db(user_id,
-                                    title.title(),
-                                    description,
-                                    instr_url,
-                                    img_url)
-
-        # Given num-supplies, we can iterate over the number of supplies to add
-        # records to the db.
-        for supply_num in range(num_supplies):
-            fieldname_num = str(supply_num)
-            supply_type = request.form.get("supplytype"+fieldname_num)
-            brand = request.form.get("brand"+fieldname_num)
-            color = request.form.get("color"+fieldname_num)
-            qty = request.form.get("qty-required"+fieldname_num)
-
-            # Get a supply from the db that matches the entered supply
-            try:
-                sd = get_matching_sd(supply_type, brand, color)
-
-                add_project_supply_to_db(project, sd, qty)
-
-            except TypeError:
-                flash("Some required supply fields are blank. Please try again!")
-                db.session.delete(project)
-                db.session.commit()
-                return redirect("/create-project")
-
-        flash("%s added to your projects. Hooray!" % (title))
-        return redirect(url_for('.show_project', project_id=project.project_id))
+    # Given num-supplies, we can gather the fields for each supply.
+    supplies = []
+
+    for supply_num in range(num_supplies):
+        fieldname_num = str(supply_num)
+        supplies.append((request.form.get("supplytype"+fieldname_num),
+                         request.form.get("brand"+fieldname_num),
+                         request.form.get("color"+fieldname_num),
+                         request.form.get("qty-required"+fieldname_num)))
+
+    # Create the project and all its supplies at once. If any supply doesn't
+    # match one in the db, nothing gets saved.
+    try:
+        project = create_project_with_supplies(user_id,
+                                               title,
+                                               description,
+                                               instr_url,
+                                               img_url,
+                                               supplies)
+
+    # Say which supply was the problem, since colors have to match exactly.
+    except ValueError as e:
+        flash("%s Please try again!" % e)
+        return redirect("/create-project")
+
+    flash("%s added to your projects. Hooray!" % (title))
+    return redirect(url_for('.show_project', project_id=project.project_id))
 
 
 @app.route("/create-project/new-supply-form")
@@ -374,9 +637,7 @@ def get_new_supply_form():
 @app.route("/add-project/colors-by-brand")
 def get_colors():
     """Fetch a dict of all colors in the db by brand, and return as JSON."""
-    colors = get_all_colors_dict_by_brand()
-    colors = jsonify(colors)
-    return(colors)
+    return render_catalog_json("colors_by_brand")
 
 
 @app.route("/projects/search-results")
@@ -384,14 +645,20 @@ def get_project_search_results():
     """Return HTML representing a table of projects that match the user's
     search query."""
 
-    # Get the string the user wanted to search for.
+    # Get the string the user wanted to search for, and which page of results
+    # they want.
     search_term = request.args.get("search")
+    # Pages start at 1, so the link to the next one does too.
+    page = max(request.args.get("page", 1, type=int), 1)
 
-    # Get a group of projects filtered by the search term, as a list of tuples.
-    projects = get_projects_by_search(search_term)
+    # Get a page of projects filtered by the search term, as a list of tuples.
+    projects, has_more = search_projects(search_term, page,
+                                         app.config["PROJECT_SEARCH_PAGE_SIZE"])
 
     # Render HTML for search results as a safe-to-use Markup object.
-    project_table_body = Markup(render_template("project_table.html", projects=projects))
+    project_table_body = Markup(render_template("project_table.html",
+                                                projects=projects,
+                                                next_page=page + 1 if has_more else None))
 
     #return project_table_body
     return project_table_body
@@ -506,6 +773,17 @@ def logout():
     return redirect("/")
 
 
+@app.route('/pool-stats')
+def show_pool_stats():
+    """Show how the database connection pool is doing, for sizing it. Only
+    available in debug mode, or with EXPOSE_POOL_STATS set."""
+
+    if not (app.debug or app.config["EXPOSE_POOL_STATS"]):
+        abort(404)
+
+    return jsonify(get_pool_stats(db.engine))
+
+
 if __name__ == "__main__":
     # We have to set debug=True here, since it has to be True at the
     # point that we invoke the DebugToolbarExtension
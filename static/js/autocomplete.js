@@ -2,6 +2,20 @@
 // jQuery UI Autocomplete Code for Color Fields
 /////////////////////////////////////////////////
 
+// Wait this long after the last keystroke before asking the server for tags,
+// so typing a word doesn't send a request per letter.
+var AUTOCOMPLETE_DELAY = 200;
+
+// The request in flight for each kind of autocomplete, so a newer one can
+// cancel it instead of racing it.
+var pendingRequests = {};
+
+// Colors we've already fetched, by brand. The catalog only changes when a
+// supply is added, and that reloads the page.
+var colorsByBrand = {};
+
+var searchTimer = null;
+
 // Success function to be called after AJAX request for color data.
 // Should change the autocomplete options in color textbox.
 function replaceTags(results) {
@@ -11,15 +25,46 @@ function replaceTags(results) {
     });
 }
 
-// Fetch the color data from the server.
+// Ask the server for tags, cancelling any request of the same kind that
+// hasn't come back yet, since its answer would be out of date.
+function fetchTags(kind, url, success) {
+    if (pendingRequests[kind]) {
+        pendingRequests[kind].abort();
+    }
+
+    var request = $.get(url, success);
+    pendingRequests[kind] = request;
+
+    request.always(function() {
+        if (pendingRequests[kind] === request) {
+            pendingRequests[kind] = null;
+        }
+    });
+}
+
+// Fetch the color data from the server, unless we already have it.
 function updateColors() {
-  var brand = encodeURIComponent($("#brand").val());
-  $.get("/typeahead/colors-by-brand?brand="+brand, replaceTags);
+  var brand = $("#brand").val() || "";
+
+  if (colorsByBrand.hasOwnProperty(brand)) {
+      replaceTags(colorsByBrand[brand]);
+      return;
+  }
+
+  fetchTags("colors", "/typeahead/colors-by-brand?brand="+encodeURIComponent(brand), function(results) {
+      colorsByBrand[brand] = results;
+      replaceTags(results);
+  });
 }
 
+// Fetch tags for the inventory search once the user pauses typing.
 function updateInventorySearch() {
-    var searchTerm = encodeURIComponent($("#search-term").val());
-    $.get("/inventory/search-autocomplete-tags?search="+searchTerm, replaceTags);
+    clearTimeout(searchTimer);
+
+    searchTimer = setTimeout(function() {
+        var searchTerm = encodeURIComponent($("#search-term").val());
+        fetchTags("search", "/inventory/search-autocomplete-tags?search="+searchTerm, replaceTags);
+    }, AUTOCOMPLETE_DELAY);
 }
 
 // Event listeners for elements tha should cause the colors
@@ -27,4 +72,4 @@ function updateInventorySearch() {
 $("#brand").on("change", updateColors);
 $(".supplytype").on("change", updateColors);
 $(".autocomplete").on("click", updateColors);
-$("#search-term").on("input", updateInventorySearch);
\ No newline at end of file
+$("#search-term").on("input", updateInventorySearch);
@@ -1,4 +1,245 @@
 
+//////////////////////////////////////////////
+// The user's inventory, kept on this side
+//////////////////////////////////////////////
+
+// The whole inventory, fetched once from the server in a compact, columnar
+// form. Until it arrives, or if it never does, filters and searches ask the
+// server for new HTML like they always did.
+var inventory = null;
+
+// The rows matching the current filter or search, as indexes into the
+// inventory, and how many of them are in the table so far.
+var matchingRows = [];
+var shownRows = 0;
+
+// Show this many rows at a time, like the server does.
+var PAGE_SIZE = 100;
+
+$.getJSON("/inventory/data", function(data) {
+    inventory = data;
+});
+
+
+// Turn row i of the columnar inventory back into an object.
+function getInventoryRow(i) {
+    var rows = inventory.rows;
+
+    return {
+        supplyType: inventory.supply_types[rows.supply_type[i]],
+        brand: inventory.brands[rows.brand[i]],
+        color: inventory.colors[rows.color[i]],
+        units: inventory.units[rows.units[i]],
+        qty: rows.qty[i],
+        itemID: rows.item_id[i]
+    };
+}
+
+
+// Return the indexes of all the rows that pass the given test.
+function findInventoryRows(test) {
+    var matches = [];
+
+    for (var i = 0; i < inventory.rows.item_id.length; i++) {
+        if (test(getInventoryRow(i))) {
+            matches.push(i);
+        }
+    }
+
+    return matches;
+}
+
+
+// Build a table row that looks just like the ones the server renders. Use
+// text(), since brands and colors are whatever users typed in.
+function makeInventoryRow(i) {
+    var row = getInventoryRow(i);
+
+    var stock = $("<td>").append(
+        $("<div class='qty-column'>").attr("id", row.itemID).text(row.qty + " " + row.units + " "),
+        $("<input type='text' class='qty-field' hidden name='new-qty'>").attr("id", row.itemID),
+        "<br>");
+
+    var button = $("<button type='button' class='btn btn-default btn-lg update-item' style='float: right;'>")
+        .attr("id", row.itemID)
+        .text("Update Stock");
+
+    return $("<tr>").append(
+        $("<td>").text(row.supplyType),
+        $("<td>").text(row.brand || ""),
+        $("<td>").text(row.color || ""),
+        stock,
+        $("<td>").append(button));
+}
+
+
+// Replace the inventory table with one showing just the matching rows.
+function showInventoryRows(matches) {
+    matchingRows = matches;
+    shownRows = 0;
+
+    var table = $("<table class='table table-striped' id='inventory'>").append(
+        "<thead id='inventory-labels'><tr><th>Type</th><th>Brand</th><th>Color</th>" +
+        "<th>Stock</th><th></th></tr></thead>",
+        "<tbody></tbody>");
+
+    $("#inv-table").empty().append($("<div class='table-responsive'>").append(table));
+
+    showMoreInventoryRows();
+}
+
+
+// Add the next page of matching rows to the table, with a button for the
+// page after that, if there is one.
+function showMoreInventoryRows() {
+    var end = Math.min(shownRows + PAGE_SIZE, matchingRows.length);
+    var tableBody = $("#inventory tbody");
+
+    for (; shownRows < end; shownRows++) {
+        tableBody.append(makeInventoryRow(matchingRows[shownRows]));
+    }
+
+    $("#show-more").remove();
+
+    if (shownRows < matchingRows.length) {
+        $("#inv-table").append("<button type='button' class='btn btn-default btn-lg' " +
+                               "id='show-more'>Show More Supplies</button>");
+    }
+}
+
+$("#inv-table").on("click", "#show-more", showMoreInventoryRows);
+
+
+// Apply a change the server told us about to our copy of the inventory.
+function applyInventoryChange(change) {
+    if (inventory === null) {
+        return;
+    }
+
+    var i = inventory.rows.item_id.indexOf(change.item_id);
+
+    if (i === -1) {
+        return;
+    }
+
+    if (change.deleted) {
+        removeInventoryRow(i);
+    }
+
+    else {
+        inventory.rows.qty[i] = change.qty;
+    }
+}
+
+
+// Remove row i from our copy of the inventory.
+function removeInventoryRow(i) {
+    $.each(inventory.rows, function(column, values) {
+        values.splice(i, 1);
+    });
+}
+
+
+// Return the index of value in one of the inventory's lists of distinct
+// values, adding it if it's new.
+function encodeInventoryValue(values, value) {
+    var i = values.indexOf(value);
+
+    if (i === -1) {
+        values.push(value);
+        i = values.length - 1;
+    }
+
+    return i;
+}
+
+
+// Compare two rows the way the server sorts them: by type, brand, color,
+// then item id.
+function compareInventoryRows(a, b) {
+    var keysA = [a.supplyType, a.brand || "", a.color || "", a.itemID];
+    var keysB = [b.supplyType, b.brand || "", b.color || "", b.itemID];
+
+    for (var k = 0; k < keysA.length; k++) {
+        if (keysA[k] < keysB[k]) {
+            return -1;
+        }
+
+        if (keysA[k] > keysB[k]) {
+            return 1;
+        }
+    }
+
+    return 0;
+}
+
+
+// Put a row the server sent us into our copy of the inventory, replacing the
+// old copy of it if we have one.
+function putInventoryRow(item) {
+    var i = inventory.rows.item_id.indexOf(item.item_id);
+
+    if (i > -1) {
+        removeInventoryRow(i);
+    }
+
+    var row = {supplyType: item.supply_type, brand: item.brand, color: item.color,
+               itemID: item.item_id};
+
+    // Keep the rows in the same order the server would send them.
+    var at = 0;
+
+    while (at < inventory.rows.item_id.length &&
+           compareInventoryRows(getInventoryRow(at), row) < 0) {
+        at++;
+    }
+
+    inventory.rows.supply_type.splice(at, 0, encodeInventoryValue(inventory.supply_types, item.supply_type));
+    inventory.rows.brand.splice(at, 0, encodeInventoryValue(inventory.brands, item.brand));
+    inventory.rows.color.splice(at, 0, encodeInventoryValue(inventory.colors, item.color));
+    inventory.rows.units.splice(at, 0, encodeInventoryValue(inventory.units, item.units));
+    inventory.rows.qty.splice(at, 0, item.qty);
+    inventory.rows.item_id.splice(at, 0, item.item_id);
+}
+
+
+// Catch our copy of the inventory up with the server's, fetching only what
+// changed since the version we have.
+function syncInventory() {
+    if (inventory === null) {
+        return;
+    }
+
+    $.getJSON("/inventory/changes?since=" + inventory.version, function(changes) {
+        // We're too far behind for the server to say what changed. Start over.
+        if (changes.reload) {
+            $.getJSON("/inventory/data", function(data) {
+                inventory = data;
+            });
+            return;
+        }
+
+        $.each(changes.deleted, function(_, itemID) {
+            var i = inventory.rows.item_id.indexOf(itemID);
+
+            if (i > -1) {
+                removeInventoryRow(i);
+            }
+        });
+
+        $.each(changes.items, function(_, item) {
+            putInventoryRow(item);
+        });
+
+        inventory.version = changes.version;
+    });
+}
+
+// Whatever happened in other tabs while the user was away, pick it up when
+// they come back.
+$(window).on("focus", syncInventory);
+
+
 //////////////////////////////////////////////
 // Filter inventory code
 //////////////////////////////////////////////
@@ -6,11 +247,22 @@
 var filterDrops = $(".filter");
 
 $(filterDrops).on("change", function() {
-    // Get the values to craft our request URL from the DOM.
+    // Get the values to filter on from the DOM.
     var brand = $("#filter-brand").val();
     var type = $("#filter-type").val();
     var color = $("#filter-color").val();
 
+    // If we have the inventory already, there's no need to ask the server.
+    // Blank filters match everything.
+    if (inventory !== null) {
+        showInventoryRows(findInventoryRows(function(row) {
+            return (!brand || row.brand === brand) &&
+                   (!type || row.supplyType === type) &&
+                   (!color || row.color === color);
+        }));
+        return;
+    }
+
     // Need to use encodeURIComponent() to escape spaces, &, etc. to sanitize
     // input. Will be useful later too!
     var encodedBrand = encodeURIComponent(brand);
@@ -38,6 +290,19 @@ $("#search-button").on("click", function() {
     // Get the entered search term.
     var searchTerm = $("#search-term").val();
 
+    // Like the server, match the term anywhere in the type, brand, or color,
+    // ignoring case.
+    if (inventory !== null) {
+        var term = searchTerm.toLowerCase();
+
+        showInventoryRows(findInventoryRows(function(row) {
+            return [row.supplyType, row.brand, row.color].some(function(field) {
+                return (field || "").toLowerCase().indexOf(term) > -1;
+            });
+        }));
+        return;
+    }
+
     // Encode the search term for use in URLs.
     var encodedSearchTerm = encodeURIComponent(searchTerm);
 
@@ -58,8 +323,47 @@ $("#search-button").on("click", function() {
 
 $("#clear-filters").on("click", function() {
 
+    if (inventory !== null) {
+        showInventoryRows(findInventoryRows(function(row) {
+            return true;
+        }));
+        return;
+    }
+
     requestURL = "/inventory/filter?brand=&supplytype=&color=";
     $.get(requestURL, function(results) {
         $("#inv-table").html(results);
     });
-});
\ No newline at end of file
+});
+
+
+/////////////////////////////////////////////
+// Load more rows of a long inventory
+/////////////////////////////////////////////
+
+// The button comes and goes with the table, so listen on the table's container.
+$("#inv-table").on("click", "#load-more", function() {
+    var button = $(this);
+
+    // The button knows which filter or search it belongs to and which page
+    // comes next.
+    var url = button.data("url");
+    var separator = url.indexOf("?") > -1 ? "&" : "?";
+    var requestURL = url + separator + "page=" + encodeURIComponent(button.data("page"));
+
+    // Expecting just the rows for the next page, plus the token for the page
+    // after that in a header.
+    $.get(requestURL, function(rows, status, xhr) {
+        $("#inventory tbody").append(rows);
+
+        var nextPage = xhr.getResponseHeader("X-Next-Page");
+
+        if (nextPage) {
+            button.data("page", nextPage);
+        }
+
+        else {
+            button.remove();
+        }
+    });
+});
@@ -3,6 +3,39 @@
 // user-created project pages.
 ///////////////////////////////////////////////
 
+// The term we last searched for, so we can ask for more pages of its results.
+var currentSearchTerm = "";
+
+// Send a get request to the server for html containing one page of search
+// results, and show it. The first page replaces whatever was there before;
+// later ones go on the end of the table, so earlier pages stay in view.
+function showProjectSearchResults(searchTerm, page) {
+    var encodedSearchTerm = encodeURIComponent(searchTerm);
+
+    $.get("/projects/search-results?search=" + encodedSearchTerm + "&page=" + page,
+        function(results) {
+            if (page > 1) {
+                var newPage = $("<div>").html(results);
+
+                $("#project-search-results tbody").append(newPage.find("tbody tr"));
+
+                // Swap the button for the one that asks for the page after
+                // this. Past the last page, there isn't one.
+                $("#more-projects").remove();
+                $("#project-search-results").append(newPage.find("#more-projects"));
+            }
+
+            else if (results.indexOf("td") > -1) {
+                $("#project-search-results").html(results);
+            }
+
+            else {
+                $("#project-search-results").html("<i>I'm sorry, I couldn't find any matching projects! Please try again.</i><br>");
+                $("#project-search-results").append("<img src=\"https://s-media-cache-ak0.pinimg.com/736x/29/d1/1c/29d11cff4795c805abc6010a1690916b.jpg\"></img>");
+            }
+    });
+}
+
 $("#search-projects").on("click", function () {
 
     // Get the search term.
@@ -15,23 +48,18 @@ $("#search-projects").on("click", function () {
         $("#project-search-results").html("");
     }
 
-    // Otherwise, encode search term, create a URL, and send a get request
-    // to the server for html containing the search results.
+    // Otherwise, ask the server for the first page of results.
     else{
-        encodedSearchTerm = encodeURIComponent(searchTerm);
+        currentSearchTerm = searchTerm;
 
         $("#search-active-head").html("Click title links to view matching project pages.");
 
-        $.get("/projects/search-results?search=" + encodedSearchTerm,
-            function(results) {
-                if (results.indexOf("td") > -1) {
-                    $("#project-search-results").html(results);
-                }
-
-                else {
-                    $("#project-search-results").html("<i>I'm sorry, I couldn't find any matching projects! Please try again.</i><br>");
-                    $("#project-search-results").append("<img src=\"https://s-media-cache-ak0.pinimg.com/736x/29/d1/1c/29d11cff4795c805abc6010a1690916b.jpg\"></img>");
-                }
-        });
+        showProjectSearchResults(searchTerm, 1);
     }
-});
\ No newline at end of file
+});
+
+// The "More Projects" button comes and goes with the results, so listen for
+// clicks on the results section instead of the button itself.
+$("#project-search-results").on("click", "#more-projects", function () {
+    showProjectSearchResults(currentSearchTerm, $(this).data("page"));
+});
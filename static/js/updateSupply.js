@@ -3,8 +3,6 @@
 ///////////////////////////////////////////////
 
 
-// Get ALL the update buttons!
-var update_buttons = $(".update-item");
 
 // State variable; we'll use this to decide whether the user has begun updating
 // or is done updating.
@@ -13,8 +11,10 @@ var prevButtonID;
 
 
 // Add an event listener to all the update buttons to get the id and send it
-// to the server. Each button id corresponds to an item in the db.
-update_buttons.on("click", function(evt) {
+// to the server. Each button id corresponds to an item in the db. Listen on the
+// inventory table, so buttons in rows loaded later work too. This script runs
+// every time the table is rendered, so drop the old listener first.
+$("#inv-table").off("click", ".update-item").on("click", ".update-item", function(evt) {
 
     // Prepare selector strings derived from button id.
     var buttonID = $(this).attr("id");
@@ -45,7 +45,15 @@ update_buttons.on("click", function(evt) {
 
         else if ($.isNumeric($(field).val()) || ($(field).val() === "")) {
             updating = false;
-            $.post("/update-item", {"qty": $(field).val(), "itemID": buttonID}, function(data) {
+            // Ask for JSON, so we hear exactly what changed and can keep the
+            // dashboard's copy of the inventory up to date.
+            $.post("/update-item", {"qty": $(field).val(), "itemID": buttonID}, function(response) {
+                var data = response.message;
+
+                if (typeof applyInventoryChange === "function") {
+                    applyInventoryChange(response.change);
+                }
+
                 $(field).toggle();
                 $(col).html(data);
 
@@ -62,7 +70,7 @@ update_buttons.on("click", function(evt) {
                     $(col).append('<div id="success" style="color:green"><i>Successfully updated!</i></div>');
                     $("#success").fadeOut(1000);
                 }
-            });
+            }, "json");
 
             // Remake the chart in the image of our new data. All hail the database,
             // source of truth.
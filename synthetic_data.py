@@ -0,0 +1,326 @@
+"""Generate large, realistic seed files for Crafter's Closet.
+
+Writes u.user, u.supplydetail, u.project, u.projectsupply, and u.item files
+in the same format as the ones in seed_data/, at whatever scale we ask for,
+ready for seed.py --bulk:
+
+    python synthetic_data.py /tmp/big_seed --users 10000 --items 5000000
+    python seed.py --bulk --seed-dir /tmp/big_seed
+
+The data is skewed the way real inventories are. A few popular brands carry
+big color lines and show up in most inventories, most colors are long-tail
+ones hardly anybody owns, and a few power users own far more than everybody
+else. The same seed always writes the same files.
+
+Everything streams, so memory doesn't grow with the number of rows. The one
+exception is the set of supplies the user being written owns, so it's bounded
+by the biggest single inventory.
+"""
+
+from fractions import gcd
+import argparse
+import os
+import random
+
+from seed_data.cc_parsing_scripts import expand_colors
+
+# The real catalog the synthetic one grows out of.
+REAL_CATALOG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "seed_data", "u.supplydetail")
+
+# How skewed things are. Bigger is more skewed. Brand sizes and user
+# inventory sizes fall off like a Zipf distribution with these exponents...
+BRAND_SIZE_SKEW = 0.5
+USER_SKEW = 1.0
+
+# ...and picks of brands, colors within a brand, and project owners are
+# uniform numbers raised to these powers, which bunches them up near the most
+# popular end. A skew of 3 puts half the picks in the first eighth.
+BRAND_PICK_SKEW = 2.0
+COLOR_PICK_SKEW = 3.0
+OWNER_PICK_SKEW = 2.0
+
+# A brand carries this many colors on average.
+COLORS_PER_BRAND = 150
+
+SUPPLIES_PER_PROJECT = (1, 8)
+
+PROJECT_THINGS = ["Scarf", "Bowl", "Necklace", "Sweater", "Dragon", "Coasters",
+                  "Wall Hanging", "Pillow", "Bracelet", "Ornament", "Mittens", "Mobile"]
+
+
+def apportion(total, weights):
+    """Generate integer shares of total in proportion to weights, which must
+    be a function that can be called more than once to iterate them. The
+    shares always add up to total exactly."""
+
+    weight_sum = sum(weights())
+    cumulative = 0.0
+    given = 0
+
+    for weight in weights():
+        cumulative += weight
+        share = int(total * cumulative / weight_sum) - given
+        given += share
+
+        yield share
+
+
+def load_real_catalog(path=REAL_CATALOG):
+    """Return the real catalog's brands, as (brand, supply type, units), most
+    colors first, and all its distinct colors, in the order they first
+    appear."""
+
+    brand_sizes = {}
+    colors = []
+    seen = set()
+
+    with open(path) as catalog_file:
+        for line in catalog_file:
+            if not line.strip():
+                continue
+
+            sd_id, supply_type, brand, color, units, purchase_url = line.rstrip("\n").split(",")
+
+            key = (brand, supply_type, units)
+            brand_sizes[key] = brand_sizes.get(key, 0) + 1
+
+            # The catalog's unique key ignores case, so our colors should too.
+            if color and color.lower() not in seen:
+                seen.add(color.lower())
+                colors.append(color)
+
+    brands = sorted(brand_sizes, key=lambda key: (-brand_sizes[key], key))
+
+    return brands, colors
+
+
+class SyntheticCatalog(object):
+    """A catalog of supply details, laid out brand by brand, most popular
+    brand first, each brand's colors most popular first.
+
+    Brands are the real catalog's, with numbered lines added ("Americana 2")
+    when we need more. Colors are the real catalog's colors, started at a
+    different point for each brand, with numbered shades ("Cool White 2") once
+    a brand runs through them all. Only where each brand starts is kept in
+    memory, so any supply can be looked up, or picked at random, by its id.
+    """
+
+    def __init__(self, size, colors_per_brand=COLORS_PER_BRAND, real_catalog=REAL_CATALOG):
+        self.size = size
+        real_brands, self.colors = load_real_catalog(real_catalog)
+
+        brand_count = max(1, min(size, -(-size // colors_per_brand)))
+
+        # Ids start at 1, like everywhere else in the database.
+        self.brands = []
+        start = 1
+
+        weights = lambda: (1.0 / (b + 1) ** BRAND_SIZE_SKEW for b in xrange(brand_count))
+
+        for b, brand_size in enumerate(apportion(size, weights)):
+            # Rounding can leave a brand with no colors at all.
+            if not brand_size:
+                continue
+
+            brand, supply_type, units = real_brands[b % len(real_brands)]
+
+            if b >= len(real_brands):
+                brand = "%s %d" % (brand, b // len(real_brands) + 1)
+
+            self.brands.append((start, brand_size, brand, supply_type, units))
+            start += brand_size
+
+    def __len__(self):
+        return self.size
+
+    def get_color(self, b, j):
+        """Return the name of color j of brand number b."""
+
+        color = self.colors[(j + b * 37) % len(self.colors)]
+
+        if j >= len(self.colors):
+            color = "%s %d" % (color, j // len(self.colors) + 1)
+
+        return color
+
+    def get_supply(self, sd_id):
+        """Return (supply_type, brand, color, units) for a supply detail id."""
+
+        b = self.find_brand(sd_id)
+        start, brand_size, brand, supply_type, units = self.brands[b]
+
+        return supply_type, brand, self.get_color(b, sd_id - start).title(), units
+
+    def find_brand(self, sd_id):
+        """Return the number of the brand a supply detail id belongs to."""
+
+        low, high = 0, len(self.brands) - 1
+
+        while low < high:
+            middle = (low + high + 1) // 2
+
+            if self.brands[middle][0] <= sd_id:
+                low = middle
+            else:
+                high = middle - 1
+
+        return low
+
+    def iter_rows(self):
+        """Generate the catalog's u.supplydetail lines, in id order."""
+
+        for b, (start, brand_size, brand, supply_type, units) in enumerate(self.brands):
+            colors = (self.get_color(b, j) for j in xrange(brand_size))
+
+            for row in expand_colors(colors, start, supply_type, brand, units):
+                yield row
+
+    def pick(self, rng):
+        """Pick a supply detail id at random, favoring popular brands and
+        colors."""
+
+        b = int(len(self.brands) * rng.random() ** BRAND_PICK_SKEW)
+        start, brand_size, _, _, _ = self.brands[b]
+
+        return start + int(brand_size * rng.random() ** COLOR_PICK_SKEW)
+
+    def pick_distinct(self, rng, count):
+        """Generate count different supply detail ids, chosen at random."""
+
+        count = min(count, self.size)
+
+        # Picking at random gets slow once most of the catalog is taken. Past
+        # that, walk the whole catalog from a random start with a random
+        # stride that visits every id exactly once.
+        if count > self.size // 2:
+            start = rng.randrange(self.size)
+            stride = rng.randrange(1, self.size + 1)
+
+            while gcd(stride, self.size) != 1:
+                stride = rng.randrange(1, self.size + 1)
+
+            for i in xrange(count):
+                yield (start + i * stride) % self.size + 1
+
+            return
+
+        picked = set()
+
+        while len(picked) < count:
+            sd_id = self.pick(rng)
+
+            if sd_id not in picked:
+                picked.add(sd_id)
+                yield sd_id
+
+
+def generate_seed_files(seed_dir, users=1000, supply_details=100000, items=1000000,
+                        projects=10000, seed=0):
+    """Write a full set of u.* seed files into seed_dir. Returns how many rows
+    went into each file, by filename.
+
+    Items are shared out among users so that user 1 owns the most. Nobody
+    can own more supplies than the catalog has, so if there are more items
+    than every user owning the whole catalog allows, the rest don't get
+    written.
+    """
+
+    if not os.path.isdir(seed_dir):
+        os.makedirs(seed_dir)
+
+    catalog = SyntheticCatalog(supply_details)
+    counts = {}
+
+    def write(filename, lines):
+        count = 0
+
+        with open(os.path.join(seed_dir, filename), "w") as seed_file:
+            for line in lines:
+                seed_file.write(line)
+                count += 1
+
+        counts[filename] = count
+
+    # Each file gets its own random numbers, so changing how one is made
+    # doesn't change the others.
+    def get_rng(n):
+        return random.Random(seed * 10 + n)
+
+    write("u.user", ("%d,crafter%d@example.com,crafter%d,\n" % (user_id, user_id, user_id)
+                     for user_id in xrange(1, users + 1)))
+
+    write("u.supplydetail", catalog.iter_rows())
+
+    write("u.item", generate_item_lines(catalog, users, items, get_rng(1)))
+
+    # Projects and their supplies get written side by side.
+    rng = get_rng(2)
+    project_supplies = 0
+
+    with open(os.path.join(seed_dir, "u.project"), "w") as project_file, \
+            open(os.path.join(seed_dir, "u.projectsupply"), "w") as supply_file:
+
+        for project_id in xrange(1, projects + 1):
+            user_id = int(users * rng.random() ** OWNER_PICK_SKEW) + 1
+            sd_ids = list(catalog.pick_distinct(rng, rng.randint(*SUPPLIES_PER_PROJECT)))
+
+            supply_type, brand, color, units = catalog.get_supply(sd_ids[0])
+            thing = rng.choice(PROJECT_THINGS)
+
+            # Seed files are split on commas, so descriptions can't have any.
+            project_file.write("%d,%s %s,%d,,,%s made with %s %s.\n" % (
+                project_id, color, thing, user_id, thing, brand, supply_type))
+
+            for sd_id in sd_ids:
+                project_supplies += 1
+                supply_file.write("%d,%d,%d,%d\n" % (project_supplies, project_id, sd_id,
+                                                      rng.randint(1, 10)))
+
+    counts["u.project"] = projects
+    counts["u.projectsupply"] = project_supplies
+
+    return counts
+
+
+def generate_item_lines(catalog, users, items, rng):
+    """Generate u.item lines for items items, shared out among users, most
+    to user 1."""
+
+    item_id = 1
+    weights = lambda: (1.0 / user_id ** USER_SKEW for user_id in xrange(1, users + 1))
+
+    # Whatever a user can't own, because they already own the whole catalog,
+    # goes to the next user.
+    left_over = 0
+
+    for user_id, share in enumerate(apportion(items, weights), 1):
+        count = min(share + left_over, len(catalog))
+        left_over += share - count
+
+        for sd_id in catalog.pick_distinct(rng, count):
+            # Most people have a little of most things.
+            qty = 1 + int(49 * rng.random() ** 2)
+
+            yield "%d,%d,%d,%d\n" % (item_id, user_id, sd_id, qty)
+            item_id += 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic seed files for "
+                                                 "Crafter's Closet.")
+    parser.add_argument("seed_dir", help="directory to write the u.* files into")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--supplies", type=int, default=100000,
+                        help="supply details in the catalog")
+    parser.add_argument("--items", type=int, default=1000000,
+                        help="items across all users' inventories")
+    parser.add_argument("--projects", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    counts = generate_seed_files(args.seed_dir, args.users, args.supplies, args.items,
+                                 args.projects, args.seed)
+
+    for filename, count in sorted(counts.items()):
+        print "%s: %d rows" % (filename, count)
@@ -8,9 +8,30 @@
 
 
 import unittest
+import zlib
 from server import app
 from flask import json
-from model import db, example_data, connect_to_db
+from model import (db, example_data, connect_to_db, Project, User, SupplyDetail,
+                   ItemDeletion, unit_of_work, on_commit, ITEM_DELETION_RETENTION)
+from seed import bulk_load_all
+from cache import VersionedCache, catalog_cache
+from helpers import (search_projects, get_matching_sd, get_matching_sds, get_fuzzy_matching_sd,
+                     add_user_to_db, get_craft_project_supplies_info, PROJECT_SEARCH_PAGE_SIZE)
+from search_index import TagIndex, ProjectSearchIndex, inventory_tag_indexes
+from engine_profiles import (get_engine_options, get_pool_stats, TimedQueuePool,
+                             PingingQueuePool)
+from sqlalchemy import create_engine
+from query_stats import (fingerprint, query_budget, QueryBudgetExceeded, SQL_QUERY_BUDGET,
+                         SQL_TIME_BUDGET, SQL_REPEAT_BUDGET)
+from benchmark import percentile, find_regressions, format_size
+from synthetic_data import SyntheticCatalog, generate_seed_files
+from load_test import StepStats, VirtualUser, JourneyFailed, run_users
+import Queue
+import filecmp
+import os
+import random
+import shutil
+import tempfile
 
 
 ######################################################################
@@ -39,6 +60,325 @@ class CCTestsBasic(unittest.TestCase):
         self.assertIn("Welcome to Crafter's Closet!", result.data)
 
 
+class CCTestsVersionedCache(unittest.TestCase):
+    """Tests for the in-process caches in cache.py."""
+
+    def test_bump_version_invalidates(self):
+        cache = VersionedCache()
+        self.assertEqual(cache.get_or_compute("key", lambda: 1), 1)
+        self.assertEqual(cache.get_or_compute("key", lambda: 2), 1)
+
+        cache.bump_version()
+        self.assertEqual(cache.get_or_compute("key", lambda: 3), 3)
+
+    def test_stale_version_not_stored(self):
+        """A value computed before a bump shouldn't be cached after it."""
+        cache = VersionedCache()
+        version = cache.version
+        cache.bump_version()
+        cache.set("key", "stale", version)
+        self.assertIsNone(cache.get("key"))
+
+    def test_ttl_expires_entries(self):
+        cache = VersionedCache(ttl=0)
+        cache.set("key", "value")
+        self.assertIsNone(cache.get("key"))
+
+    def test_lru_eviction(self):
+        cache = VersionedCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        # Touch "a", so "b" is the least recently used entry.
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+
+class CCTestsTagIndex(unittest.TestCase):
+    """Tests for the autocomplete index in search_index.py."""
+
+    def setUp(self):
+        self.index = TagIndex()
+
+        for tag in ["Acrylic Paint", "Americana", "Calypso Blue", "Terra Cotta"]:
+            self.index.add(tag)
+
+    def test_prefix_of_any_word(self):
+        self.assertEqual(self.index.search("pa"), ["Acrylic Paint"])
+        self.assertEqual(self.index.search("Am"), ["Americana"])
+
+    def test_substring_fallback_after_prefixes(self):
+        """Tags that only contain the term come after tags with a word
+        starting with it."""
+        self.assertEqual(self.index.search("c"),
+                         ["Calypso Blue", "Terra Cotta", "Acrylic Paint", "Americana"])
+
+    def test_limit(self):
+        self.assertEqual(len(self.index.search("", limit=2)), 2)
+
+    def test_remove_is_reference_counted(self):
+        self.index.add("Americana")
+        self.index.remove("Americana")
+        self.assertEqual(self.index.search("amer"), ["Americana"])
+
+        self.index.remove("Americana")
+        self.assertEqual(self.index.search("amer"), [])
+
+    def test_extending_a_term_matches_a_fresh_search(self):
+        """Searches answered from an earlier, shorter term's results should
+        come out just like searches of the whole index."""
+
+        self.index.search("c")
+        self.index.search("a")
+
+        fresh = TagIndex()
+
+        for tag in ["Acrylic Paint", "Americana", "Calypso Blue", "Terra Cotta"]:
+            fresh.add(tag)
+
+        for term in ["ca", "co", "ame", "a p", "ana", "cx"]:
+            self.assertEqual(self.index.search(term), fresh.search(term))
+
+    def test_remembered_results_follow_new_tags(self):
+        self.assertEqual(self.index.search("cal"), ["Calypso Blue"])
+
+        self.index.add("Calico")
+        self.assertEqual(self.index.search("cal"), ["Calico", "Calypso Blue"])
+        self.assertEqual(self.index.search("cali"), ["Calico"])
+
+
+class CCTestsProjectSearchIndex(unittest.TestCase):
+    """Tests for the in-memory project search index in search_index.py."""
+
+    def setUp(self):
+        self.index = ProjectSearchIndex()
+        self.index.add_project(1, "Terra Cotta Bowl", "A clay bowl.",
+                               ["Oven-Bake Clay", "Sculpey", "Terra Cotta"])
+        self.index.add_project(2, "Clay Dragon", None,
+                               ["Oven-Bake Clay", "Sculpey", "Blue"])
+
+    def test_matches_substrings_in_any_field(self):
+        self.assertEqual(self.index.search("ulpe"),
+                         [("Clay Dragon", None, 2), ("Terra Cotta Bowl", "A clay bowl.", 1)])
+        self.assertEqual(self.index.search("blue"), [("Clay Dragon", None, 2)])
+        self.assertEqual(self.index.search("foobar"), [])
+
+    def test_title_matches_rank_first(self):
+        results = self.index.search("dragon")
+        self.assertEqual([project_id for _, _, project_id in results], [2])
+
+        results = self.index.search("bowl")
+        self.assertEqual([project_id for _, _, project_id in results], [1])
+
+        # Both projects use clay, but a title match beats a description match.
+        results = self.index.search("clay")
+        self.assertEqual([project_id for _, _, project_id in results], [2, 1])
+
+    def test_short_terms(self):
+        self.assertEqual(len(self.index.search("cl")), 2)
+
+
+class CCTestsEngineProfiles(unittest.TestCase):
+    """Tests for the engine settings and pool stats in engine_profiles.py."""
+
+    def test_web_profile_on_postgres(self):
+        options = get_engine_options("postgresql:///crafterscloset")
+
+        self.assertIs(options["poolclass"], PingingQueuePool)
+        self.assertEqual(options["isolation_level"], "READ COMMITTED")
+        self.assertIn("statement_timeout=5000", options["connect_args"]["options"])
+
+    def test_seed_profile_has_no_statement_timeout(self):
+        options = get_engine_options("postgresql:///crafterscloset", "seed")
+
+        self.assertIs(options["poolclass"], TimedQueuePool)
+        self.assertEqual(options["pool_size"], 1)
+        self.assertNotIn("connect_args", options)
+
+    def test_overrides_and_sqlite(self):
+        options = get_engine_options("postgresql:///testdb", "test", pool_size=7)
+        self.assertEqual(options["pool_size"], 7)
+
+        self.assertEqual(get_engine_options("sqlite:///test.db", "web"), {})
+        self.assertRaises(ValueError, get_engine_options, "sqlite://", "nonsense")
+
+    def test_pool_stats(self):
+        engine = create_engine("sqlite://", poolclass=PingingQueuePool, pool_size=2)
+
+        first = engine.connect()
+        second = engine.connect()
+        stats = get_pool_stats(engine)
+
+        self.assertEqual(stats["pool_class"], "PingingQueuePool")
+        self.assertEqual(stats["checked_out"], 2)
+        self.assertEqual(stats["overflow"], 0)
+        self.assertEqual(stats["checkouts"], 2)
+        self.assertEqual(stats["timeouts"], 0)
+
+        first.close()
+        second.close()
+        stats = get_pool_stats(engine)
+
+        self.assertEqual(stats["checked_out"], 0)
+        self.assertEqual(stats["checked_in"], 2)
+
+
+class CCTestsQueryStats(unittest.TestCase):
+    """Tests for the SQL tracking in query_stats.py."""
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint("SELECT * FROM items\n WHERE item_id = 12"),
+                         fingerprint("SELECT * FROM items WHERE item_id = 7"))
+        self.assertEqual(fingerprint("SELECT * FROM items WHERE brand = 'Sculpey'"),
+                         "SELECT * FROM items WHERE brand = ?")
+        self.assertEqual(fingerprint("SELECT * FROM items WHERE item_id IN (%(a)s, %(b)s)"),
+                         "SELECT * FROM items WHERE item_id IN (?)")
+
+    def test_query_budget_catches_loops(self):
+        engine = create_engine("sqlite://")
+
+        with query_budget(queries=10) as stats:
+            engine.execute("SELECT 1")
+            engine.execute("SELECT 2")
+
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.get_repeated(1), [("SELECT ?", 2)])
+
+        with self.assertRaises(QueryBudgetExceeded):
+            with query_budget(repeats=5):
+                for i in range(6):
+                    engine.execute("SELECT %d" % i)
+
+
+class CCTestsBenchmark(unittest.TestCase):
+    """Tests for the number crunching in benchmark.py."""
+
+    def test_percentile(self):
+        values = range(100, 0, -1)
+
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+
+    def test_find_regressions(self):
+        base = {"p50": 10.0, "p95": 20.0, "p99": 40.0, "queries": 3}
+        baseline = {"1000": {"dashboard": base}}
+
+        # Small wobbles, and routes with no baseline, don't count.
+        results = {"1000": {"dashboard": dict(base, p50=14.0),
+                            "project page": dict(base, p50=500.0)}}
+        self.assertEqual(find_regressions(results, baseline), [])
+
+        results = {"1000": {"dashboard": dict(base, p95=30.0, queries=4)}}
+        regressions = find_regressions(results, baseline)
+
+        self.assertEqual(len(regressions), 2)
+        self.assertIn("dashboard at 1k items: p95", regressions[0])
+
+    def test_format_size(self):
+        self.assertEqual(format_size(1000000), "1M")
+        self.assertEqual(format_size(1500), "1500")
+
+
+class CCTestsLoadTest(unittest.TestCase):
+    """Tests for collecting results in load_test.py."""
+
+    def test_step_stats_merge(self):
+        stats = StepStats()
+        stats.record("login", 12.0)
+        stats.record("login", 30.0, "HTTP 500")
+
+        other = StepStats()
+        other.record("login", 20.0)
+        other.record("dashboard", 5.0)
+
+        stats.merge(other.as_dict())
+
+        self.assertEqual(sorted(stats.latencies["login"]), [12.0, 20.0, 30.0])
+        self.assertEqual(stats.latencies["dashboard"], [5.0])
+        self.assertEqual(stats.errors, {"login": ["HTTP 500"]})
+
+    def test_unreachable_server_fails_step(self):
+        stats = StepStats()
+        user = VirtualUser("http://127.0.0.1:1", "nobody", [], stats, random.Random(0))
+
+        self.assertRaises(JourneyFailed, user.request, "login", "/login")
+        self.assertEqual(len(stats.errors["login"]), 1)
+
+    def test_broken_journey_is_recorded(self):
+        def run_journey(self):
+            raise ValueError("No JSON object could be decoded")
+
+        original = VirtualUser.run_journey
+        VirtualUser.run_journey = run_journey
+        results = Queue.Queue()
+
+        try:
+            run_users("http://127.0.0.1:1", [], 1, 0.2, 0, 0, 0, 0, results)
+
+        finally:
+            VirtualUser.run_journey = original
+
+        errors = results.get()["errors"]
+
+        # After failing, the thread backs off instead of trying again at once.
+        self.assertEqual(errors, {"journey": ["ValueError: No JSON object could be decoded"]})
+
+
+class CCTestsSyntheticData(unittest.TestCase):
+    """Tests for the seed file generator in synthetic_data.py."""
+
+    def setUp(self):
+        self.seed_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.seed_dir)
+
+    def read_rows(self, filename, seed_dir=None):
+        with open(os.path.join(seed_dir or self.seed_dir, filename)) as seed_file:
+            return [line.rstrip("\n").split(",") for line in seed_file]
+
+    def test_catalog_supplies_are_distinct(self):
+        catalog = SyntheticCatalog(5000)
+        rows = [row.split(",") for row in catalog.iter_rows()]
+
+        self.assertEqual([int(row[0]) for row in rows], range(1, 5001))
+        self.assertEqual(len(set(tuple(field.lower() for field in row[1:4]) for row in rows)), 5000)
+
+        # Looking a supply up by id agrees with the file.
+        self.assertEqual(list(catalog.get_supply(4321)), rows[4320][1:5])
+
+    def test_generate_seed_files(self):
+        counts = generate_seed_files(self.seed_dir, users=20, supply_details=500, items=3000,
+                                     projects=15, seed=3)
+
+        self.assertEqual(counts["u.item"], 3000)
+        self.assertEqual(counts["u.user"], 20)
+
+        items = self.read_rows("u.item")
+        owned = [(user_id, sd_id) for item_id, user_id, sd_id, qty in items]
+
+        # Nobody owns the same supply twice, and user 1 owns the most.
+        self.assertEqual(len(set(owned)), 3000)
+        self.assertEqual(sum(1 for user_id, _ in owned if user_id == "1"), 500)
+        self.assertTrue(all(len(row) == 6 for row in self.read_rows("u.project")))
+
+    def test_same_seed_same_files(self):
+        other_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other_dir)
+
+        generate_seed_files(self.seed_dir, users=5, supply_details=300, items=400, projects=5, seed=1)
+        generate_seed_files(other_dir, users=5, supply_details=300, items=400, projects=5, seed=1)
+
+        for filename in os.listdir(self.seed_dir):
+            self.assertTrue(filecmp.cmp(os.path.join(self.seed_dir, filename),
+                                        os.path.join(other_dir, filename), shallow=False))
+
+
 ######################################################################
 # Tests that require an active session, but no database access.
 ######################################################################
@@ -80,7 +420,9 @@ class CCTestsDatabaseQueriesNoSession(unittest.TestCase):
         self.client = app.test_client()
         app.config['TESTING'] = True
 
-        connect_to_db(app, "postgresql:///testdb")
+        connect_to_db(app, "postgresql:///testdb", profile="test")
+
+        use_strict_sql_budgets()
 
         db.create_all()
         example_data()
@@ -90,6 +432,7 @@ class CCTestsDatabaseQueriesNoSession(unittest.TestCase):
 
         db.session.close()
         db.drop_all()
+        reset_sql_budgets()
 
     def test_get_brands_by_type(self):
         result = self.client.get("/dashboard/brands")
@@ -109,6 +452,90 @@ class CCTestsDatabaseQueriesNoSession(unittest.TestCase):
         result = self.client.get("/dashboard/units")
         self.assertEqual(result.mimetype, 'application/json')
 
+    def test_get_units_by_type(self):
+        """Each supply type should map to its unit of measure."""
+
+        result = self.client.get("/dashboard/units")
+        data = json.loads(result.data)
+        self.assertEqual(data, {"Acrylic Paint": "oz", "Oven-Bake Clay": "oz"})
+
+    def test_get_colors_by_brand(self):
+        """Try to get all colors in the db by brand, for the project form."""
+
+        result = self.client.get("/add-project/colors-by-brand")
+        data = json.loads(result.data)
+        self.assertEqual(data["Sculpey"], ["Terra Cotta", "White"])
+        self.assertEqual(data["Americana"], ["Bittersweet Chocolate", "Calypso Blue"])
+
+    def test_typed_brands_leave_catalog_cached(self):
+        """However many brands get typed into the colors typeahead, the
+        catalog itself should stay cached."""
+
+        self.client.get("/typeahead/colors-by-brand?brand=Sculpey")
+        self.assertIsNotNone(catalog_cache.get("facets"))
+
+        for i in range(300):
+            self.client.get("/typeahead/colors-by-brand?brand=brand%d" % i)
+
+        self.assertIsNotNone(catalog_cache.get("facets"))
+
+        # Brands are matched the same way however they're typed.
+        result = self.client.get("/typeahead/colors-by-brand?brand=%20SCULPEY")
+        self.assertEqual(json.loads(result.data), ["Terra Cotta", "White"])
+
+    def test_catalog_json_not_modified(self):
+        """Catalog JSON should carry an ETag, and asking again with that ETag
+        should get an empty 304."""
+
+        result = self.client.get("/dashboard/brands")
+        etag = result.headers["ETag"]
+        self.assertIn("no-cache", result.headers["Cache-Control"])
+
+        result = self.client.get("/dashboard/brands", headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.data, "")
+
+    def test_catalog_json_compressed(self):
+        """Browsers that take gzip should get it, with an ETag of its own that
+        still gets a 304 when it matches."""
+
+        min_size = app.config["COMPRESS_MIN_SIZE"]
+        app.config["COMPRESS_MIN_SIZE"] = 0
+        self.addCleanup(app.config.__setitem__, "COMPRESS_MIN_SIZE", min_size)
+
+        plain = self.client.get("/dashboard/brands")
+        result = self.client.get("/dashboard/brands", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(result.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", result.headers["Vary"])
+        self.assertEqual(zlib.decompress(result.data, 16 + zlib.MAX_WBITS), plain.data)
+        self.assertNotEqual(result.headers["ETag"], plain.headers["ETag"])
+
+        result = self.client.get("/dashboard/brands",
+                                 headers={"Accept-Encoding": "gzip",
+                                          "If-None-Match": result.headers["ETag"]})
+        self.assertEqual(result.status_code, 304)
+
+    def test_small_responses_not_compressed(self):
+        """Responses under the size threshold should go out as they are."""
+
+        result = self.client.get("/dashboard/units", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", result.headers)
+
+    def test_matching_sd_is_exact(self):
+        """Supply lookups should ignore case and whitespace, but not match
+        partial words unless asked to."""
+
+        sd = get_matching_sd(" oven-bake CLAY", "sculpey", "terra cotta ")
+        self.assertEqual(sd.sd_id, 1)
+
+        self.assertIsNone(get_matching_sd("Oven-Bake Clay", "Sculpey", "Terra"))
+        self.assertEqual(get_fuzzy_matching_sd("Oven-Bake Clay", "Sculpey", "Terra").sd_id, 1)
+
+        sds = get_matching_sds([("Acrylic Paint", "Americana", "calypso blue"),
+                                ("Acrylic Paint", "Americana", "Calypso")])
+        self.assertEqual([sd.sd_id for sd in sds.values()], [4])
+
     def test_get_colors_for_typeahead(self):
         """Try to get the colors by brand for typeahead fields."""
 
@@ -145,7 +572,9 @@ class CCTestsDatabaseQueriesOnlyWithSession(unittest.TestCase):
         self.client = app.test_client()
         app.config['TESTING'] = True
 
-        connect_to_db(app, "postgresql:///testdb")
+        connect_to_db(app, "postgresql:///testdb", profile="test")
+
+        use_strict_sql_budgets()
 
         db.create_all()
         example_data()
@@ -157,6 +586,8 @@ class CCTestsDatabaseQueriesOnlyWithSession(unittest.TestCase):
 
         db.session.close()
         db.drop_all()
+        reset_sql_budgets()
+        app.config['PROJECT_SEARCH_PAGE_SIZE'] = PROJECT_SEARCH_PAGE_SIZE
 
     def test_login(self):
         # /login redirects to /dashboard on success, so need to follow
@@ -174,6 +605,29 @@ class CCTestsDatabaseQueriesOnlyWithSession(unittest.TestCase):
         self.assertIn("clay", result.data)
         self.assertNotIn("sorry", result.data)
 
+    def test_project_search_pages(self):
+        """Project search results should come back a page at a time."""
+        result = self.client.get("/projects/search-results?search=bowl")
+        self.assertIn("Terra Cotta Bowl", result.data)
+        self.assertIn("Blue Clay Bowl", result.data)
+        self.assertNotIn("more-projects", result.data)
+
+        projects, has_more = search_projects("bowl", page=1, per_page=1)
+        self.assertEqual(len(projects), 1)
+        self.assertTrue(has_more)
+
+        projects, has_more = search_projects("bowl", page=2, per_page=1)
+        self.assertEqual(len(projects), 1)
+        self.assertFalse(has_more)
+
+    def test_project_search_clamps_page(self):
+        """A page before the first gets the first, and links to the second."""
+
+        app.config['PROJECT_SEARCH_PAGE_SIZE'] = 1
+
+        result = self.client.get("/projects/search-results?search=bowl&page=-3")
+        self.assertIn('data-page="2"', result.data)
+
     def test_project_search_no_projects(self):
         """Search for a term where matching projects should NOT be in db."""
         result = self.client.get("/projects/search-results?search=foobar")
@@ -186,6 +640,23 @@ class CCTestsDatabaseQueriesOnlyWithSession(unittest.TestCase):
         result = self.client.get("/supply-types")
         self.assertEqual(result.mimetype, 'application/json')
 
+    def test_strict_mode(self):
+        """Requests that go over their SQL budget should fail in the tests."""
+
+        app.config['SQL_QUERY_BUDGET'] = 1
+
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get("/dashboard")
+
+    def test_project_supplies_in_one_query(self):
+        """Comparing a project's supplies to an inventory shouldn't query per
+        supply."""
+
+        project = Project.query.get(1)
+
+        with query_budget(queries=1, repeats=1):
+            get_craft_project_supplies_info(project, 1)
+
     def test_get_filtered_inventory(self):
         """Try to get the user's filtered inventory when the users picks a filter
         dropdown on the dashboard."""
@@ -201,6 +672,64 @@ class CCTestsDatabaseQueriesOnlyWithSession(unittest.TestCase):
         self.assertIn("Paint", result.data)
         self.assertNotIn("Clay", result.data)
 
+    def test_inventory_pages(self):
+        """Paging through the inventory should return every row once, in
+        order, and then stop."""
+
+        user = User.query.get(1)
+        first_page, next_page = user.get_inventory(page_size=1)
+        second_page, last_page = user.get_inventory(next_page, page_size=1)
+
+        self.assertEqual([row.color for row in first_page], ["Calypso Blue"])
+        self.assertEqual([row.color for row in second_page], ["Terra Cotta"])
+        self.assertIsNone(last_page)
+
+    def test_inventory_query_is_composable(self):
+        """Filters and search terms should combine, and the rows should come
+        back sorted by the database."""
+
+        user = User.query.get(1)
+
+        rows = user.query_inventory(supply_type="Oven-Bake Clay", search_term="cotta").all()
+        self.assertEqual([row.color for row in rows], ["Terra Cotta"])
+
+        rows = list(user.iter_inventory(batch_size=1))
+        self.assertEqual([row.supply_type for row in rows], ["Acrylic Paint", "Oven-Bake Clay"])
+
+    def test_inventory_page_request(self):
+        """Asking for a later page should only send table rows."""
+
+        user = User.query.get(1)
+        _, next_page = user.get_inventory(page_size=1)
+
+        result = self.client.get("/inventory/filter?brand=&supplytype=&color=&page=" + next_page)
+        self.assertIn("Terra Cotta", result.data)
+        self.assertNotIn("Calypso Blue", result.data)
+        self.assertNotIn("<table", result.data)
+        self.assertNotIn("X-Next-Page", result.headers)
+
+        result = self.client.get("/inventory/search-results?search=a&page=garbage")
+        self.assertEqual(result.status_code, 400)
+
+    def test_inventory_data(self):
+        """The dashboard's copy of the inventory should come column by column,
+        with each type, brand, color, and unit spelled out only once."""
+
+        result = self.client.get("/inventory/data")
+        data = json.loads(result.data)
+
+        self.assertEqual(data["supply_types"], ["Acrylic Paint", "Oven-Bake Clay"])
+        self.assertEqual(data["units"], ["oz"])
+        self.assertEqual(data["rows"]["item_id"], [3, 1])
+        self.assertEqual(data["rows"]["qty"], [5, 10])
+        self.assertEqual(data["rows"]["units"], [0, 0])
+        self.assertEqual([data["colors"][i] for i in data["rows"]["color"]],
+                         ["Calypso Blue", "Terra Cotta"])
+
+        result = self.client.get("/inventory/data",
+                                 headers={"If-None-Match": result.headers["ETag"]})
+        self.assertEqual(result.status_code, 304)
+
     def test_get_inventory_search_ac_tags(self):
         """Try to get autocomplete tags for the inventory search box. Note:
         if the example users' data is ever changed in model.py, this may
@@ -209,6 +738,12 @@ class CCTestsDatabaseQueriesOnlyWithSession(unittest.TestCase):
         result = self.client.get("/inventory/search-autocomplete-tags?search=pa")
         self.assertIn("Acrylic Paint", result.data)
 
+    def test_inventory_search_ac_tags_substring(self):
+        """Autocomplete should still find tags by a piece of a word."""
+
+        result = self.client.get("/inventory/search-autocomplete-tags?search=otta")
+        self.assertEqual(json.loads(result.data), ["Terra Cotta"])
+
     def test_show_project_authenticated(self):
         """Try to show a project page with a user logged in."""
 
@@ -224,6 +759,34 @@ class CCTestsDatabaseQueriesOnlyWithSession(unittest.TestCase):
         # We should not see the sign in button.
         self.assertNotIn("Sign In", result.data)
 
+    def test_shopping_list_for_several_projects(self):
+        """Try to get one shopping list for two projects at once. Supplies the
+        user already has enough of shouldn't show up."""
+
+        result = self.client.get("/projects/shopping-list?project_id=1&project_id=2&project_id=2")
+        shopping_list = json.loads(result.data)["shopping_list"]
+
+        to_buy = {supply["color"]: supply["qty_to_buy"]
+                  for group in shopping_list for supply in group["supplies"]}
+
+        self.assertEqual(to_buy, {"Bittersweet Chocolate": 2, "White": 10})
+        self.assertEqual(sorted(group["brand"] for group in shopping_list),
+                         ["Americana", "Sculpey"])
+
+    def test_project_supplies_list_nets_inventory(self):
+        """The project supply list should say how much of each supply the user
+        owns and how much they still need to buy."""
+
+        project = Project.query.get(1)
+        supplies = project.get_project_supplies_list(1)
+        supplies_by_sd = {supply["sd_id"]: supply for supply in supplies}
+
+        # The user owns more terra cotta clay than needed, but no brown paint.
+        self.assertEqual(supplies_by_sd[1]["qty_owned"], 10)
+        self.assertEqual(supplies_by_sd[1]["qty_to_buy"], 0)
+        self.assertEqual(supplies_by_sd[3]["qty_owned"], 0)
+        self.assertEqual(supplies_by_sd[3]["qty_to_buy"], 2)
+
 
 ######################################################################
 # Tests that require database access, need an active session, and
@@ -243,7 +806,9 @@ class CCTestsDatabaseChanges(unittest.TestCase):
         # possible changes are associated with users.
         add_test_user_to_session(self)
 
-        connect_to_db(app, "postgresql:///testdb")
+        connect_to_db(app, "postgresql:///testdb", profile="test")
+
+        use_strict_sql_budgets()
 
         db.create_all()
         example_data()
@@ -253,6 +818,7 @@ class CCTestsDatabaseChanges(unittest.TestCase):
 
         db.session.close()
         db.drop_all()
+        reset_sql_budgets()
 
     def test_register_user_all_data_okay(self):
         """Test a good registration."""
@@ -308,6 +874,24 @@ class CCTestsDatabaseChanges(unittest.TestCase):
         self.assertIn("this is new!", result.data)
         self.assertIn("Electric Purple", result.data)
 
+    def test_catalog_etag_changes_with_new_supply(self):
+        """Adding a supply the catalog hasn't seen should change its ETag."""
+
+        etag = self.client.get("/add-project/colors-by-brand").headers["ETag"]
+
+        data = {"supplytype": "Acrylic Paint",
+                "brand": "Americana",
+                "color": "Electric Purple",
+                "units": "oz",
+                "quantity-owned": "42"}
+
+        self.client.post("/add-supply", data=data)
+
+        result = self.client.get("/add-project/colors-by-brand",
+                                 headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 200)
+        self.assertIn("Electric Purple", json.loads(result.data)["Americana"])
+
     def test_add_item_where_supply_exists(self):
         """Try to add a supply to user's inventory, where the details are
         already in the db."""
@@ -348,6 +932,97 @@ class CCTestsDatabaseChanges(unittest.TestCase):
 
         self.assertIn(expected_str, result.data)
 
+    def test_inventory_chart_totals(self):
+        """The chart should weight each supply type's total quantity, and
+        supply types without a weight shouldn't break it."""
+
+        self.client.post("/add-supply", data={"supplytype": "Washi Tape",
+                                              "brand": "Tapey",
+                                              "color": "Gold",
+                                              "units": "rolls",
+                                              "quantity-owned": "3"})
+
+        result = self.client.get("/supply-types")
+        data = json.loads(result.data)
+
+        self.assertEqual(data["labels"], ["Acrylic Paint", "Oven-Bake Clay", "Washi Tape"])
+        self.assertEqual(data["datasets"][0]["data"], [2, 5, 3])
+
+    def test_ac_tags_follow_inventory_changes(self):
+        """Autocomplete tags should pick up newly added supplies and drop
+        deleted ones without waiting for the index to be rebuilt."""
+
+        # Build the index before changing anything.
+        result = self.client.get("/inventory/search-autocomplete-tags?search=white")
+        self.assertEqual(json.loads(result.data), [])
+
+        data = {"supplytype": "Oven-Bake Clay",
+                "brand": "Sculpey",
+                "color": "White",
+                "units": "oz",
+                "quantity-owned": "2"}
+        self.client.post("/add-supply", data=data)
+
+        result = self.client.get("/inventory/search-autocomplete-tags?search=white")
+        self.assertEqual(json.loads(result.data), ["White"])
+
+        # Item 1 is the user's only Terra Cotta clay.
+        self.client.post("/update-item", data={"qty": "0", "itemID": "1"})
+
+        result = self.client.get("/inventory/search-autocomplete-tags?search=terra")
+        self.assertEqual(json.loads(result.data), [])
+
+    def test_add_supplies_in_bulk(self):
+        """Try to add a batch of supplies at once: one the user owns, one in the
+        db they don't own, one that's brand new, and one that's broken."""
+
+        supplies = [{"supply_type": "oven-bake clay", "brand": "Sculpey",
+                     "color": "Terra Cotta", "units": "oz", "qty": 3},
+                    {"supply_type": "Acrylic Paint", "brand": "Americana",
+                     "color": "Bittersweet Chocolate", "units": "oz", "qty": 2},
+                    {"supply_type": "Acrylic Paint", "brand": "Americana",
+                     "color": "Electric Purple", "units": "oz", "qty": 4},
+                    {"supply_type": "Acrylic Paint", "brand": "Americana",
+                     "color": "Calypso Blue", "qty": "lots"}]
+
+        result = self.client.post("/add-supplies",
+                                  data=json.dumps({"supplies": supplies}),
+                                  content_type="application/json")
+        results = json.loads(result.data)["results"]
+
+        self.assertEqual([row["status"] for row in results],
+                         ["updated", "added", "created", "error"])
+        self.assertEqual([row["qty"] for row in results], [13, 2, 4, None])
+
+        result = self.client.get("/inventory/search-results?search=purple")
+        self.assertIn("4 oz", result.data)
+
+    def test_add_supplies_with_wrong_types(self):
+        """Rows with fields of the wrong type, or nothing to add, are errors
+        rather than crashes."""
+
+        supplies = [{"supply_type": "Acrylic Paint", "brand": 42,
+                     "color": "Electric Purple", "units": "oz", "qty": 4},
+                    {"supply_type": ["Acrylic Paint"], "brand": "Americana",
+                     "color": "Electric Purple", "units": "oz", "qty": 4},
+                    {"supply_type": "Acrylic Paint", "brand": "Americana",
+                     "color": "Electric Purple", "units": "oz", "qty": 0},
+                    {"supply_type": "Acrylic Paint", "brand": "Americana",
+                     "color": "Electric Purple", "units": "oz", "qty": 2.5},
+                    {"supply_type": "Acrylic Paint", "brand": "Americana",
+                     "color": "Electric Purple", "units": "  ", "qty": 4}]
+
+        result = self.client.post("/add-supplies",
+                                  data=json.dumps({"supplies": supplies}),
+                                  content_type="application/json")
+        results = json.loads(result.data)["results"]
+
+        self.assertEqual([row["status"] for row in results], ["error"] * 5)
+        self.assertEqual(results[0]["message"], "The brand should be text.")
+        self.assertEqual(results[2]["message"], "The quantity should be at least 1.")
+        self.assertEqual(results[4]["message"], "Units are required for a new supply.")
+        self.assertIsNone(SupplyDetail.query.filter_by(color="Electric Purple").first())
+
     def test_overwrite_inventory_item(self):
         """Test whether the we can successfully overwrite an item in the user's
         inventory with a new qty."""
@@ -363,6 +1038,119 @@ class CCTestsDatabaseChanges(unittest.TestCase):
         # contain the new qty and units.
         self.assertIn("5 oz", result.data)
 
+    def test_inventory_fragments_follow_item_changes(self):
+        """Filtered inventory HTML should be reused until the user's items
+        change through the app."""
+
+        url = "/inventory/filter?brand=&supplytype=Oven-Bake+Clay&color="
+        self.assertIn("10 oz", self.client.get(url).data)
+
+        # Changing the item behind the app's back doesn't touch the cached HTML.
+        db.session.execute("UPDATE items SET qty = 7 WHERE item_id = 1")
+        db.session.commit()
+        self.assertIn("10 oz", self.client.get(url).data)
+
+        self.client.post("/update-item", data={"qty": "5", "itemID": "1"})
+        result = self.client.get(url)
+        self.assertIn("5 oz", result.data)
+        self.assertNotIn("10 oz", result.data)
+
+    def test_update_item_json_change(self):
+        """The dashboard should hear exactly what changed when it asks for JSON."""
+
+        result = self.client.post("/update-item",
+                                  data={"qty": "5", "itemID": "1"},
+                                  headers={"Accept": "application/json"})
+        data = json.loads(result.data)
+        self.assertEqual(data["change"], {"item_id": 1, "deleted": False, "qty": 5})
+        self.assertIn("5 oz", data["message"])
+
+        result = self.client.post("/update-item",
+                                  data={"qty": "0", "itemID": "1"},
+                                  headers={"Accept": "application/json"})
+        self.assertEqual(json.loads(result.data)["change"], {"item_id": 1, "deleted": True})
+
+        data = json.loads(self.client.get("/inventory/data").data)
+        self.assertNotIn(1, data["rows"]["item_id"])
+
+    def test_update_item_json_from_jquery(self):
+        """jQuery's $.post(..., "json") asks for more than just JSON, and
+        should still get JSON back."""
+
+        result = self.client.post("/update-item",
+                                  data={"qty": "5", "itemID": "1"},
+                                  headers={"Accept": "application/json, text/javascript, */*; q=0.01"})
+        self.assertEqual(result.mimetype, "application/json")
+        self.assertEqual(json.loads(result.data)["change"]["qty"], 5)
+
+        # Anything that doesn't ask for JSON gets the plain message.
+        result = self.client.post("/update-item",
+                                  data={"qty": "6", "itemID": "1"},
+                                  headers={"Accept": "*/*"})
+        self.assertIn("6 oz", result.data)
+        self.assertNotEqual(result.mimetype, "application/json")
+
+    def test_inventory_changes_since_version(self):
+        """Each request that changes the inventory should move it on one
+        version, and asking what changed since then should only get what did."""
+
+        data = json.loads(self.client.get("/inventory/data").data)
+        version = data["version"]
+
+        self.client.post("/update-item", data={"qty": "5", "itemID": "1"})
+        self.client.post("/update-item", data={"qty": "0", "itemID": "3"})
+
+        result = self.client.get("/inventory/changes?since=%s" % version)
+        changes = json.loads(result.data)
+
+        self.assertEqual(changes["version"], version + 2)
+        self.assertEqual([(item["item_id"], item["qty"]) for item in changes["items"]], [(1, 5)])
+        self.assertEqual(changes["deleted"], [3])
+
+        result = self.client.get("/inventory/changes?since=%s" % changes["version"])
+        self.assertEqual(json.loads(result.data), {"version": version + 2, "items": [], "deleted": []})
+
+        result = self.client.get("/inventory/changes?since=yesterday")
+        self.assertEqual(result.status_code, 400)
+
+    def test_inventory_changes_forget_old_deletions(self):
+        """Deletions are only remembered for so many versions. Anyone further
+        behind than that should be told to reload."""
+
+        self.client.post("/update-item", data={"qty": "0", "itemID": "3"})
+        version = User.query.get(1).inventory_version
+
+        # Pretend a lot has happened since.
+        with unit_of_work():
+            User.query.get(1).inventory_version += ITEM_DELETION_RETENTION
+
+        self.client.post("/update-item", data={"qty": "0", "itemID": "1"})
+
+        self.assertEqual([deletion.item_id for deletion in ItemDeletion.query.all()], [1])
+
+        changes = User.query.get(1).get_inventory_changes(0)
+        self.assertEqual(changes, {"version": version + ITEM_DELETION_RETENTION + 1,
+                                   "reload": True})
+
+    def test_bulk_add_is_one_version(self):
+        """However many items one request changes, that's one new version."""
+
+        user = User.query.get(1)
+        version = user.inventory_version
+
+        supplies = [{"supply_type": "Oven-Bake Clay", "brand": "Sculpey",
+                     "color": "White", "units": "oz", "qty": 3},
+                    {"supply_type": "Acrylic Paint", "brand": "Americana",
+                     "color": "Calypso Blue", "units": "oz", "qty": 2}]
+
+        self.client.post("/add-supplies",
+                         data=json.dumps({"supplies": supplies}),
+                         content_type="application/json")
+
+        changes = User.query.get(1).get_inventory_changes(version)
+        self.assertEqual(changes["version"], version + 1)
+        self.assertEqual(len(changes["items"]), 2)
+
     def test_delete_inventory_item(self):
         """Test whether we can successfully delete an item in the user's inventory
         if they explicitly ask to update that item with a qty of 0."""
@@ -399,6 +1187,101 @@ class CCTestsDatabaseChanges(unittest.TestCase):
         self.assertIn("Hooray!", result.data)
         self.assertIn("Emergency Crafting System", result.data)
 
+    def test_add_project_with_unknown_supply_saves_nothing(self):
+        """A project with any supply we can't match shouldn't be saved at all."""
+
+        num_projects = Project.query.count()
+
+        data = {
+            "title": "A Half-Finished Project",
+            "description": "One of these supplies doesn't exist.",
+            "instr-url": "",
+            "img-url": "",
+            "num-supplies": "2",
+            "supplytype0": "Acrylic Paint",
+            "brand0": "Americana",
+            "color0": "Calypso Blue",
+            "qty-required0": 2,
+            "supplytype1": "Acrylic Paint",
+            "brand1": "Americana",
+            "color1": "Not A Real Color",
+            "qty-required1": 1,
+        }
+
+        result = self.client.post("/create-project", data=data, follow_redirects=True)
+
+        self.assertIn("No supply matches Americana Not A Real Color Acrylic Paint.", result.data)
+        self.assertEqual(Project.query.count(), num_projects)
+
+    def test_unit_of_work_rolls_back_together(self):
+        """Nothing done in a failed unit of work is saved, and nothing waiting
+        for it to commit gets called."""
+
+        committed = []
+
+        with self.assertRaises(RuntimeError):
+            with unit_of_work():
+                add_user_to_db("oops@test.com", "oops", "not-a-hash")
+                on_commit(lambda: committed.append(True))
+                raise RuntimeError("Something went wrong partway through.")
+
+        self.assertIsNone(User.query.filter_by(username="oops").first())
+        self.assertEqual(committed, [])
+
+        with unit_of_work():
+            add_user_to_db("fine@test.com", "fine", "not-a-hash")
+            on_commit(lambda: committed.append(True))
+
+        self.assertIsNotNone(User.query.filter_by(username="fine").first())
+        self.assertEqual(committed, [True])
+
+
+class CCTestsBulkSeed(unittest.TestCase):
+    """Tests for seeding the database in bulk from the files in seed_data/."""
+
+    def setUp(self):
+        connect_to_db(app, "postgresql:///testdb", profile="test")
+
+        db.create_all()
+        example_data()
+
+    def tearDown(self):
+        db.session.close()
+        db.drop_all()
+
+    def test_bulk_load_replaces_data(self):
+        tag_index_version = inventory_tag_indexes.version
+        total_rows = bulk_load_all()
+
+        self.assertEqual(total_rows, 567)
+        self.assertEqual(SupplyDetail.query.count(), 542)
+        self.assertIsNone(User.query.filter_by(username="ihaveprojects").first())
+
+        # Rows should look exactly like the ones the ORM loaders make.
+        sd = SupplyDetail.query.get(0)
+        self.assertEqual((sd.supply_type, sd.brand, sd.color, sd.units, sd.purchase_url),
+                         ("Acrylic Paint", "Americana", "Snow (Titanium) White", "oz", ""))
+
+        # Autocomplete shouldn't offer tags from the old inventories.
+        self.assertNotEqual(inventory_tag_indexes.version, tag_index_version)
+
+    def test_bulk_load_after_deletions(self):
+        """Reseeding a database someone's deleted items from should forget
+        those deletions, instead of tripping over them."""
+
+        client = app.test_client()
+
+        with client.session_transaction() as session:
+            session['user_id'] = 1
+
+        client.post("/update-item", data={"qty": "0", "itemID": "1"})
+        self.assertEqual(ItemDeletion.query.count(), 1)
+
+        bulk_load_all()
+
+        self.assertEqual(ItemDeletion.query.count(), 0)
+        self.assertEqual(User.query.get(1).get_inventory_changes(0)["deleted"], [])
+
 
 ######################################################################
 # Helpers/code to run the tests
@@ -411,5 +1294,24 @@ def add_test_user_to_session(test_class_instance):
             session['user_id'] = 1
             session['username'] = 'ihaveprojects'
 
+
+def use_strict_sql_budgets():
+    """Fail any request that runs too many queries, or the same one over and
+    over. How long SQL takes depends on the machine, so time isn't checked."""
+
+    app.config['SQL_STRICT'] = True
+    app.config['SQL_TIME_BUDGET'] = float("inf")
+
+
+def reset_sql_budgets():
+    """Put the SQL budgets back how query_stats.py has them, so tests that
+    change them don't leak into tests that run later."""
+
+    app.config['SQL_STRICT'] = False
+    app.config['SQL_QUERY_BUDGET'] = SQL_QUERY_BUDGET
+    app.config['SQL_TIME_BUDGET'] = SQL_TIME_BUDGET
+    app.config['SQL_REPEAT_BUDGET'] = SQL_REPEAT_BUDGET
+
+
 if __name__ == "__main__":
     unittest.main()